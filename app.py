@@ -1,12 +1,21 @@
-from flask import Flask, request, jsonify
+import os
+import time
+
+from flask import Flask, Response, request, jsonify, stream_with_context, send_file
 from flask_cors import CORS
 
-from query_builder import QueryBuilder
+from connection import pool_stats
+from export import ExportManager
+from metrics import ActionTimer, RecordedErrors, REQUEST_SECONDS, observe_response, render_metrics
+from query_builder import QueryBuilder, action_label
+from resilience import error_status
+from serialization import dumps
 
 app = Flask(__name__)
 CORS(app)
 
 builder = QueryBuilder()
+exports = ExportManager(builder)
 
 
 @app.route('/ask/storage/', methods=['POST'])
@@ -16,14 +25,117 @@ def ask_elastic_storage():
     if 'action' not in data.keys():
         return 'action not in request body', 400
     else:
-        elastic_results = builder.command(action=data['action'], payload=data)
-        json_results = builder.get_source(elastic_results)
+        label = action_label(data['action'])
+        with ActionTimer(REQUEST_SECONDS, label):
+            with RecordedErrors() as errors:
+                elastic_results = builder.command(action=data['action'], payload=data)
+            if elastic_results is None and errors:
+                status, headers = error_status(errors[-1])
+                body = dumps({'error': type(errors[-1]).__name__, 'reason': str(errors[-1])})
+                return Response(body, status, mimetype='application/json', headers=headers)
+
+            if data.get('stream'):
+                return Response(
+                    stream_with_context(builder.stream_source(elastic_results)),
+                    mimetype='application/x-ndjson'
+                )
+
+            start = time.perf_counter()
+            if 'file_type' in data.keys():
+                json_results = builder.get_source(elastic_results)
+                builder.save_results(
+                    results=json_results['results'] if isinstance(json_results, dict) else json_results,
+                    file_name=data['action'],
+                    file_type=data['file_type']
+                )
+
+            body = builder.encode_results(elastic_results)
+            observe_response(label, start, len(body))
+            return Response(body, mimetype='application/json')
+
+
+@app.route('/ask/storage/tasks/<task_id>', methods=['GET'])
+def elastic_task_status(task_id):
+    task = builder.command(action='get_task', payload={'task_id': task_id})
+    if task is None:
+        return 'unknown task', 404
+    return jsonify(task)
+
+
+@app.route('/ask/storage/pool/', methods=['GET'])
+def elastic_pool_stats():
+    return jsonify(pool_stats())
+
+
+@app.route('/ask/storage/cache/', methods=['GET'])
+def query_cache_stats():
+    stats = builder.cache.stats() if builder.cache is not None else {'backend': 'none'}
+    if builder.client.documents is not None:
+        stats['documents'] = builder.client.documents.stats()
+    if builder.single_flight is not None:
+        stats['single_flight'] = builder.single_flight.stats()
+    return jsonify(stats)
+
+
+@app.route('/ask/storage/slow/', methods=['GET'])
+def slow_queries():
+    return jsonify(builder.slow_queries.recent())
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+
+@app.route('/ask/storage/batch/', methods=['POST'])
+def ask_elastic_storage_batch():
+    data = request.get_json()
+    payloads = data['requests'] if isinstance(data, dict) else data
+
+    if not isinstance(payloads, list) or not all(isinstance(p, dict) and 'action' in p for p in payloads):
+        return 'requests must be a list of payloads with an action', 400
+
+    with ActionTimer(REQUEST_SECONDS, 'batch'):
+        items = builder.batch(payloads)
+        start = time.perf_counter()
+        for item in items:
+            if 'results' in item:
+                item['results'] = builder.get_source(item['results'])
+        body = dumps(items)
+        observe_response('batch', start, len(body))
+        return Response(body, mimetype='application/json')
+
+
+@app.route('/ask/storage/export/', methods=['POST'])
+def export_elastic_storage():
+    data = request.get_json()
+
+    if 'action' not in data.keys():
+        return 'action not in request body', 400
+    try:
+        job = exports.submit(
+            action=data['action'],
+            payload=data,
+            file_type=data.get('file_type', 'ndjson'),
+            compression=data.get('compression', 'none')
+        )
+    except ValueError as ex:
+        return str(ex), 400
+    return jsonify(job), 202
+
+
+@app.route('/ask/storage/export/<job_id>', methods=['GET'])
+def export_status(job_id):
+    job = exports.status(job_id)
+    if job is None:
+        return 'unknown export job', 404
+    return jsonify(job)
 
-        if 'file_type' in data.keys():
-            builder.save_results(
-                results=json_results,
-                file_name=data['action'],
-                file_type=data['file_type']
-            )
 
-        return jsonify(json_results)
+@app.route('/ask/storage/export/<job_id>/download', methods=['GET'])
+def export_download(job_id):
+    path = exports.file_path(job_id)
+    if path is None:
+        return 'export job is unknown or not finished', 404
+    return send_file(os.path.abspath(path), as_attachment=True)
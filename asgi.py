@@ -0,0 +1,121 @@
+#  ASGI flavour of app.py, run with: uvicorn asgi:app --workers 4
+import time
+
+from async_query_builder import AsyncQueryBuilder
+from metrics import ActionTimer, RecordedErrors, REQUEST_SECONDS, observe_response, render_metrics
+from query_builder import action_label
+from resilience import error_status
+from serialization import loads, dumps
+
+builder = AsyncQueryBuilder()
+
+
+async def read_body(receive):
+    """
+    This function is used to read the full request body of an ASGI http request
+
+    :param receive: ASGI receive callable
+    :return: request body bytes
+    """
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_response(send, status, body, content_type='application/json', headers=None):
+    """
+    This function is used to send a complete ASGI http response
+
+    :param send: ASGI send callable
+    :param status: http status code
+    :param body: response body bytes
+    :param content_type: response content type
+    :param headers: extra response headers
+    """
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [[b'content-type', content_type.encode()], [b'access-control-allow-origin', b'*']] +
+                   [[name.lower().encode(), value.encode()] for name, value in (headers or {}).items()]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def ask_elastic_storage(receive, send):
+    data = loads(await read_body(receive) or b'{}')
+
+    if 'action' not in data.keys():
+        await send_response(send, 400, b'action not in request body', content_type='text/plain')
+        return
+
+    label = action_label(data['action'])
+    with ActionTimer(REQUEST_SECONDS, label):
+        with RecordedErrors() as errors:
+            elastic_results = await builder.command(action=data['action'], payload=data)
+        if elastic_results is None and errors:
+            status, headers = error_status(errors[-1])
+            body = dumps({'error': type(errors[-1]).__name__, 'reason': str(errors[-1])})
+            await send_response(send, status, body, headers=headers)
+            return
+
+        if data.get('stream'):
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [[b'content-type', b'application/x-ndjson'], [b'access-control-allow-origin', b'*']]
+            })
+            async for line in builder.stream_source(elastic_results):
+                await send({'type': 'http.response.body', 'body': line.encode(), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        start = time.perf_counter()
+        if 'file_type' in data.keys():
+            json_results = builder.get_source(elastic_results)
+            builder.save_results(
+                results=json_results['results'] if isinstance(json_results, dict) else json_results,
+                file_name=data['action'],
+                file_type=data['file_type']
+            )
+
+        body = builder.encode_results(elastic_results)
+        observe_response(label, start, len(body))
+        await send_response(send, 200, body)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await builder.client.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    if scope['method'] == 'OPTIONS':
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                [b'access-control-allow-origin', b'*'],
+                [b'access-control-allow-methods', b'GET, POST, OPTIONS'],
+                [b'access-control-allow-headers', b'content-type']
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': b''})
+    elif scope['path'] == '/ask/storage/' and scope['method'] == 'POST':
+        await ask_elastic_storage(receive, send)
+    elif scope['path'] == '/metrics' and scope['method'] == 'GET':
+        body, content_type = render_metrics()
+        await send_response(send, 200, body, content_type=content_type)
+    else:
+        await send_response(send, 404, b'not found', content_type='text/plain')
@@ -0,0 +1,116 @@
+import inspect
+import json
+import time
+
+from async_storage_client import AsyncElasticBookStorage
+from cache import make_query_cache, cache_key
+from metrics import ActionTimer, COMMAND_SECONDS, record_error, observe_results, es_took
+from query_builder import QueryBuilder, NO_RESULT_ACTIONS, WRITE_ACTIONS, action_label
+from settings import SINGLE_FLIGHT
+from single_flight import AsyncSingleFlight
+from slow_queries import SlowQueryLog
+from storage_client import profiling
+
+
+class AsyncQueryBuilder(QueryBuilder):
+    def __init__(self):
+        self.client = AsyncElasticBookStorage()
+        self.cache = make_query_cache()
+        # the materialized aggregates are only maintained by the sync QueryBuilder
+        self.materialized = None
+        self.single_flight = AsyncSingleFlight() if SINGLE_FLIGHT else None
+        self.slow_queries = SlowQueryLog()
+
+    @staticmethod
+    async def stream_source(results):
+        """
+        Asyncio flavour of QueryBuilder.stream_source
+
+        :param results: elasticsearch response or async hits generator
+        :return: async generator of NDJSON lines
+        """
+        if results is None:
+            return
+        if isinstance(results, dict):
+            yield json.dumps(results) + "\n"
+            return
+        async for book in results:
+            yield json.dumps(QueryBuilder.hit_source(book)) + "\n"
+
+    async def command(self, action, payload):
+        """
+        Asyncio flavour of QueryBuilder.command
+
+        :param action: parameter
+        :param payload: provided payload
+        :return: result
+
+        Example:
+            >>> builder = AsyncQueryBuilder()
+            >>> results = await builder.command(action='fetch_all', payload={})
+        """
+        stream = payload.get('stream')
+        profiles = [] if payload.get('profile') and not stream else None
+        start, took = time.perf_counter(), []
+        took_token, profiling_token = es_took.set(took), profiling.set(profiles)
+        try:
+            results = await self._command(action, payload)
+        finally:
+            es_took.reset(took_token)
+            profiling.reset(profiling_token)
+        if not stream:
+            self.slow_queries.observe(action_label(action), payload, time.perf_counter() - start, took, results)
+        return self.with_profile(results, profiles)
+
+    async def _command(self, action, payload):
+        """
+        Asyncio flavour of QueryBuilder._command
+
+        :param action: parameter
+        :param payload: provided payload
+        :return: result
+        """
+        label = action_label(action)
+        payload = self.refreshed(action, payload)
+        with ActionTimer(COMMAND_SECONDS, label):
+            try:
+                if self.is_cacheable(action, payload):
+                    key = cache_key(action, payload)
+                    results = self.cache.get(key)
+                    if results is None:
+                        generation = self.cache.generation()
+                        results = await self._execute(action, payload)
+                        if results is not None:
+                            self.cache.set(key, results, generation)
+                    observe_results(label, results)
+                    return results
+
+                results = await self._execute(action, payload)
+                if action in WRITE_ACTIONS and self.cache is not None:
+                    self.cache.clear()
+                if action == 'get_task' and results and results['completed'] and self.cache is not None:
+                    self.cache.clear()
+                if action in NO_RESULT_ACTIONS:
+                    results = None
+                observe_results(label, results)
+                return results
+            except Exception as ex:
+                record_error(ex)
+
+    async def _execute(self, action, payload):
+        """
+        Asyncio flavour of QueryBuilder._execute
+
+        :param action: parameter
+        :param payload: provided payload
+        :return: paginated results
+        """
+        async def run():
+            results = self._dispatch(action, payload)
+            if inspect.isawaitable(results):
+                results = await results
+            return self.paginate(results, payload)
+
+        if not self.is_coalesced(action, payload):
+            return await run()
+        return await self.single_flight.do(cache_key(action, payload), run)
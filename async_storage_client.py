@@ -0,0 +1,180 @@
+from elasticsearch import helpers
+
+from bulk_ingest import BulkIngestEngine
+from connection import get_async_client
+from metrics import record_error, timed_storage
+from settings import ELASTIC_INDEX, ELASTIC_DOC, ELASTIC_HOSTNAME, ELASTIC_PORT, HITS_SIZE, SCROLL_SIZE, \
+    SCROLL_TIMEOUT, UPDATE_SCRIPT_ID, USE_STORED_SCRIPTS
+from storage_client import ElasticBookStorage, HITS_FILTER_PATH, BOOK_UPDATE_SCRIPT, BOOK_ID_FIELD, profiling
+
+
+def sync_only(name):
+    """
+    This function is used to build the error raised by the methods only ElasticBookStorage implements
+
+    :param name: method name
+    :return: TypeError
+    """
+    return TypeError("{} is not supported by AsyncElasticBookStorage, run it with ElasticBookStorage".format(name))
+
+
+@timed_storage
+class AsyncElasticBookStorage(ElasticBookStorage):
+    """
+    Asyncio flavour of ElasticBookStorage built on the AsyncElasticsearch transport.
+
+    The query methods are inherited: they only build request bodies and hand them either to
+    self.es or to the _search/_aggregate/_delete_by_query/_update_by_query/_mget primitives, which are overridden
+    here with coroutines. Every public method therefore returns an awaitable, or an async
+    generator of hits when stream is enabled.
+
+    Of the index administration methods, create_book_index, live_indices, mapping_version and bulk_insert
+    (without bulk_load) are coroutines too. reindex and bulk_load_mode raise TypeError, they are only
+    run by ElasticBookStorage, and so do the batch primitives _msearch and _mget_docs.
+
+    :Example:
+        >>> elk = AsyncElasticBookStorage()
+        >>> books = await elk.fetch_all_docs()
+    """
+
+    def __init__(self):
+        self.book_index = ELASTIC_INDEX
+        self.book_doc = ELASTIC_DOC
+        self.ELK_HOSTNAME = ELASTIC_HOSTNAME
+        self.ELK_PORT = ELASTIC_PORT
+
+        self.es = get_async_client()
+        # the document cache and the write-behind buffer are only used by the sync storage
+        self.documents = None
+        self.write_behind = None
+
+    def _search(self, body, stream=False, page=None, projection=None):
+        if projection:
+            body = dict(body, **projection)
+        if stream:
+            return helpers.async_scan(
+                self.es,
+                query=body,
+                index=self.book_index,
+                size=SCROLL_SIZE,
+                scroll=SCROLL_TIMEOUT
+            )
+        if page is not None:
+            body = self._page_body(body, page)
+        return self._hits(
+            body,
+            size=HITS_SIZE if page is None else None,
+            filter_path=HITS_FILTER_PATH
+        )
+
+    async def _hits(self, body, size=None, filter_path=None):
+        profiles = profiling.get()
+        if profiles is not None:
+            body, filter_path = dict(body, profile=True), filter_path + ',profile'
+        results = await self.es.search(index=self.book_index, body=body, size=size, filter_path=filter_path)
+        if profiles is not None:
+            profiles.append(results.get("profile"))
+        return results.get("hits", {}).get("hits", [])
+
+    async def _aggregate(self, body):
+        profiles = profiling.get()
+        if profiles is not None:
+            body = dict(body, profile=True)
+        results = await self.es.search(index=self.book_index, body=body, size=0)
+        if profiles is not None:
+            profiles.append(results.get("profile"))
+        return results["aggregations"]
+
+    async def _delete_by_query(self, body, params):
+        response = await self.es.delete_by_query(index=self.book_index, body=body, params=params)
+        if 'task' in response:
+            return {'task_id': response['task']}
+        return {'count': response['deleted']}
+
+    async def _update_by_query(self, body, params):
+        if USE_STORED_SCRIPTS and not self.update_script_stored:
+            await self.es.put_script(
+                id=UPDATE_SCRIPT_ID,
+                body={'script': {'lang': 'painless', 'source': BOOK_UPDATE_SCRIPT}}
+            )
+            ElasticBookStorage.update_script_stored = True
+        response = await self.es.update_by_query(index=self.book_index, body=body, params=params)
+        if 'task' in response:
+            return {'task_id': response['task']}
+        return response
+
+    async def _get_task(self, task_id):
+        return self._task_status(await self.es.tasks.get(task_id=task_id))
+
+    async def _mget(self, book_ids, projection=None):
+        book_results = await self.es.mget(
+            index=self.book_index,
+            doc_type=self.book_doc,
+            body={'ids': book_ids},
+            params=self._source_params(projection)
+        )
+        return {'docs': [book.get('_source', {'_id': book['_id']}) for book in book_results['docs']]}
+
+    async def mapping_version(self):
+        """Asyncio flavour of ElasticBookStorage.mapping_version"""
+        try:
+            return self._mapping_version(await self.es.indices.get_mapping(index=self.book_index, ignore=404))
+        except Exception as ex:
+            record_error(ex)
+
+    async def live_indices(self):
+        """Asyncio flavour of ElasticBookStorage.live_indices"""
+        if await self.es.indices.exists_alias(name=self.book_index):
+            return sorted(await self.es.indices.get_alias(name=self.book_index))
+        if await self.es.indices.exists(index=self.book_index):
+            return [self.book_index]
+        return []
+
+    async def create_book_index(self, number_of_shards=None, number_of_replicas=None):
+        """Asyncio flavour of ElasticBookStorage.create_book_index"""
+        try:
+            if await self.live_indices():
+                return None
+            body = dict(self.book_index_body(number_of_shards, number_of_replicas), aliases={self.book_index: {}})
+            return await self.es.indices.create(index=self.new_index_name(), body=body)
+        except Exception as ex:
+            record_error(ex)
+
+    async def bulk_insert(self, data, bulk_load=False, refresh=False, **kwargs):
+        """
+        Asyncio flavour of ElasticBookStorage.bulk_insert
+
+        :param data: list of dict, iterator of dict or NDJSON file path
+        :param bulk_load: not supported, see bulk_load_mode
+        :param refresh: refresh the index once the data is in, so it is searchable on return
+        :param kwargs: BulkIngestEngine options
+        :return: ingest report
+        """
+        if bulk_load:
+            raise sync_only('bulk_insert with bulk_load')
+        try:
+            engine = BulkIngestEngine(self.es, self.book_index, self.book_doc, id_copy=BOOK_ID_FIELD, **kwargs)
+            report = await engine.async_ingest(data)
+            if refresh:
+                await self.es.indices.refresh(index=self.book_index)
+            return report
+        except Exception as e:
+            record_error(e)
+
+    def reindex(self, *args, **kwargs):
+        """reindex is not supported by the async storage, see ElasticBookStorage.reindex"""
+        raise sync_only('reindex')
+
+    def bulk_load_mode(self):
+        """bulk_load_mode is not supported by the async storage, see ElasticBookStorage.bulk_load_mode"""
+        raise sync_only('bulk_load_mode')
+
+    def _msearch(self, plans):
+        raise sync_only('batch')
+
+    def _mget_docs(self, book_ids, projections=None):
+        raise sync_only('batch')
+
+    async def close(self):
+        """This function is used to close the underlying aiohttp session"""
+        await self.es.close()
@@ -0,0 +1,86 @@
+#  This file is used to compare the throughput of the sync and async query paths
+#  Usage: python benchmarks/async_vs_sync.py [action] [requests] [concurrency]
+#  Requires a running, initialized ElasticSearch (see initializer.py)
+#  The query cache, request coalescing and the document cache are disabled, so both paths measure
+#  elasticsearch round trips rather than cache hits
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# settings are read at import time, so disable the cache layers before importing the builders
+os.environ['QUERY_CACHE_BACKEND'] = 'none'
+os.environ['SINGLE_FLIGHT'] = 'false'
+os.environ['DOC_CACHE_MAX_BYTES'] = '0'
+
+from async_query_builder import AsyncQueryBuilder  # noqa: E402
+from query_builder import QueryBuilder  # noqa: E402
+
+# gunicorn --workers=4 in modules/run.sh: at most 4 sync requests in flight
+SYNC_WORKERS = 4
+
+PAYLOADS = {
+    'fetch_all': {},
+    'search_book_by_parameter': {'field': 'title', 'query': 'in action'},
+    'fuzzy_queries': {'query': 'comprihensiv guide', 'fields': ['title', 'summary']},
+    'metric_aggregations': {'field': 'num_reviews', 'metric': 'avg'},
+}
+
+
+def bench_sync(action, payload, requests):
+    """
+    This function is used to run the requests through the sync QueryBuilder
+    with SYNC_WORKERS requests in flight
+
+    :param action: action to run
+    :param payload: action payload
+    :param requests: number of requests
+    :return: requests per second
+    """
+    builder = QueryBuilder()
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        list(executor.map(lambda _: builder.command(action=action, payload=payload), range(requests)))
+    return requests / (time.time() - start)
+
+
+async def bench_async(action, payload, requests, concurrency):
+    """
+    This function is used to run the requests through the AsyncQueryBuilder
+    with up to concurrency requests in flight on a single event loop
+
+    :param action: action to run
+    :param payload: action payload
+    :param requests: number of requests
+    :param concurrency: requests in flight
+    :return: requests per second
+    """
+    builder = AsyncQueryBuilder()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await builder.command(action=action, payload=payload)
+
+    start = time.time()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    elapsed = time.time() - start
+    await builder.client.close()
+    return requests / elapsed
+
+
+if __name__ == "__main__":
+    action = sys.argv[1] if len(sys.argv) > 1 else 'search_book_by_parameter'
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    payload = PAYLOADS.get(action, {})
+
+    sync_rps = bench_sync(action, payload, requests)
+    print("sync  ({} in flight):  {:.0f} req/s".format(SYNC_WORKERS, sync_rps))
+
+    async_rps = asyncio.run(bench_async(action, payload, requests, concurrency))
+    print("async ({} in flight): {:.0f} req/s".format(concurrency, async_rps))
+    print("speedup: {:.1f}x".format(async_rps / sync_rps))
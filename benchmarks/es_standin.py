@@ -0,0 +1,264 @@
+#  This file is a lightweight local stand-in for the ElasticSearch REST endpoints this project uses
+#  (_search/scroll, _msearch, _mget, _doc, _bulk, _update_by_query, _delete_by_query, _reindex, _aliases, _alias,
+#  _settings, _forcemerge, _scripts, _tasks, _cluster/*),
+#  answered by the embedded engine, with configurable injected latency and 503 rejections
+#  Usage: python benchmarks/es_standin.py [--port 9200] [--latency-ms 2] [--jitter-ms 0] [--error-rate 0]
+#  [--data-dir DIR]
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, unquote
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from elasticsearch import TransportError  # noqa: E402
+
+from embedded_storage_client import EmbeddedClient, index_not_found, transport_error  # noqa: E402
+
+# endpoints that take the index from the path: /{index}/_endpoint or /{index}/{doc_type}/_endpoint
+INDEX_ENDPOINTS = ('_search', '_count', '_msearch', '_mget', '_bulk', '_delete_by_query', '_update_by_query',
+                   '_refresh', '_forcemerge', '_mapping', '_settings')
+
+
+def route(es, method, parts, params, body):
+    """
+    This function is used to dispatch a REST request to the EmbeddedClient method serving it
+
+    :param es: EmbeddedClient
+    :param method: HTTP method
+    :param parts: decoded path segments
+    :param params: query parameters
+    :param body: parsed JSON body, raw text for NDJSON endpoints, or None
+    :return: response body
+    """
+    endpoint = parts[0] if parts else None
+    if endpoint == '_bulk':
+        return es.bulk(body, params=params)
+    if endpoint == '_msearch':
+        return es.msearch(body, params=params)
+    if endpoint == '_mget':
+        return es.mget(body, params=params)
+    if endpoint == '_search' and parts[1:] == ['scroll']:
+        if method == 'DELETE':
+            return es.clear_scroll(body=body, params=params)
+        return es.scroll(body=body, params=params)
+    if endpoint == '_reindex':
+        return es.reindex(body, params=params)
+    if endpoint == '_aliases':
+        return es.indices.update_aliases(body, params=params)
+    if endpoint == '_alias':
+        name = parts[1] if len(parts) > 1 else None
+        if method == 'HEAD':
+            if not es.indices.exists_alias(name):
+                raise transport_error(404, 'aliases_not_found_exception', "alias [{}] missing".format(name))
+            return {}
+        return es.indices.get_alias(name=name, params=params)
+    if endpoint == '_scripts' and method in ('PUT', 'POST'):
+        return es.put_script(parts[1], body, params=params)
+    if endpoint == '_tasks':
+        return es.tasks.get(parts[1], params=params)
+    if endpoint == '_cluster' and parts[1:] == ['health']:
+        return es.cluster.health(params=params)
+    if endpoint == '_cluster' and parts[1:] == ['stats']:
+        return es.cluster.stats(params=params)
+    if endpoint in ('_refresh', '_forcemerge', '_settings'):
+        return route(es, method, ['_all', endpoint], params, body)
+    if endpoint is None or endpoint.startswith('_'):
+        raise transport_error(400, 'invalid_index_name_exception', "unsupported endpoint [{}]".format(endpoint))
+
+    index = None if endpoint == '_all' else endpoint
+    if len(parts) == 1:
+        if method == 'PUT':
+            return es.indices.create(index, body=body, params=params)
+        if method == 'DELETE':
+            return es.indices.delete(index, params=params)
+        if method == 'HEAD':
+            if not es.indices.exists(index):
+                raise index_not_found(index)
+            return {}
+        if method == 'GET':
+            # the async client sends indices.exists as a GET
+            if not es.indices.exists(index):
+                raise index_not_found(index)
+            aliases = es.indices.get_alias(index=index)
+            return {
+                name: dict(aliases.get(name, {'aliases': {}}), **mapping, **es.indices.get_settings(index=name)[name])
+                for name, mapping in es.indices.get_mapping(index).items()
+            }
+        raise transport_error(400, 'illegal_argument_exception', "unsupported request [{} /{}]".format(method, index))
+
+    # typed urls, /{index}/{doc_type}/_endpoint
+    if len(parts) >= 3 and parts[2] in INDEX_ENDPOINTS:
+        parts = [parts[0]] + parts[2:]
+
+    operation = parts[1]
+    if operation in ('_alias', '_aliases'):
+        name = parts[2] if len(parts) > 2 else None
+        if method == 'HEAD':
+            if not es.indices.exists_alias(name, index=index):
+                raise transport_error(404, 'aliases_not_found_exception', "alias [{}] missing".format(name))
+            return {}
+        return es.indices.get_alias(index=index, name=name, params=params)
+    if operation == '_search':
+        return es.search(body=body, index=index, params=params)
+    if operation == '_count':
+        return es.count(body=body, index=index, params=params)
+    if operation == '_msearch':
+        return es.msearch(body, index=index, params=params)
+    if operation == '_mget':
+        return es.mget(body, index=index, params=params)
+    if operation == '_bulk':
+        return es.bulk(body, index=index, params=params)
+    if operation == '_delete_by_query':
+        return es.delete_by_query(index, body, params=params)
+    if operation == '_update_by_query':
+        return es.update_by_query(index, body=body, params=params)
+    if operation == '_refresh':
+        return es.indices.refresh(index=index, params=params)
+    if operation == '_forcemerge':
+        return es.indices.forcemerge(index=index, params=params)
+    if operation == '_mapping':
+        return es.indices.get_mapping(index, params=params)
+    if operation == '_settings':
+        if method in ('PUT', 'POST'):
+            return es.indices.put_settings(body, index=index, params=params)
+        return es.indices.get_settings(index=index, params=params)
+    if operation == '_source' and len(parts) == 3:
+        return es.get_source(index, parts[2], params=params)
+
+    # documents, /{index}/{doc_type}[/{id}[/_source|_update]]
+    doc_type = None if operation in ('_doc', '_update') else operation
+    if len(parts) == 2:
+        return es.index(index, body, doc_type=doc_type, params=params)
+    doc_id = parts[2]
+    action = parts[3] if len(parts) > 3 else operation
+    if action == '_source':
+        return es.get_source(index, doc_id, doc_type=doc_type, params=params)
+    if action == '_update':
+        return es.update(index, doc_id, body, doc_type=doc_type, params=params)
+    if method in ('PUT', 'POST'):
+        return es.index(index, body, doc_type=doc_type, id=doc_id, params=params)
+    if method == 'DELETE':
+        return es.delete(index, doc_id, doc_type=doc_type, params=params)
+    raise transport_error(400, 'illegal_argument_exception', "unsupported request [{} /{}]".format(method,
+                                                                                                 '/'.join(parts)))
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Request handler of the stand-in, the server carries the client and the injected latency"""
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, without this every response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def _handle(self):
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.split('/') if part]
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length).decode('utf-8') if length else ''
+
+        status = 200
+        try:
+            if self.server.rejected():
+                raise transport_error(503, 'unavailable_shards_exception', 'injected rejection')
+            ndjson = url.path.rstrip('/').endswith(('_bulk', '_msearch'))
+            body = raw if ndjson else (json.loads(raw) if raw.strip() else None)
+            response = route(self.server.es, self.command, parts, params, body)
+            if response is True:
+                response = {}
+            if parts and parts[-1] not in ('_search', '_msearch') and isinstance(response, dict) \
+                    and response.get('result') == 'created':
+                status = 201
+        except TransportError as ex:
+            status = ex.status_code if isinstance(ex.status_code, int) else 500
+            response = ex.info if isinstance(ex.info, dict) else {'error': str(ex.error), 'status': status}
+        except (KeyError, IndexError, ValueError, TypeError) as ex:
+            status = 400
+            response = {'error': {'type': 'parse_exception', 'reason': str(ex)}, 'status': 400}
+
+        self.server.inject_latency()
+        data = b'' if self.command == 'HEAD' else json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandinServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server answering elasticsearch REST requests from an EmbeddedClient.
+    Every response is delayed by latency_ms plus a uniform random jitter_ms, to mimic the
+    network and cluster time of a real round trip, and a fraction error_rate of the requests
+    is rejected with a 503 without being executed, to mimic an overloaded cluster.
+
+    :Example:
+        >>> server = StandinServer(('127.0.0.1', 9200), EmbeddedClient(tempfile.mkdtemp()), latency_ms=2)
+        >>> threading.Thread(target=server.serve_forever, daemon=True).start()
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, es, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0):
+        super(StandinServer, self).__init__(address, StandinHandler)
+        self.es = es
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+    def rejected(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def inject_latency(self):
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+
+def start_standin(port=0, latency_ms=0.0, jitter_ms=0.0, data_dir=None, error_rate=0.0):
+    """
+    This function is used to start a stand-in in a background thread
+
+    :param port: port to listen on, 0 picks a free one
+    :param latency_ms: injected latency per request
+    :param jitter_ms: random extra latency per request
+    :param data_dir: embedded data directory, a temporary one by default
+    :param error_rate: fraction of the requests rejected with a 503
+    :return: running StandinServer, its port is server.server_address[1]
+    """
+    server = StandinServer(('127.0.0.1', port), EmbeddedClient(data_dir or tempfile.mkdtemp(prefix='es_standin_')),
+                           latency_ms, jitter_ms, error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local ElasticSearch stand-in with injected latency")
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--data-dir', default=None)
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='es_standin_')
+    standin = StandinServer(('127.0.0.1', args.port), EmbeddedClient(data_dir), args.latency_ms, args.jitter_ms,
+                            args.error_rate)
+    print("ElasticSearch stand-in on http://127.0.0.1:{} ({} ms + up to {} ms latency, {:.0%} rejected, "
+          "data in {})".format(args.port, args.latency_ms, args.jitter_ms, args.error_rate, data_dir), flush=True)
+    try:
+        standin.serve_forever()
+    except KeyboardInterrupt:
+        standin.es.close()
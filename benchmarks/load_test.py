@@ -0,0 +1,329 @@
+#  This file is used to load test every /ask/storage/ action against a local ElasticSearch stand-in
+#  Usage: python benchmarks/load_test.py [--concurrency 1,4,16,64] [--requests 200] [--latency-ms 2]
+#                                        [--json results.json] [--baseline baseline.json] [--tolerance 0.25]
+#  Reports p50/p95/p99 latency and requests/sec per action and concurrency level. Every request reaches the
+#  stand-in: the query cache, request coalescing and the document cache are disabled unless --cache is given.
+#  With --baseline it exits with status 1 when an action regressed, so it can gate CI.
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+
+# read actions first, write actions last so they do not change what the reads are measured against
+ACTIONS = [
+    ('fetch_all', {}),
+    ('fetch_all_page', {'action': 'fetch_all', 'page_size': 10}),
+    ('retrieve_book_by_id', {'book_id': None}),
+    ('multi_get', {'ids': None}),
+    ('search_book_by_parameter', {'field': 'title', 'query': 'in action'}),
+    ('fuzzy_queries', {'query': 'comprihensiv guide', 'fields': ['title', 'summary']}),
+    ('wild_card_query', {'field': 'title', 'query': 'data*'}),
+    ('regex_query', {'field': 'title', 'query': 'min.*'}),
+    ('match_phrase_query', {'query': 'data mining', 'slop': 1, 'fields': ['title', 'summary']}),
+    ('match_phrase_prefix', {'query': 'data min', 'slop': 1, 'fields': ['title', 'summary']}),
+    ('term_query', {'field': 'publisher', 'term': 'manning'}),
+    ('bool_query', {'should': [['title', 'Elasticsearch'], ['title', 'Solr']], 'must_not': [['authors', 'radu']]}),
+    ('range_query', {'field': 'num_reviews', 'range': {'gte': 20, 'lte': 50}}),
+    ('metric_aggregations', {'field': 'num_reviews', 'metric': 'avg'}),
+    ('filter_aggregations', {'term': 'publisher', 'query': 'manning', 'metric': 'avg', 'field': 'num_reviews'}),
+    ('reviews_range_aggregation', {'ranges': [{'to': 20}, {'from': 20, 'to': 50}, {'from': 50}]}),
+    ('aggregate', {'metrics': [{'field': 'num_reviews', 'metric': 'stats'}],
+                   'buckets': [{'type': 'terms', 'field': 'publisher'}, {'type': 'date_histogram',
+                                                                         'field': 'publish_date'}]}),
+    ('composite_aggregation', {'sources': [{'type': 'terms', 'field': 'authors'}], 'size': 20}),
+    ('catalog_aggregates', {}),
+    ('get_cluster_health', {}),
+    ('get_cluster_stats', {}),
+    ('get_task', {'task_id': None}),
+    ('append_book', {'title': 'Load Test Book', 'authors': ['load tester'], 'summary': 'written by the load test',
+                     'publisher': 'loadtest', 'num_reviews': 1, 'publish_date': '2020-01-01'}),
+    ('remove_book_by_id', {'book_id': None}),
+    ('update_by_query', {'fields': ['publisher'], 'query': 'loadtest',
+                         'updates': [{'op': 'inc', 'field': 'num_reviews', 'value': 1}]}),
+    ('delete_by_query', {'fields': ['publisher'], 'query': 'loadtest'}),
+]
+
+# ids of the books indexed for remove_book_by_id, past the seed ids
+REMOVABLE_FIRST_ID = 1000000
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_standin(port, latency_ms, jitter_ms, error_rate=0.0):
+    """
+    This function is used to start es_standin.py in its own process, so the stand-in does not
+    compete with the measured webserver for the interpreter lock
+
+    :param port: port to listen on
+    :param latency_ms: injected latency per request
+    :param jitter_ms: random extra latency per request
+    :param error_rate: fraction of the requests rejected with a 503
+    :return: stand-in process
+    """
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCHMARKS_DIR, 'es_standin.py'), '--port', str(port),
+         '--latency-ms', str(latency_ms), '--jitter-ms', str(jitter_ms), '--error-rate', str(error_rate)],
+        stdout=subprocess.DEVNULL
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("ElasticSearch stand-in did not start on port {}".format(port))
+
+
+def is_failure(response, action):
+    """
+    This function is used to tell whether a response failed: an error status, an error body, or a null
+    body for an action that returns results (a failed command used to be answered 200 null)
+
+    :param response: test client response
+    :param action: requested action
+    :return: boolean
+    """
+    from query_builder import NO_RESULT_ACTIONS
+
+    if response.status_code != 200:
+        return True
+    if response.mimetype != 'application/json':
+        return False
+    body = json.loads(response.get_data() or b'null')
+    if body is None:
+        return action not in NO_RESULT_ACTIONS
+    return isinstance(body, dict) and 'error' in body
+
+
+def percentile(samples, fraction):
+    """
+    This function is used to compute a nearest-rank percentile
+
+    :param samples: sorted samples
+    :param fraction: percentile as a fraction, e.g. 0.95
+    :return: percentile value
+
+    Example:
+        >>> percentile([1, 2, 3, 4], 0.5)
+        2
+    """
+    if not samples:
+        return 0.0
+    return samples[max(0, min(len(samples) - 1, int(round(fraction * len(samples) + 0.5)) - 1))]
+
+
+def run_level(app, payload, concurrency, requests):
+    """
+    This function is used to send requests to the /ask/storage/ endpoint with concurrency threads,
+    each with its own test client, and measure every request
+
+    :param app: flask app
+    :param payload: request body, or a function returning the body of every request
+    :param concurrency: threads in flight
+    :param requests: total number of requests
+    :return: {'p50', 'p95', 'p99' (ms), 'rps', 'errors', 'requests'}
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        client = app.test_client()
+        timings = []
+        failures = 0
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    break
+                remaining[0] -= 1
+            body = payload() if callable(payload) else payload
+            start = time.perf_counter()
+            response = client.post('/ask/storage/', json=body)
+            response.get_data()
+            timings.append((time.perf_counter() - start) * 1000.0)
+            if is_failure(response, body['action']):
+                failures += 1
+        with lock:
+            latencies.extend(timings)
+            errors[0] += failures
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'p50': round(percentile(latencies, 0.50), 3),
+        'p95': round(percentile(latencies, 0.95), 3),
+        'p99': round(percentile(latencies, 0.99), 3),
+        'rps': round(len(latencies) / elapsed, 1),
+        'errors': errors[0],
+        'requests': len(latencies)
+    }
+
+
+def seed(builder):
+    """
+    This function is used to load the initializer data into the stand-in and to fill in
+    the payloads that need existing document or task ids
+
+    :param builder: QueryBuilder
+    :return: payloads by action name
+    """
+    from initializer import DATA
+
+    builder.client.create_book_index()
+    builder.bulk_insert(data=DATA)
+    builder.client.es.indices.refresh(index=builder.client.book_index)
+
+    ids = [book['_id'] for book in builder.command('fetch_all', {'projection': {'ids_only': True}})]
+    task = builder.command('delete_by_query', {'fields': ['publisher'], 'query': 'load-test-no-match',
+                                               'wait_for_completion': False})
+
+    payloads = {}
+    for name, payload in ACTIONS:
+        payload = dict(payload, action=payload.get('action', name))
+        if 'book_id' in payload and payload['book_id'] is None:
+            payload['book_id'] = ids[0]
+        if 'ids' in payload:
+            payload['ids'] = ids[:10]
+        if 'task_id' in payload:
+            payload['task_id'] = task['task_id']
+        payloads[name] = payload
+    return payloads
+
+
+def removable(builder, first_id, count):
+    """
+    This function is used to index books for remove_book_by_id, outside the measured time,
+    so every measured request removes an existing book
+
+    :param builder: QueryBuilder
+    :param first_id: id of the first book, ids are numbered from it
+    :param count: number of books
+    :return: function returning the payload of the next request
+    """
+    from initializer import DATA
+
+    books = [dict(DATA[i % len(DATA)], publisher='loadtest-remove') for i in range(count)]
+    builder.client.bulk_insert(data=books, first_id=first_id)
+    ids = iter(range(first_id, first_id + count))
+    lock = threading.Lock()
+
+    def payload():
+        with lock:
+            return {'action': 'remove_book_by_id', 'book_id': str(next(ids))}
+    return payload
+
+
+def compare(results, baseline, tolerance):
+    """
+    This function is used to compare a run with a baseline run. A level regressed when its
+    p95 latency grew, or its throughput dropped, by more than tolerance, or when it had errors.
+
+    :param results: current results {action: {concurrency: stats}}
+    :param baseline: baseline results, same shape
+    :param tolerance: allowed relative change, e.g. 0.25
+    :return: list of regression messages
+    """
+    regressions = []
+    for action, levels in results.items():
+        for concurrency, stats in levels.items():
+            if stats['errors']:
+                regressions.append("{} x{}: {} errors".format(action, concurrency, stats['errors']))
+            reference = baseline.get(action, {}).get(str(concurrency))
+            if reference is None:
+                continue
+            if stats['p95'] > reference['p95'] * (1 + tolerance):
+                regressions.append("{} x{}: p95 {:.2f} ms > baseline {:.2f} ms".format(
+                    action, concurrency, stats['p95'], reference['p95']))
+            if stats['rps'] < reference['rps'] / (1 + tolerance):
+                regressions.append("{} x{}: {:.0f} req/s < baseline {:.0f} req/s".format(
+                    action, concurrency, stats['rps'], reference['rps']))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test every action against a local ElasticSearch stand-in")
+    parser.add_argument('--concurrency', default='1,4,16,64', help="comma separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=200, help="requests per action and concurrency level")
+    parser.add_argument('--actions', default=None, help="comma separated subset of actions")
+    parser.add_argument('--latency-ms', type=float, default=2.0, help="latency injected by the stand-in")
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help="random extra latency of the stand-in")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of 503s injected by the stand-in")
+    parser.add_argument('--cache', action='store_true',
+                        help="keep the query cache, request coalescing and the document cache enabled")
+    parser.add_argument('--json', default=None, help="write the results to this file")
+    parser.add_argument('--baseline', default=None, help="fail when results regress against this file")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative regression")
+    args = parser.parse_args()
+
+    port = free_port()
+    standin = start_standin(port, args.latency_ms, args.jitter_ms, args.error_rate)
+
+    # settings are read at import time, so point the app at the stand-in before importing it
+    os.environ['STORAGE_BACKEND'] = 'elasticsearch'
+    os.environ['ELASTIC_HOSTNAME'] = '127.0.0.1'
+    os.environ['ELASTIC_PORT'] = str(port)
+    os.environ['MATERIALIZED_AGGREGATES'] = 'true'
+    if not args.cache:
+        os.environ['QUERY_CACHE_BACKEND'] = 'none'
+        os.environ['SINGLE_FLIGHT'] = 'false'
+        os.environ['DOC_CACHE_MAX_BYTES'] = '0'
+
+    try:
+        from app import app, builder
+
+        payloads = seed(builder)
+        levels = [int(level) for level in args.concurrency.split(',')]
+        selected = args.actions.split(',') if args.actions else [name for name, _ in ACTIONS]
+
+        results = {}
+        removable_id = REMOVABLE_FIRST_ID
+        print("{:<28}{:>6}{:>10}{:>10}{:>10}{:>10}{:>8}".format(
+            'action', 'conc', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'errors'), flush=True)
+        for name in selected:
+            results[name] = {}
+            for concurrency in levels:
+                requests = max(args.requests, concurrency)
+                payload = payloads[name]
+                if name == 'remove_book_by_id':
+                    payload = removable(builder, removable_id, requests)
+                    removable_id += requests
+                stats = run_level(app, payload, concurrency, requests)
+                results[name][str(concurrency)] = stats
+                print("{:<28}{:>6}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.0f}{:>8}".format(
+                    name, concurrency, stats['p50'], stats['p95'], stats['p99'], stats['rps'], stats['errors']),
+                    flush=True)
+    finally:
+        standin.terminate()
+        standin.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'latency_ms': args.latency_ms, 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,80 @@
+#  This file is used to measure the CPU spent turning an elasticsearch search response into an API response
+#  Usage: python benchmarks/serialization.py [--hits 10000] [--repeat 10]
+#  Compares the former path (stdlib decode of the full response, get_source, jsonify-style stdlib encode
+#  with sorted keys) with the fast path (orjson decode of the HITS_FILTER_PATH response, encode_results)
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from initializer import DATA  # noqa: E402
+from query_builder import QueryBuilder  # noqa: E402
+from serialization import FastJSONSerializer, use_orjson  # noqa: E402
+
+
+def search_response(hits, filtered):
+    """
+    This function is used to build the raw body of a search response with the initializer books
+
+    :param hits: number of hits
+    :param filtered: drop what HITS_FILTER_PATH filters out
+    :return: response body text
+    """
+    documents = []
+    for i in range(hits):
+        hit = {'_id': str(i), '_score': 1.0, '_source': DATA[i % len(DATA)]}
+        if not filtered:
+            hit = dict({'_index': 'book_index_v2_20200120153000', '_type': 'book_doc'}, **hit)
+        documents.append(hit)
+    response = {'took': 12, 'hits': {'hits': documents}}
+    if not filtered:
+        response.update(timed_out=False, _shards={'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0})
+        response['hits'].update(total=hits, max_score=1.0)
+    return json.dumps(response)
+
+
+def former_path(raw):
+    results = json.loads(raw)['hits']['hits']
+    return json.dumps(QueryBuilder.get_source(results), sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def fast_path(raw, serializer=FastJSONSerializer()):
+    results = serializer.loads(raw)['hits']['hits']
+    return QueryBuilder.encode_results(results)
+
+
+def cpu_ms(func, raw, repeat):
+    """
+    This function is used to measure the median CPU time of a function
+
+    :param func: path to measure
+    :param raw: response body
+    :param repeat: runs
+    :return: CPU milliseconds per call
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.process_time()
+        func(raw)
+        timings.append((time.process_time() - start) * 1000.0)
+    return sorted(timings)[len(timings) // 2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU cost of serializing a search response")
+    parser.add_argument('--hits', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    full, filtered = search_response(args.hits, False), search_response(args.hits, True)
+    assert json.loads(former_path(full)) == json.loads(fast_path(filtered))
+
+    former = cpu_ms(former_path, full, args.repeat)
+    fast = cpu_ms(fast_path, filtered, args.repeat)
+    print("{} hits, orjson {}".format(args.hits, 'enabled' if use_orjson() else 'not installed'))
+    print("former path: {:8.2f} ms CPU ({} response bytes)".format(former, len(full)))
+    print("fast path:   {:8.2f} ms CPU ({} response bytes)".format(fast, len(filtered)))
+    print("saved:       {:8.2f} ms CPU per response ({:.0%})".format(former - fast, 1 - fast / former))
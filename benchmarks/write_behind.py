@@ -0,0 +1,66 @@
+#  This file is used to compare the append_book throughput of per document index requests and the write-behind buffer
+#  Usage: python benchmarks/write_behind.py [--books 2000] [--writers 16]
+#  Requires a running ElasticSearch (see initializer.py), the appended books are deleted afterwards
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bulk_ingest import WriteBehindBuffer  # noqa: E402
+from initializer import DATA  # noqa: E402
+from storage_client import ElasticBookStorage  # noqa: E402
+
+# marks the appended books so they can be deleted
+PUBLISHER = 'write-behind-benchmark'
+
+
+def append_books(storage, books, writers, wait):
+    """
+    This function is used to append books from concurrent writers
+
+    :param storage: ElasticBookStorage
+    :param books: number of books
+    :param writers: concurrent writers
+    :param wait: wait for the ack of every book
+    :return: books per second, until every book is acknowledged
+    """
+    def append(i):
+        book = dict(DATA[i % len(DATA)], publisher=PUBLISHER)
+        return storage.create_book_doc(book['title'], book['authors'], book['summary'], book['publisher'],
+                                       book['num_reviews'], book['publish_date'], wait=wait)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        results = list(executor.map(append, range(books)))
+    if storage.write_behind is not None:
+        storage.write_behind.flush()
+    elapsed = time.time() - start
+    assert all(result is not None for result in results), "some books were not indexed"
+    return books / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="append_book throughput with and without write-behind")
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--writers', type=int, default=16)
+    args = parser.parse_args()
+
+    storage = ElasticBookStorage()
+    storage.documents = None
+    try:
+        storage.write_behind = None
+        direct = append_books(storage, args.books, args.writers, True)
+        print("index per book:           {:8.0f} books/sec".format(direct))
+
+        storage.write_behind = WriteBehindBuffer(storage.es, storage.book_index, storage.book_doc)
+        acked = append_books(storage, args.books, args.writers, True)
+        print("write-behind, wait ack:   {:8.0f} books/sec ({:.1f}x)".format(acked, acked / direct))
+        queued = append_books(storage, args.books, args.writers, False)
+        print("write-behind, no wait:    {:8.0f} books/sec ({:.1f}x)".format(queued, queued / direct))
+        print("bulk requests: {batches} for {documents} books".format(**storage.write_behind.stats()))
+    finally:
+        storage.es.delete_by_query(index=storage.book_index, body={'query': {'term': {'publisher.keyword': PUBLISHER}}},
+                                   params={'refresh': 'true', 'conflicts': 'proceed'})
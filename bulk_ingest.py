@@ -0,0 +1,490 @@
+import asyncio
+import atexit
+import base64
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, Future, wait
+
+from elasticsearch import helpers
+
+from metrics import record_error
+from resilience import CallerRetries
+from settings import BULK_CHUNK_SIZE, BULK_MAX_CHUNK_BYTES, BULK_THREAD_COUNT, BULK_MAX_RETRIES, \
+    BULK_INITIAL_BACKOFF, BULK_MAX_BACKOFF, BULK_LOAD_REFRESH_INTERVAL, BULK_LOAD_REPLICAS, \
+    BULK_LOAD_MAX_NUM_SEGMENTS, WRITE_BEHIND, WRITE_BEHIND_MAX_DOCS, WRITE_BEHIND_MAX_DELAY
+
+logger = logging.getLogger('book_storage.bulk_ingest')
+
+# refresh options of buffered writes, a batch is sent with the strongest one of its writes
+REFRESH_OPTIONS = (None, 'wait_for', 'true')
+
+
+def new_doc_id():
+    """
+    This function is used to generate a document id client side, when it has to be known before the write
+
+    :return: 22 character url safe id
+    """
+    return base64.urlsafe_b64encode(uuid.uuid4().bytes).decode('ascii').rstrip('=')
+
+
+def read_books(source):
+    """
+    This function is used to lazily read book documents from any supported source.
+    Supported sources are iterables of dicts, iterables of NDJSON lines (e.g. an open file)
+    and paths to NDJSON files.
+
+    :param source: iterable of dicts/lines or NDJSON file path
+    :return: generator of book dicts
+
+    Example:
+        >>> books = read_books("books.ndjson")
+    """
+    if isinstance(source, str):
+        with open(source) as f:
+            for book in read_books(f):
+                yield book
+        return
+
+    for item in source:
+        if isinstance(item, (str, bytes)):
+            item = item.strip()
+            if not item:
+                continue
+            item = json.loads(item)
+        yield item
+
+
+class BulkIngestEngine(object):
+    """
+    Streaming bulk ingest engine. Documents are pulled lazily from the source,
+    grouped into batches bounded by document count and byte size and sent through
+    several concurrent streaming_bulk requests, which retry items rejected with 429.
+    on_indexed, when given, is called from the sending threads with the sources of every sent batch
+    and its number of failed items.
+    Ids are generated by elasticsearch, read from the id_field of every book, or with first_id given
+    numbered from it in source order, so reloading the same data replaces it instead of duplicating it.
+    With id_copy the id is also copied into that field of every book, generated by new_doc_id when neither
+    id_field nor first_id is given.
+    """
+
+    def __init__(self, client, index, doc_type, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+                 thread_count=BULK_THREAD_COUNT, max_retries=BULK_MAX_RETRIES, initial_backoff=BULK_INITIAL_BACKOFF,
+                 max_backoff=BULK_MAX_BACKOFF, id_field=None, first_id=None, id_copy=None, on_indexed=None):
+        self.client = client
+        self.index = index
+        self.doc_type = doc_type
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.thread_count = thread_count
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.id_field = id_field
+        self.first_id = first_id
+        self.id_copy = id_copy
+        self.on_indexed = on_indexed
+
+    def _actions(self, books):
+        """
+        This function is used to turn book documents into bulk index actions.
+        Ids are generated by elasticsearch unless id_field, first_id or id_copy is set.
+
+        :param books: iterable of book dicts
+        :return: generator of bulk actions
+        """
+        for position, book in enumerate(books):
+            action = {
+                "_index": self.index,
+                "_type": self.doc_type,
+                "_source": book
+            }
+            if self.id_field is not None:
+                action["_id"] = book[self.id_field]
+            elif self.first_id is not None:
+                action["_id"] = self.first_id + position
+            elif self.id_copy is not None:
+                action["_id"] = new_doc_id()
+            if self.id_copy is not None:
+                action["_source"] = dict(book, **{self.id_copy: str(action["_id"])})
+            yield action
+
+    def _batches(self, actions):
+        """
+        This function is used to group actions into batches bounded by
+        chunk_size documents and max_chunk_bytes bytes
+
+        :param actions: iterable of bulk actions
+        :return: generator of action lists
+        """
+        serializer = self.client.transport.serializer
+        batch, batch_bytes = [], 0
+
+        for action in actions:
+            action_bytes = len(serializer.dumps(action["_source"]).encode("utf-8")) + 1
+            if batch and (len(batch) >= self.chunk_size or batch_bytes + action_bytes > self.max_chunk_bytes):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(action)
+            batch_bytes += action_bytes
+
+        if batch:
+            yield batch
+
+    def _send(self, batch):
+        """
+        This function is used to send one batch, retrying items rejected with 429
+
+        :param batch: list of bulk actions
+        :return: tuple of (indexed count, list of failed items)
+        """
+        indexed, failed = 0, []
+        # rejected chunks are retried by streaming_bulk, not by the transport too
+        with CallerRetries(self.max_retries > 0):
+            for ok, item in helpers.streaming_bulk(
+                    self.client,
+                    batch,
+                    chunk_size=self.chunk_size,
+                    max_chunk_bytes=self.max_chunk_bytes,
+                    max_retries=self.max_retries,
+                    initial_backoff=self.initial_backoff,
+                    max_backoff=self.max_backoff,
+                    raise_on_error=False,
+                    raise_on_exception=False
+            ):
+                if ok:
+                    indexed += 1
+                else:
+                    failed.append(item)
+        if self.on_indexed is not None:
+            self.on_indexed([action["_source"] for action in batch], len(failed))
+        return indexed, failed
+
+    async def _async_send(self, batch):
+        """
+        Asyncio flavour of _send, used with an AsyncElasticsearch client
+
+        :param batch: list of bulk actions
+        :return: tuple of (indexed count, list of failed items)
+        """
+        indexed, failed = 0, []
+        # rejected chunks are retried by streaming_bulk, not by the transport too
+        with CallerRetries(self.max_retries > 0):
+            async for ok, item in helpers.async_streaming_bulk(
+                    self.client,
+                    batch,
+                    chunk_size=self.chunk_size,
+                    max_chunk_bytes=self.max_chunk_bytes,
+                    max_retries=self.max_retries,
+                    initial_backoff=self.initial_backoff,
+                    max_backoff=self.max_backoff,
+                    raise_on_error=False,
+                    raise_on_exception=False
+            ):
+                if ok:
+                    indexed += 1
+                else:
+                    failed.append(item)
+        if self.on_indexed is not None:
+            self.on_indexed([action["_source"] for action in batch], len(failed))
+        return indexed, failed
+
+    def ingest(self, source):
+        """
+        This function is used to ingest every book of the source. At most thread_count
+        batches are in flight at any time, so memory stays bounded for any input size.
+
+        :param source: iterable of dicts/lines or NDJSON file path
+        :return: ingest report
+
+        Example:
+            >>> engine = BulkIngestEngine(es, "book_index", "book_doc", id_field="isbn")
+            >>> report = engine.ingest("books.ndjson")
+        """
+        report = {"indexed": 0, "failed": 0, "errors": []}
+        start = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.thread_count) as executor:
+            pending = set()
+
+            def collect(done):
+                for future in done:
+                    indexed, failed = future.result()
+                    report["indexed"] += indexed
+                    report["failed"] += len(failed)
+                    report["errors"].extend(failed[:10 - len(report["errors"])])
+
+            for batch in self._batches(self._actions(read_books(source))):
+                if len(pending) >= self.thread_count:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(self._send, batch))
+
+            collect(wait(pending).done)
+
+        report["elapsed"] = time.time() - start
+        report["docs_per_sec"] = report["indexed"] / report["elapsed"] if report["elapsed"] else 0.0
+        logger.info("indexed %d docs (%d failed) in %.2fs, %.0f docs/sec",
+                    report["indexed"], report["failed"], report["elapsed"], report["docs_per_sec"])
+        return report
+
+    async def async_ingest(self, source):
+        """
+        Asyncio flavour of ingest, used with an AsyncElasticsearch client.
+        At most thread_count batches are in flight at any time.
+
+        :param source: iterable of dicts/lines or NDJSON file path
+        :return: ingest report
+
+        Example:
+            >>> engine = BulkIngestEngine(async_es, "book_index", "book_doc")
+            >>> report = await engine.async_ingest("books.ndjson")
+        """
+        report = {"indexed": 0, "failed": 0, "errors": []}
+        start = time.time()
+        pending = set()
+
+        def collect(done):
+            for task in done:
+                indexed, failed = task.result()
+                report["indexed"] += indexed
+                report["failed"] += len(failed)
+                report["errors"].extend(failed[:10 - len(report["errors"])])
+
+        for batch in self._batches(self._actions(read_books(source))):
+            if len(pending) >= self.thread_count:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                collect(done)
+            pending.add(asyncio.ensure_future(self._async_send(batch)))
+
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            collect(done)
+
+        report["elapsed"] = time.time() - start
+        report["docs_per_sec"] = report["indexed"] / report["elapsed"] if report["elapsed"] else 0.0
+        logger.info("indexed %d docs (%d failed) in %.2fs, %.0f docs/sec",
+                    report["indexed"], report["failed"], report["elapsed"], report["docs_per_sec"])
+        return report
+
+
+class BulkLoadMode(object):
+    """
+    Context manager tuning an index for a bulk load: refreshes are disabled and replicas dropped
+    while the load runs, so segments are neither refreshed nor replicated until the data is in.
+    On exit the original settings are restored, the index is force merged and refreshed once,
+    and the throughput of the load and of the load including that final work is reported.
+    Documents are counted from the index doc count, so every write made in the block is measured.
+
+    :Example:
+        >>> with BulkLoadMode(es, "book_index") as mode:
+        ...     BulkIngestEngine(es, "book_index", "book_doc").ingest("books.ndjson")
+        >>> mode.report["docs_per_sec"], mode.report["searchable_docs_per_sec"]
+    """
+
+    def __init__(self, client, index, refresh_interval=BULK_LOAD_REFRESH_INTERVAL, number_of_replicas=BULK_LOAD_REPLICAS,
+                 max_num_segments=BULK_LOAD_MAX_NUM_SEGMENTS):
+        self.client = client
+        self.index = index
+        self.refresh_interval = refresh_interval
+        self.number_of_replicas = number_of_replicas
+        self.max_num_segments = max_num_segments
+        self.original = {}
+        self.report = {}
+
+    def _doc_count(self):
+        self.client.indices.refresh(index=self.index)
+        return self.client.count(index=self.index)["count"]
+
+    def __enter__(self):
+        settings = self.client.indices.get_settings(index=self.index)
+        for name, index_settings in settings.items():
+            index_settings = index_settings["settings"]["index"]
+            # None puts a setting back to its default when it was not set explicitly
+            self.original[name] = {
+                "refresh_interval": index_settings.get("refresh_interval"),
+                "number_of_replicas": index_settings.get("number_of_replicas")
+            }
+        self.client.indices.put_settings(index=self.index, body={"index": {
+            "refresh_interval": self.refresh_interval,
+            "number_of_replicas": self.number_of_replicas
+        }})
+        self.docs_before = self._doc_count()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        loaded = time.time()
+        for name, original in self.original.items():
+            self.client.indices.put_settings(index=name, body={"index": original})
+        if exc_type is None:
+            self.client.indices.forcemerge(index=self.index, max_num_segments=self.max_num_segments)
+        self.report["indexed"] = self._doc_count() - self.docs_before
+        done = time.time()
+
+        self.report["load_elapsed"] = loaded - self.start
+        self.report["elapsed"] = done - self.start
+        self.report["docs_per_sec"] = self.report["indexed"] / self.report["load_elapsed"] \
+            if self.report["load_elapsed"] else 0.0
+        self.report["searchable_docs_per_sec"] = self.report["indexed"] / self.report["elapsed"] \
+            if self.report["elapsed"] else 0.0
+        logger.info("bulk load of %d docs: %.0f docs/sec while loading, %.0f docs/sec once merged and refreshed "
+                    "(%.2fs + %.2fs)", self.report["indexed"], self.report["docs_per_sec"],
+                    self.report["searchable_docs_per_sec"], self.report["load_elapsed"], done - loaded)
+        return False
+
+
+class WriteBehindBuffer(object):
+    """
+    Write-behind buffer for single document writes. Documents are queued and a background thread
+    sends them as one _bulk request once max_docs are queued or the oldest one waited max_delay seconds,
+    so concurrent writers share a round trip and a translog fsync. Every write gets a Future of its
+    bulk item (the index response, ready once the bulk request is acknowledged, that is durable) or
+    of the exception that failed it. Queued writes are flushed on close and at interpreter exit.
+    With id_field the id of every document is read from that field, elasticsearch generates it otherwise.
+
+    :Example:
+        >>> buffer = WriteBehindBuffer(es, "book_index", "book_doc")
+        >>> future = buffer.submit({"title": "Solr in Action"}, refresh="wait_for")
+        >>> future.result()["_id"]
+        'AX3b'
+    """
+
+    def __init__(self, client, index, doc_type, max_docs=WRITE_BEHIND_MAX_DOCS, max_delay=WRITE_BEHIND_MAX_DELAY,
+                 id_field=None):
+        self.client = client
+        self.index = index
+        self.doc_type = doc_type
+        self.id_field = id_field
+        self.max_docs = max_docs
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        # list of (source, refresh, future, queued time)
+        self.pending = []
+        self.flushing = False
+        self.closed = False
+        self.thread = None
+        self.pid = None
+        self.batches = 0
+        self.documents = 0
+
+    def submit(self, source, refresh=None):
+        """
+        This function is used to queue a document
+
+        :param source: document source
+        :param refresh: None, "wait_for" (the ack waits until the document is searchable) or "true"
+        :return: Future of the bulk item response
+        """
+        if refresh not in REFRESH_OPTIONS:
+            raise ValueError("refresh must be one of {}".format(REFRESH_OPTIONS))
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("write-behind buffer is closed")
+            self._start()
+            self.pending.append((source, refresh, future, time.monotonic()))
+            # wakes the thread up to start the max_delay countdown, or to send right away
+            if len(self.pending) in (1, self.max_docs) or refresh is not None:
+                self.condition.notify()
+        return future
+
+    def flush(self):
+        """This function is used to send the queued documents now and wait for their acks"""
+        with self.condition:
+            futures = [write[2] for write in self.pending]
+            self.flushing = True
+            self.condition.notify()
+        wait(futures)
+
+    def close(self):
+        """This function is used to flush the queued documents and stop the background thread"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None and thread.is_alive() and self.pid == os.getpid():
+            thread.join()
+
+    def stats(self):
+        """This function is used to return the queue length and the number of sent batches and documents"""
+        return {'pending': len(self.pending), 'batches': self.batches, 'documents': self.documents}
+
+    def _start(self):
+        """This function is used to start the background thread once per process (gunicorn workers are forked)"""
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        if self.pid is None:
+            atexit.register(self.close)
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self.thread.start()
+
+    def _ready(self):
+        """This function is used to tell whether the queued documents must be sent, under the condition lock"""
+        return len(self.pending) >= self.max_docs or self.flushing or self.closed or \
+            any(write[1] is not None for write in self.pending) or \
+            time.monotonic() - self.pending[0][3] >= self.max_delay
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.flushing = False
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                while not self._ready():
+                    self.condition.wait(self.max_delay - (time.monotonic() - self.pending[0][3]))
+                batch, self.pending = self.pending[:self.max_docs], self.pending[self.max_docs:]
+            self._send(batch)
+
+    def _send(self, batch):
+        """
+        This function is used to send one batch of queued documents and resolve their futures
+
+        :param batch: list of queued writes
+        """
+        lines = []
+        for source, _, _, _ in batch:
+            meta = {"_index": self.index, "_type": self.doc_type}
+            if self.id_field is not None:
+                meta["_id"] = source[self.id_field]
+            lines.append({"index": meta})
+            lines.append(source)
+        refresh = max((write[1] for write in batch), key=REFRESH_OPTIONS.index)
+        try:
+            response = self.client.bulk(body=lines, params={"refresh": refresh} if refresh else {})
+        except Exception as ex:
+            record_error(ex)
+            for write in batch:
+                write[2].set_exception(ex)
+            return
+
+        self.batches += 1
+        self.documents += len(batch)
+        for write, item in zip(batch, response["items"]):
+            result = item["index"]
+            if "error" in result:
+                error = helpers.BulkIndexError("1 document(s) failed to index.", [item])
+                record_error(error)
+                write[2].set_exception(error)
+            else:
+                write[2].set_result(result)
+
+
+def make_write_behind(client, index, doc_type, id_field=None):
+    """
+    This function is used to create the write-behind buffer of a storage, see WRITE_BEHIND
+
+    :param client: elasticsearch client
+    :param index: index name
+    :param doc_type: document type
+    :param id_field: document field the id is read from, None to let elasticsearch generate it
+    :return: WriteBehindBuffer or None when writes are sent one by one
+    """
+    return WriteBehindBuffer(client, index, doc_type, id_field=id_field) if WRITE_BEHIND else None
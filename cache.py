@@ -0,0 +1,298 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from settings import QUERY_CACHE_BACKEND, QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL, QUERY_CACHE_REDIS_URL, \
+    DOC_CACHE_MAX_BYTES, DOC_CACHE_TTL
+
+# payload keys that do not change the elasticsearch results
+IGNORED_PAYLOAD_KEYS = ('action', 'file_type')
+
+
+def cache_key(action, payload):
+    """
+    This function is used to build a normalized cache key for an action and its payload.
+    Payload keys are sorted so equivalent payloads map to the same key.
+
+    :param action: action parameter
+    :param payload: provided payload
+    :return: cache key
+
+    Example:
+        >>> cache_key('fetch_all', {'action': 'fetch_all'})
+        'fetch_all:{}'
+    """
+    normalized = {k: v for k, v in payload.items() if k not in IGNORED_PAYLOAD_KEYS}
+    return "{}:{}".format(action, json.dumps(normalized, sort_keys=True, separators=(',', ':')))
+
+
+class QueryCache(object):
+    """
+    In-process LRU cache with a TTL for query results. Values are stored serialized,
+    so callers can freely mutate what they get back. Every clear bumps the generation,
+    so results computed before a write are never stored after it.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES, ttl=QUERY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self):
+        """This function is used to return the current cache generation"""
+        return self._generation
+
+    def get(self, key):
+        """
+        This function is used to return a cached value, or None on a miss
+
+        :param key: cache key
+        :return: cached value
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return json.loads(entry[1])
+
+    def set(self, key, value, generation):
+        """
+        This function is used to cache a value, evicting the least recently used entries
+
+        :param key: cache key
+        :param value: json serializable value
+        :param generation: cache generation read before the value was computed
+        """
+        data = json.dumps(value)
+        with self.lock:
+            if generation != self._generation:
+                return
+            self.entries[key] = (time.time() + self.ttl, data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """This function is used to invalidate every cached value"""
+        with self.lock:
+            self._generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        """This function is used to return the cache hit/miss counters"""
+        return {
+            'backend': 'memory',
+            'pid': os.getpid(),
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+class RedisQueryCache(object):
+    """
+    Query cache shared by all gunicorn workers through redis (requires the redis package).
+    Keys embed a generation number, so a single INCR invalidates every worker's entries;
+    stale generations expire through the TTL and redis' own LRU eviction.
+    """
+
+    def __init__(self, url=QUERY_CACHE_REDIS_URL, ttl=QUERY_CACHE_TTL):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.generation_key = 'query_cache:generation'
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self):
+        return int(self.redis.get(self.generation_key) or 0)
+
+    def get(self, key):
+        data = self.redis.get('query_cache:{}:{}'.format(self.generation(), key))
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(data)
+
+    def set(self, key, value, generation):
+        self.redis.setex('query_cache:{}:{}'.format(generation, key), self.ttl, json.dumps(value))
+
+    def clear(self):
+        self.redis.incr(self.generation_key)
+
+    def stats(self):
+        return {
+            'backend': 'redis',
+            'pid': os.getpid(),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def approximate_size(value):
+    """
+    This function is used to estimate the memory held by a decoded JSON value, without serializing it
+
+    :param value: decoded JSON value
+    :return: approximate size in bytes
+    """
+    if isinstance(value, str):
+        return 49 + len(value)
+    if isinstance(value, dict):
+        return 64 + sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    if isinstance(value, list):
+        return 56 + sum(8 + approximate_size(item) for item in value)
+    return 28
+
+
+class DocumentCache(object):
+    """
+    In-process LRU of book sources by id, bounded by their approximate size in bytes.
+    Cached sources are served without asking elasticsearch for ttl seconds: the writes of this worker update
+    or drop them, a write served by another worker is hidden until the entry expires.
+    Every entry keeps the _version it was read at, a source is only replaced by a newer one and a deleted
+    book leaves a tombstone, so a read that started before a write cannot cache the older source again.
+
+    Only full sources (created books, _mget docs and search hits without _source filtering) may be cached.
+    Cached sources are shared with the callers, they must be treated as read only.
+
+    :Example:
+        >>> documents = DocumentCache()
+        >>> documents.put('AX3b', {'title': 'Solr in Action'}, 1)
+        >>> documents.get_many(['AX3b', 'BY4c'])
+        {'AX3b': {'title': 'Solr in Action'}}
+    """
+
+    # size of a tombstone entry
+    TOMBSTONE_SIZE = 128
+
+    def __init__(self, max_bytes=DOC_CACHE_MAX_BYTES, ttl=DOC_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # book id -> (expires, version, source or None for a tombstone, size)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, book_ids):
+        """
+        This function is used to return the live cached sources of several books
+
+        :param book_ids: list of book ids
+        :return: {book id (str): source} of the cached books
+        """
+        found = {}
+        now = time.time()
+        with self.lock:
+            for book_id in book_ids:
+                book_id = str(book_id)
+                entry = self.entries.get(book_id)
+                if entry is None or entry[2] is None or entry[0] < now:
+                    self.misses += 1
+                    continue
+                self.entries.move_to_end(book_id)
+                self.hits += 1
+                found[book_id] = entry[2]
+        return found
+
+    def put(self, book_id, source, version):
+        """
+        This function is used to cache the source of a book, unless a newer version is cached already
+
+        :param book_id: book id
+        :param source: full book source, None to leave a tombstone
+        :param version: _version of the source
+        """
+        book_id = str(book_id)
+        with self.lock:
+            entry = self.entries.get(book_id)
+            if entry is not None and entry[0] >= time.time() and entry[1] >= version:
+                self.entries.move_to_end(book_id)
+                return
+            size = approximate_size(source) if source is not None else self.TOMBSTONE_SIZE
+            if entry is not None:
+                self.bytes -= entry[3]
+            self.entries[book_id] = (time.time() + self.ttl, version, source, size)
+            self.entries.move_to_end(book_id)
+            self.bytes += size
+            while self.bytes > self.max_bytes and self.entries:
+                self.bytes -= self.entries.popitem(last=False)[1][3]
+
+    def put_docs(self, docs):
+        """
+        This function is used to cache the full sources of mget docs or search hits.
+        Docs fetched with _source filtering must not be given.
+
+        :param docs: list of mget docs or search hits (with _version)
+        """
+        for doc in docs:
+            if doc.get('found', True) and '_source' in doc and '_version' in doc:
+                self.put(doc['_id'], doc['_source'], doc['_version'])
+
+    def remove(self, book_id, version=None):
+        """
+        This function is used to drop a deleted or changed book
+
+        :param book_id: book id
+        :param version: _version of the delete, leaves a tombstone so older reads are not cached again
+        """
+        if version is not None:
+            self.put(book_id, None, version)
+            return
+        with self.lock:
+            entry = self.entries.pop(str(book_id), None)
+            if entry is not None:
+                self.bytes -= entry[3]
+
+    def clear(self):
+        """This function is used to drop every cached source"""
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """This function is used to return the cache size and hit/miss counters"""
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def make_document_cache():
+    """
+    This function is used to create the document cache, see DOC_CACHE_MAX_BYTES
+
+    :return: DocumentCache or None when it is disabled
+    """
+    return DocumentCache() if DOC_CACHE_MAX_BYTES > 0 else None
+
+
+def make_query_cache():
+    """
+    This function is used to create the query cache configured by QUERY_CACHE_BACKEND
+
+    :return: QueryCache, RedisQueryCache or None when caching is disabled
+    """
+    if QUERY_CACHE_BACKEND == 'memory':
+        return QueryCache()
+    if QUERY_CACHE_BACKEND == 'redis':
+        return RedisQueryCache()
+    return None
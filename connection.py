@@ -0,0 +1,107 @@
+import os
+import threading
+
+from elasticsearch import Elasticsearch, AsyncElasticsearch
+from elasticsearch_dsl import connections
+
+from resilience import ResilientTransport, ResilientAsyncTransport, breaker
+from serialization import FastJSONSerializer
+from settings import ELASTIC_HOSTNAME, ELASTIC_PORT, ES_POOL_MAXSIZE, ES_TIMEOUT, ES_KEEP_ALIVE, ES_ASYNC_POOL_MAXSIZE
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_async_client = None
+_async_client_pid = None
+
+
+def get_client():
+    """
+    This function is used to return the process wide Elasticsearch client.
+    The client (and its connection pool) is created once per process, so gunicorn
+    workers forked from a master never share sockets. It is also registered as the
+    default elasticsearch_dsl connection so Search/UpdateByQuery objects reuse it.
+    Its requests go through the resilience layer, see ResilientTransport.
+
+    :return: Elasticsearch client
+
+    Example:
+        >>> es = get_client()
+        >>> es is get_client()
+        True
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _client = Elasticsearch(
+                    [{'host': ELASTIC_HOSTNAME, 'port': ELASTIC_PORT}],
+                    maxsize=ES_POOL_MAXSIZE,
+                    timeout=ES_TIMEOUT,
+                    # retries, with backoff, are done by ResilientTransport
+                    max_retries=0,
+                    headers={'connection': 'keep-alive' if ES_KEEP_ALIVE else 'close'},
+                    transport_class=ResilientTransport,
+                    serializer=FastJSONSerializer()
+                )
+                connections.add_connection('default', _client)
+                _client_pid = pid
+    return _client
+
+
+def get_async_client():
+    """
+    This function is used to return the process wide AsyncElasticsearch client,
+    configured with the same pool settings as the synchronous one. It must be used
+    from a single event loop.
+
+    :return: AsyncElasticsearch client
+
+    Example:
+        >>> es = get_async_client()
+        >>> health = await es.cluster.health()
+    """
+    global _async_client, _async_client_pid
+
+    pid = os.getpid()
+    if _async_client is None or _async_client_pid != pid:
+        _async_client = AsyncElasticsearch(
+            [{'host': ELASTIC_HOSTNAME, 'port': ELASTIC_PORT}],
+            maxsize=ES_ASYNC_POOL_MAXSIZE,
+            timeout=ES_TIMEOUT,
+            max_retries=0,
+            headers={'connection': 'keep-alive' if ES_KEEP_ALIVE else 'close'},
+            transport_class=ResilientAsyncTransport,
+            serializer=FastJSONSerializer()
+        )
+        _async_client_pid = pid
+    return _async_client
+
+
+def pool_stats():
+    """
+    This function is used to report the utilisation of the shared connection pool,
+    one entry per elasticsearch node
+
+    :return: pool stats
+
+    Example:
+        >>> pool_stats()
+        {'pid': 12, 'pools': [{'host': 'http://localhost:9200', 'maxsize': 10, 'in_use': 1, ...}],
+         'circuit_breaker': {'state': 'closed', ...}}
+    """
+    pools = []
+    for connection in get_client().transport.connection_pool.connections:
+        pool = connection.pool
+        slots = list(pool.pool.queue) if pool.pool is not None else []
+        pools.append({
+            'host': connection.host,
+            'maxsize': pool.pool.maxsize if pool.pool is not None else 0,
+            'in_use': pool.pool.maxsize - len(slots) if pool.pool is not None else 0,
+            'idle': len([conn for conn in slots if conn is not None]),
+            'opened': pool.num_connections,
+            'requests': pool.num_requests
+        })
+    return {'pid': os.getpid(), 'pools': pools, 'circuit_breaker': breaker.stats()}
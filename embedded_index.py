@@ -0,0 +1,2132 @@
+import base64
+import bisect
+import functools
+import itertools
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+import zlib
+from array import array
+from collections import namedtuple
+from datetime import datetime, timezone
+from fnmatch import fnmatchcase
+
+from settings import EMBEDDED_FLUSH_DOCS, EMBEDDED_MAX_SEGMENTS
+
+# BM25 parameters, the elasticsearch defaults
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# position gap between the values of a multi-valued text field, see position_increment_gap
+POSITION_GAP = 100
+
+# max terms a match_phrase_prefix expands its last term to, see max_expansions
+MAX_EXPANSIONS = 50
+
+# fuzzy expansions cached per immutable segment
+MAX_CACHED_EXPANSIONS = 4096
+
+# segment file: header (magic, meta offset, meta length), data area, JSON meta
+SEGMENT_MAGIC = b'EBSEG001'
+SEGMENT_HEADER = struct.Struct('<8sQQ')
+
+TOKEN_PATTERN = re.compile(r"\w+(?:['’]\w+)*")
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}([T ][\d:.]+(Z|[+-]\d{2}:?\d{2})?)?$')
+REGEX_META = set('.?+*|{}[]()"\\#@&<>~')
+
+NUMERIC_TYPES = ('integer', 'long', 'short', 'byte', 'float', 'double', 'half_float', 'scaled_float', 'date')
+METRICS = ('avg', 'sum', 'min', 'max', 'value_count', 'cardinality', 'stats', 'extended_stats', 'percentiles')
+DEFAULT_PERCENTS = (1, 5, 25, 50, 75, 95, 99)
+
+# date_histogram calendar intervals and fixed interval units in milliseconds
+CALENDAR_INTERVALS = {'year': 'year', '1y': 'year', 'quarter': 'quarter', '1q': 'quarter', 'month': 'month',
+                      '1M': 'month', 'week': 'week', '1w': 'week', 'day': 'day', '1d': 'day', 'hour': 'hour',
+                      '1h': 'hour', 'minute': 'minute', '1m': 'minute', 'second': 'second', '1s': 'second'}
+FIXED_INTERVAL_UNITS = {'ms': 1, 's': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000}
+
+# searchable field: mapping type, source path its values are read from, index and search analyzers
+# (the normalizer of keyword fields)
+FieldSpec = namedtuple('FieldSpec', ['type', 'source', 'analyzer', 'search_analyzer'])
+
+# tokenizers of custom analyzers, None keeps the whole text as one token
+TOKENIZERS = {
+    'standard': TOKEN_PATTERN,
+    'whitespace': re.compile(r'\S+'),
+    'letter': re.compile(r'[^\W\d_]+'),
+    'keyword': None
+}
+
+# built-in analyzers, in the custom analyzer format
+BUILTIN_ANALYZERS = {
+    'standard': {'tokenizer': 'standard', 'filter': ['lowercase']},
+    'simple': {'tokenizer': 'letter', 'filter': ['lowercase']},
+    'whitespace': {'tokenizer': 'whitespace', 'filter': []},
+    'keyword': {'tokenizer': 'keyword', 'filter': []}
+}
+
+
+class ConflictError(Exception):
+    """Raised when a document is created with the id of an existing one"""
+
+
+def analyze(text):
+    """
+    This function is used to split a text into lower cased word tokens, like the standard analyzer
+
+    :param text: text
+    :return: list of tokens
+
+    Example:
+        >>> analyze("Elasticsearch: The Definitive Guide")
+        ['elasticsearch', 'the', 'definitive', 'guide']
+    """
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+def fold_ascii(text):
+    """This function is used to strip accents, like the asciifolding token filter"""
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii') or text
+
+
+class Analysis(object):
+    """
+    Analyzers and normalizers of an index, read from the analysis section of its settings.
+    Custom analyzers are made of the standard, whitespace, letter or keyword tokenizer and the
+    lowercase, uppercase, asciifolding and edge_ngram token filters.
+
+    :Example:
+        >>> analysis = Analysis({"analysis": {
+        ...     "filter": {"prefixes": {"type": "edge_ngram", "min_gram": 1, "max_gram": 3}},
+        ...     "analyzer": {"autocomplete": {"tokenizer": "standard", "filter": ["lowercase", "prefixes"]}}}})
+        >>> analysis.tokens("autocomplete", "Solr in")
+        [('s', 0), ('so', 0), ('sol', 0), ('i', 1), ('in', 1)]
+    """
+
+    def __init__(self, settings):
+        analysis = settings.get('analysis') or settings.get('index', {}).get('analysis') or {}
+        self.filters = analysis.get('filter', {})
+        self.analyzers = dict(BUILTIN_ANALYZERS, **analysis.get('analyzer', {}))
+        self.normalizers = analysis.get('normalizer', {})
+
+    def tokens(self, analyzer, text):
+        """
+        This function is used to analyze a text
+
+        :param analyzer: analyzer name
+        :param text: text
+        :return: list of (term, position)
+        """
+        if analyzer == 'standard':
+            return [(term, position) for position, term in enumerate(analyze(text))]
+        definition = self.analyzers.get(analyzer)
+        if definition is None:
+            raise ValueError("failed to find analyzer [{}]".format(analyzer))
+        tokenizer = definition.get('tokenizer', 'standard')
+        if tokenizer not in TOKENIZERS:
+            raise ValueError("tokenizer [{}] is not supported".format(tokenizer))
+        text = str(text)
+        terms = [text] if TOKENIZERS[tokenizer] is None else TOKENIZERS[tokenizer].findall(text)
+        tokens = [(term, position) for position, term in enumerate(terms)]
+        for name in definition.get('filter', []):
+            tokens = self._filter(name, tokens)
+        return tokens
+
+    def normalize(self, normalizer, value):
+        """
+        This function is used to normalize a keyword value
+
+        :param normalizer: normalizer name, keyword for none
+        :param value: keyword value
+        :return: normalized value
+        """
+        if normalizer == 'keyword':
+            return value
+        definition = self.normalizers.get(normalizer)
+        if definition is None:
+            raise ValueError("failed to find normalizer [{}]".format(normalizer))
+        tokens = [(value, 0)]
+        for name in definition.get('filter', []):
+            tokens = self._filter(name, tokens)
+        return tokens[0][0]
+
+    def _filter(self, name, tokens):
+        definition = self.filters.get(name, {'type': name})
+        kind = definition.get('type', name)
+        if kind == 'lowercase':
+            return [(term.lower(), position) for term, position in tokens]
+        if kind == 'uppercase':
+            return [(term.upper(), position) for term, position in tokens]
+        if kind == 'asciifolding':
+            return [(fold_ascii(term), position) for term, position in tokens]
+        if kind in ('edge_ngram', 'edgeNGram'):
+            low, high = int(definition.get('min_gram', 1)), int(definition.get('max_gram', 2))
+            return [(term[:size], position) for term, position in tokens
+                    for size in range(low, min(high, len(term)) + 1)]
+        raise ValueError("token filter [{}] is not supported".format(name))
+
+
+def parse_date(value):
+    """
+    This function is used to convert a date to epoch milliseconds, the way dates are stored in doc values
+
+    :param value: epoch milliseconds, yyyy, yyyy-MM, yyyy-MM-dd or ISO datetime
+    :return: epoch milliseconds
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value)
+    if value == 'now':
+        return time.time() * 1000
+    if len(value) == 4:
+        value += '-01-01'
+    elif len(value) == 7:
+        value += '-01'
+    date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp() * 1000
+
+
+def format_date(millis):
+    """This function is used to format epoch milliseconds the way elasticsearch does"""
+    return datetime.fromtimestamp(millis / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def date_floor(millis, interval):
+    """
+    This function is used to round a date down to the start of its date_histogram bucket (in UTC)
+
+    :param millis: epoch milliseconds
+    :param interval: calendar interval (year, quarter, month, week, day, hour, minute, second or 1y, 1M, ...)
+        or fixed interval (e.g. 90m, 7d)
+    :return: bucket key in epoch milliseconds
+    """
+    unit = CALENDAR_INTERVALS.get(interval)
+    if unit is None:
+        step = fixed_interval(interval)
+        return math.floor(millis / step) * step
+    date = datetime.fromtimestamp(millis / 1000, timezone.utc)
+    if unit == 'year':
+        date = date.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    elif unit == 'quarter':
+        date = date.replace(month=(date.month - 1) // 3 * 3 + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    elif unit == 'month':
+        date = date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    elif unit == 'week':
+        date = datetime.fromtimestamp(millis / 1000 - date.weekday() * 86400, timezone.utc) \
+            .replace(hour=0, minute=0, second=0, microsecond=0)
+    elif unit == 'day':
+        date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif unit == 'hour':
+        date = date.replace(minute=0, second=0, microsecond=0)
+    elif unit == 'minute':
+        date = date.replace(second=0, microsecond=0)
+    else:
+        date = date.replace(microsecond=0)
+    return date.timestamp() * 1000
+
+
+def date_next(millis, interval):
+    """
+    This function is used to find the key of the date_histogram bucket following a bucket
+
+    :param millis: bucket key in epoch milliseconds
+    :param interval: interval, see date_floor
+    :return: next bucket key in epoch milliseconds
+    """
+    unit = CALENDAR_INTERVALS.get(interval)
+    if unit is None:
+        return millis + fixed_interval(interval)
+    if unit in ('year', 'quarter', 'month'):
+        date = datetime.fromtimestamp(millis / 1000, timezone.utc)
+        months = date.month - 1 + {'year': 12, 'quarter': 3, 'month': 1}[unit]
+        return date.replace(year=date.year + months // 12, month=months % 12 + 1).timestamp() * 1000
+    return millis + {'week': 7 * 86400000, 'day': 86400000, 'hour': 3600000, 'minute': 60000, 'second': 1000}[unit]
+
+
+def percentile(values, percent):
+    """
+    This function is used to compute a percentile with linear interpolation between the closest ranks
+
+    :param values: sorted values
+    :param percent: percentile, 0 to 100
+    :return: percentile value, None without values
+    """
+    if not values:
+        return None
+    rank = (len(values) - 1) * percent / 100.0
+    low = int(math.floor(rank))
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def fixed_interval(interval):
+    """
+    This function is used to convert a fixed interval to milliseconds
+
+    :param interval: e.g. 90m, 7d, 500ms
+    :return: milliseconds
+    """
+    match = re.match(r'^(\d+)(ms|s|m|h|d)$', str(interval))
+    if match is None:
+        raise ValueError("failed to parse setting [date_histogram.interval] with value [{}]".format(interval))
+    return int(match.group(1)) * FIXED_INTERVAL_UNITS[match.group(2)]
+
+
+def source_values(source, path):
+    """
+    This function is used to read the values of a (dotted) field from a document, flattening arrays
+
+    :param source: document source
+    :param path: field path
+    :return: list of values
+    """
+    values = [source]
+    for key in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and key in value:
+                value = value[key]
+                found.extend(value if isinstance(value, list) else [value])
+        values = found
+    return [value for value in values if value is not None]
+
+
+def flatten_mapping(properties, prefix='', source_prefix=''):
+    """
+    This function is used to flatten mapping properties, including multi-fields, to searchable fields
+
+    :param properties: mapping properties
+    :return: dict of field path to FieldSpec
+    """
+    fields = {}
+    for name, spec in properties.items():
+        path = prefix + name
+        source = source_prefix + name
+        if 'properties' in spec:
+            fields.update(flatten_mapping(spec['properties'], path + '.', source + '.'))
+            continue
+        fields[path] = mapping_field_spec(spec, source)
+        for sub_name, sub_spec in spec.get('fields', {}).items():
+            fields[path + '.' + sub_name] = mapping_field_spec(sub_spec, source)
+    return fields
+
+
+def mapping_field_spec(spec, source):
+    """
+    This function is used to build the FieldSpec of a mapped field
+
+    :param spec: field mapping
+    :param source: source path of the field values
+    :return: FieldSpec
+    """
+    field_type = spec.get('type', 'text')
+    if field_type == 'keyword':
+        normalizer = spec.get('normalizer', 'keyword')
+        return FieldSpec(field_type, source, normalizer, normalizer)
+    analyzer = spec.get('analyzer', 'standard')
+    return FieldSpec(field_type, source, analyzer, spec.get('search_analyzer', analyzer))
+
+
+def dynamic_mapping(source):
+    """
+    This function is used to guess the mapping of the fields of a document, like elasticsearch dynamic mapping:
+    dates are detected, other strings are text with a keyword sub-field, integers long and decimals float
+
+    :param source: document source
+    :return: mapping properties
+    """
+    properties = {}
+    for name, value in source.items():
+        if isinstance(value, list):
+            value = next((v for v in value if v is not None), None)
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            properties[name] = {'properties': dynamic_mapping(value)}
+        elif isinstance(value, bool):
+            properties[name] = {'type': 'boolean'}
+        elif isinstance(value, int):
+            properties[name] = {'type': 'long'}
+        elif isinstance(value, float):
+            properties[name] = {'type': 'float'}
+        elif DATE_PATTERN.match(str(value)):
+            properties[name] = {'type': 'date'}
+        else:
+            properties[name] = {'type': 'text', 'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}}
+    return properties
+
+
+def merge_mapping(properties, update):
+    """This function is used to add the new fields of update to properties, existing fields are kept"""
+    for name, spec in update.items():
+        if name not in properties:
+            properties[name] = spec
+        elif 'properties' in spec and 'properties' in properties[name]:
+            merge_mapping(properties[name]['properties'], spec['properties'])
+    return properties
+
+
+def new_doc_id():
+    """This function is used to generate a 20 character document id, like elasticsearch auto ids"""
+    return base64.urlsafe_b64encode(uuid.uuid4().bytes).decode()[:20]
+
+
+class LevenshteinAutomaton(object):
+    """
+    Levenshtein automaton accepting the words within max_edits edits of a word.
+    States are sparse rows of the edit distance matrix, so walking the automaton along a
+    sorted term dictionary prunes every term prefix that can no longer match. Transitions
+    are memoized, so the automaton turns into a DFA as it is walked.
+
+    :Example:
+        >>> automaton = LevenshteinAutomaton("guide", 1)
+        >>> automaton.is_match(automaton.run("guida"))
+        True
+    """
+
+    def __init__(self, word, max_edits):
+        self.word = word
+        self.max_edits = max_edits
+        self.transitions = {}
+
+    def start(self):
+        indices = tuple(range(min(self.max_edits, len(self.word)) + 1))
+        return indices, indices
+
+    def step(self, state, char):
+        key = (state, char)
+        if key not in self.transitions:
+            self.transitions[key] = self._step(state, char)
+        return self.transitions[key]
+
+    def _step(self, state, char):
+        indices, values = state
+        new_indices, new_values = [], []
+        if indices and indices[0] == 0 and values[0] < self.max_edits:
+            new_indices.append(0)
+            new_values.append(values[0] + 1)
+        for j, (i, value) in enumerate(zip(indices, values)):
+            if i == len(self.word):
+                break
+            value += 0 if self.word[i] == char else 1
+            if new_indices and new_indices[-1] == i:
+                value = min(value, new_values[-1] + 1)
+            if j + 1 < len(indices) and indices[j + 1] == i + 1:
+                value = min(value, values[j + 1] + 1)
+            if value <= self.max_edits:
+                new_indices.append(i + 1)
+                new_values.append(value)
+        return tuple(new_indices), tuple(new_values)
+
+    def run(self, text):
+        state = self.start()
+        for char in text:
+            state = self.step(state, char)
+        return state
+
+    def is_match(self, state):
+        return bool(state[0]) and state[0][-1] == len(self.word)
+
+    def can_match(self, state):
+        return bool(state[0])
+
+    def distance(self, state):
+        return state[1][-1]
+
+    def intersect(self, terms):
+        """
+        This function is used to find the terms of a sorted term dictionary accepted by the automaton
+
+        :param terms: sorted list of terms
+        :return: list of (term, edit distance)
+        """
+        matches = []
+        states = [self.start()]
+        previous = ''
+        i = 0
+        while i < len(terms):
+            term = terms[i]
+            common = 0
+            limit = min(len(previous), len(term), len(states) - 1)
+            while common < limit and previous[common] == term[common]:
+                common += 1
+            del states[common + 1:]
+
+            dead = False
+            for k in range(common, len(term)):
+                state = self.step(states[-1], term[k])
+                if not self.can_match(state):
+                    # no term starting with term[:k + 1] can match, jump past all of them
+                    prefix = term[:k + 1]
+                    i = bisect.bisect_left(terms, prefix[:-1] + chr(ord(prefix[-1]) + 1), i + 1)
+                    previous = term[:k]
+                    dead = True
+                    break
+                states.append(state)
+            if dead:
+                continue
+            if self.is_match(states[-1]):
+                matches.append((term, self.distance(states[-1])))
+            previous = term
+            i += 1
+        return matches
+
+
+def _to_bytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+class MemorySegment(object):
+    """
+    Writable in-memory segment new documents are indexed into until it is flushed to disk.
+    Documents are addressed by their ordinal within the segment.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.versions = []
+        self.seq_nos = []
+        self.sources = []
+        self.deleted = set()
+        self.inverted = {}
+        self.lengths = {}
+        self.doc_values = {}
+        self._sorted_terms = {}
+
+    @property
+    def doc_count(self):
+        return len(self.ids)
+
+    def add(self, doc_id, version, seq_no, source, tokens, numbers):
+        """
+        This function is used to add an analyzed document
+
+        :param tokens: dict of field to list of (term, position)
+        :param numbers: dict of field to list of numeric values
+        :return: document ordinal
+        """
+        ordinal = len(self.ids)
+        self.ids.append(doc_id)
+        self.versions.append(version)
+        self.seq_nos.append(seq_no)
+        self.sources.append(source)
+        for field, field_tokens in tokens.items():
+            postings = self.inverted.setdefault(field, {})
+            for term, position in field_tokens:
+                postings.setdefault(term, {}).setdefault(ordinal, []).append(position)
+            # like lucene, tokens stacked on the same position (edge n-grams) count once in the field length
+            self.lengths.setdefault(field, {})[ordinal] = len(set(position for _, position in field_tokens))
+            self._sorted_terms.pop(field, None)
+        for field, values in numbers.items():
+            self.doc_values.setdefault(field, {})[ordinal] = values
+        return ordinal
+
+    def doc_id(self, ordinal):
+        return self.ids[ordinal]
+
+    def version(self, ordinal):
+        return self.versions[ordinal]
+
+    def seq_no(self, ordinal):
+        return self.seq_nos[ordinal]
+
+    def source(self, ordinal):
+        return self.sources[ordinal]
+
+    def fields(self):
+        return list(self.inverted)
+
+    def value_fields(self):
+        return list(self.doc_values)
+
+    def terms(self, field):
+        if field not in self._sorted_terms:
+            self._sorted_terms[field] = sorted(self.inverted.get(field, {}))
+        return self._sorted_terms[field]
+
+    def postings(self, field, term):
+        return self.inverted.get(field, {}).get(term, {})
+
+    def doc_freq(self, field, term):
+        return len(self.postings(field, term))
+
+    def field_stats(self, field):
+        lengths = self.lengths.get(field, {})
+        return len(lengths), sum(lengths.values())
+
+    def length(self, field, ordinal):
+        return self.lengths.get(field, {}).get(ordinal, 0)
+
+    def values(self, field, ordinal):
+        return self.doc_values.get(field, {}).get(ordinal, [])
+
+    def size(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+def write_segment(path, segment, ordinals):
+    """
+    This function is used to write documents of a segment to an immutable segment file.
+    Stored documents and postings are laid out so they can be read lazily through mmap;
+    the term dictionary and per document lengths/values are kept in the JSON meta.
+
+    :param path: segment file path
+    :param segment: MemorySegment or MmapSegment
+    :param ordinals: ordinals of the documents to write, renumbered from 0
+    """
+    remap = {ordinal: new for new, ordinal in enumerate(ordinals)}
+    with open(path + '.tmp', 'wb') as f:
+        f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, 0, 0))
+        offset = SEGMENT_HEADER.size
+
+        def put(data):
+            nonlocal offset
+            f.write(data)
+            offset += len(data)
+            return [offset - len(data), len(data)]
+
+        docs = []
+        for ordinal in ordinals:
+            data = json.dumps(segment.source(ordinal), separators=(',', ':')).encode('utf-8')
+            docs.append([segment.doc_id(ordinal), segment.version(ordinal), segment.seq_no(ordinal)] + put(data))
+
+        fields = {}
+        for field in segment.fields():
+            terms = {}
+            for term in segment.terms(field):
+                postings = segment.postings(field, term)
+                packed = array('I')
+                doc_freq = 0
+                for ordinal in sorted(postings):
+                    if ordinal not in remap:
+                        continue
+                    positions = postings[ordinal]
+                    packed.append(remap[ordinal])
+                    packed.append(len(positions))
+                    packed.extend(positions)
+                    doc_freq += 1
+                if doc_freq:
+                    terms[term] = [doc_freq] + put(_to_bytes(packed))
+            lengths = array('I', (segment.length(field, ordinal) for ordinal in ordinals))
+            fields[field] = {'terms': terms, 'lengths': put(_to_bytes(lengths))}
+
+        values = {}
+        for field in segment.value_fields():
+            offsets, numbers = array('I', [0]), array('d')
+            for ordinal in ordinals:
+                numbers.extend(segment.values(field, ordinal))
+                offsets.append(len(numbers))
+            values[field] = {'offsets': put(_to_bytes(offsets)), 'values': put(_to_bytes(numbers))}
+
+        meta = json.dumps({'docs': docs, 'fields': fields, 'values': values}, separators=(',', ':')).encode('utf-8')
+        meta_offset = offset
+        f.write(meta)
+        f.seek(0)
+        f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, meta_offset, len(meta)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+class MmapSegment(object):
+    """
+    Immutable on-disk segment written by write_segment. The file is memory mapped:
+    stored documents and postings lists are only decoded when a query touches them.
+    """
+
+    def __init__(self, path, deleted=()):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.deleted = set(deleted)
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, meta_offset, meta_length = SEGMENT_HEADER.unpack_from(self.mm, 0)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError("{} is not a segment file".format(path))
+        meta = json.loads(self.mm[meta_offset:meta_offset + meta_length].decode('utf-8'))
+        self.docs = meta['docs']
+        self.term_dict = {field: spec['terms'] for field, spec in meta['fields'].items()}
+        self.lengths = {field: self._array('I', spec['lengths']) for field, spec in meta['fields'].items()}
+        self.doc_values = {
+            field: (self._array('I', spec['offsets']), self._array('d', spec['values']))
+            for field, spec in meta['values'].items()
+        }
+        self._sorted_terms = {}
+        self.expansions = {}
+
+    def _array(self, typecode, ref):
+        values = array(typecode)
+        values.frombytes(self.mm[ref[0]:ref[0] + ref[1]])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    @property
+    def doc_count(self):
+        return len(self.docs)
+
+    def doc_id(self, ordinal):
+        return self.docs[ordinal][0]
+
+    def version(self, ordinal):
+        return self.docs[ordinal][1]
+
+    def seq_no(self, ordinal):
+        return self.docs[ordinal][2]
+
+    def source(self, ordinal):
+        offset, length = self.docs[ordinal][3:5]
+        return json.loads(self.mm[offset:offset + length].decode('utf-8'))
+
+    def fields(self):
+        return list(self.term_dict)
+
+    def value_fields(self):
+        return list(self.doc_values)
+
+    def terms(self, field):
+        if field not in self._sorted_terms:
+            self._sorted_terms[field] = sorted(self.term_dict.get(field, {}))
+        return self._sorted_terms[field]
+
+    def postings(self, field, term):
+        ref = self.term_dict.get(field, {}).get(term)
+        if ref is None:
+            return {}
+        packed = self._array('I', ref[1:])
+        postings = {}
+        i = 0
+        while i < len(packed):
+            freq = packed[i + 1]
+            postings[packed[i]] = packed[i + 2:i + 2 + freq]
+            i += 2 + freq
+        return postings
+
+    def doc_freq(self, field, term):
+        ref = self.term_dict.get(field, {}).get(term)
+        return ref[0] if ref else 0
+
+    def field_stats(self, field):
+        lengths = self.lengths.get(field)
+        if lengths is None:
+            return 0, 0
+        return sum(1 for length in lengths if length), sum(lengths)
+
+    def length(self, field, ordinal):
+        lengths = self.lengths.get(field)
+        return lengths[ordinal] if lengths is not None else 0
+
+    def values(self, field, ordinal):
+        if field not in self.doc_values:
+            return []
+        offsets, numbers = self.doc_values[field]
+        return list(numbers[offsets[ordinal]:offsets[ordinal + 1]])
+
+    def size(self):
+        return len(self.mm)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+class SearchStats(object):
+    """Index-wide BM25 statistics of one search, shared by all segments"""
+
+    def __init__(self, segments):
+        self.segments = segments
+        self._fields = {}
+        self._doc_freqs = {}
+
+    def field(self, field):
+        if field not in self._fields:
+            doc_count, total_length = 0, 0
+            for segment in self.segments:
+                count, length = segment.field_stats(field)
+                doc_count += count
+                total_length += length
+            self._fields[field] = (doc_count, total_length / doc_count if doc_count else 0.0)
+        return self._fields[field]
+
+    def idf(self, field, term):
+        key = (field, term)
+        if key not in self._doc_freqs:
+            self._doc_freqs[key] = sum(segment.doc_freq(field, term) for segment in self.segments)
+        doc_count = self.field(field)[0]
+        doc_freq = self._doc_freqs[key]
+        return math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def tf_norm(self, field, freq, length):
+        average = self.field(field)[1] or 1.0
+        return freq * (BM25_K1 + 1) / (freq + BM25_K1 * (1 - BM25_B + BM25_B * length / average))
+
+
+class EmbeddedIndex(object):
+    """
+    Pure-Python search index: an inverted index with positions, BM25 scoring and doc values,
+    stored as memory mapped segments plus an in-memory buffer for the latest writes.
+
+    Writes are appended to a translog before they are applied, so nothing is lost between
+    flushes; the buffer is flushed to a new segment every EMBEDDED_FLUSH_DOCS documents and
+    segments are merged once there are more than EMBEDDED_MAX_SEGMENTS of them.
+    Queries and aggregations take the elasticsearch request body format.
+
+    :Example:
+        >>> index = EmbeddedIndex("embedded_data/book_index")
+        >>> index.index({"title": "Solr in Action", "num_reviews": 18})
+        >>> response = index.search({"query": {"match": {"title": "solr"}}})
+    """
+
+    def __init__(self, path, properties=None, settings=None, flush_docs=EMBEDDED_FLUSH_DOCS,
+                 max_segments=EMBEDDED_MAX_SEGMENTS):
+        self.path = path
+        self.flush_docs = flush_docs
+        self.max_segments = max_segments
+        self.lock = threading.RLock()
+        self.properties = {}
+        self.settings = settings or {}
+        self.analysis = Analysis(self.settings)
+        self.fields = {}
+        self.segments = []
+        self.buffer = MemorySegment()
+        self.id_map = {}
+        self.seq_no = -1
+        self.generation = 0
+
+        os.makedirs(path, exist_ok=True)
+        if not self._load() or properties:
+            self.put_mapping(properties or {})
+        self.translog = open(os.path.join(path, 'translog.ndjson'), 'a', encoding='utf-8')
+
+    # persistence
+
+    def _load(self):
+        """
+        This function is used to open the committed segments and replay the translog
+
+        :return: whether the index had been committed before
+        """
+        commit_path = os.path.join(self.path, 'commit.json')
+        if os.path.exists(commit_path):
+            with open(commit_path) as f:
+                commit = json.load(f)
+            self.properties = commit['properties']
+            self.settings = commit.get('settings', self.settings)
+            self.analysis = Analysis(self.settings)
+            self.seq_no = commit['seq_no']
+            self.generation = commit['generation']
+            self.segments = [
+                MmapSegment(os.path.join(self.path, segment['name']), segment['deleted'])
+                for segment in commit['segments']
+            ]
+        self.fields = flatten_mapping(self.properties)
+        self._rebuild_id_map()
+
+        translog_path = os.path.join(self.path, 'translog.ndjson')
+        if os.path.exists(translog_path):
+            with open(translog_path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        operation = json.loads(line)
+                    except ValueError:
+                        # torn last line of an interrupted write
+                        break
+                    self._apply(operation)
+        return os.path.exists(commit_path)
+
+    def _rebuild_id_map(self):
+        self.id_map = {}
+        for segment in self.segments + [self.buffer]:
+            for ordinal in range(segment.doc_count):
+                if ordinal not in segment.deleted:
+                    self.id_map[segment.doc_id(ordinal)] = (segment, ordinal)
+
+    def _commit(self):
+        commit = {
+            'properties': self.properties,
+            'settings': self.settings,
+            'seq_no': self.seq_no,
+            'generation': self.generation,
+            'segments': [{'name': segment.name, 'deleted': sorted(segment.deleted)} for segment in self.segments]
+        }
+        commit_path = os.path.join(self.path, 'commit.json')
+        with open(commit_path + '.tmp', 'w') as f:
+            json.dump(commit, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(commit_path + '.tmp', commit_path)
+
+    def _log(self, operation):
+        self.translog.write(json.dumps(operation, separators=(',', ':')) + '\n')
+        self.translog.flush()
+
+    def _apply(self, operation):
+        if operation['op'] == 'index':
+            self._apply_index(operation['id'], operation['version'], operation['seq_no'], operation['source'])
+        elif operation['op'] == 'delete':
+            self._apply_delete(operation['id'])
+        self.seq_no = max(self.seq_no, operation['seq_no'])
+
+    def _write_segment(self, segments):
+        name = 'seg_{:06d}.seg'.format(self.generation)
+        self.generation += 1
+        if len(segments) == 1:
+            segment = segments[0]
+        else:
+            segment = MemorySegment()
+            for source_segment in segments:
+                for ordinal in range(source_segment.doc_count):
+                    if ordinal not in source_segment.deleted:
+                        source = source_segment.source(ordinal)
+                        tokens, numbers = self._analyze(source)
+                        segment.add(source_segment.doc_id(ordinal), source_segment.version(ordinal),
+                                    source_segment.seq_no(ordinal), source, tokens, numbers)
+        ordinals = [ordinal for ordinal in range(segment.doc_count) if ordinal not in segment.deleted]
+        write_segment(os.path.join(self.path, name), segment, ordinals)
+        return MmapSegment(os.path.join(self.path, name))
+
+    def flush(self):
+        """
+        This function is used to write the buffer to a new segment, commit and empty the translog.
+        Fully deleted segments are dropped and segments are merged past max_segments.
+        """
+        with self.lock:
+            if self.buffer.doc_count > len(self.buffer.deleted):
+                self.segments.append(self._write_segment([self.buffer]))
+            self.buffer = MemorySegment()
+            dropped = [segment for segment in self.segments if len(segment.deleted) == segment.doc_count]
+            self.segments = [segment for segment in self.segments if segment not in dropped]
+            if len(self.segments) > self.max_segments:
+                dropped += self.segments
+                self.segments = [self._write_segment(self.segments)]
+            self._finish_commit(dropped)
+
+    def force_merge(self, max_num_segments=1):
+        """
+        This function is used to merge the segments, expunging deleted documents
+
+        :param max_num_segments: number of segments to merge down to
+        """
+        with self.lock:
+            self.flush()
+            if not self.segments:
+                return
+            if len(self.segments) > max_num_segments or any(segment.deleted for segment in self.segments):
+                merged = self.segments[max_num_segments - 1:]
+                self.segments = self.segments[:max_num_segments - 1] + [self._write_segment(merged)]
+                self._finish_commit(merged)
+
+    def _finish_commit(self, dropped):
+        self._commit()
+        self.translog.close()
+        self.translog = open(os.path.join(self.path, 'translog.ndjson'), 'w', encoding='utf-8')
+        self._rebuild_id_map()
+        for segment in dropped:
+            segment.close()
+            os.remove(segment.path)
+
+    def close(self):
+        """This function is used to flush the index and release its files"""
+        with self.lock:
+            self.flush()
+            self.translog.close()
+            for segment in self.segments:
+                segment.close()
+
+    # mapping and analysis
+
+    def put_mapping(self, properties):
+        """
+        This function is used to add fields to the mapping
+
+        :param properties: mapping properties
+        """
+        with self.lock:
+            merge_mapping(self.properties, properties)
+            self.analysis = Analysis(self.settings)
+            self.fields = flatten_mapping(self.properties)
+            self._commit()
+
+    def field_spec(self, field):
+        """
+        This function is used to look up a searchable field. Like elasticsearch dynamic mappings,
+        every text field without an explicit mapping has a keyword sub-field.
+
+        :param field: field path
+        :return: FieldSpec or None for unknown fields
+        """
+        spec = self.fields.get(field)
+        if spec is None and field.endswith('.keyword') and field[:-8] in self.fields:
+            spec = FieldSpec('keyword', self.fields[field[:-8]].source, 'keyword', 'keyword')
+        return spec
+
+    def _analyze(self, source):
+        """
+        This function is used to analyze a document into postings and doc values
+
+        :param source: document source
+        :return: tuple of (tokens, numbers), see MemorySegment.add
+        """
+        tokens, numbers = {}, {}
+        for field, spec in self.fields.items():
+            values = source_values(source, spec.source)
+            if not values:
+                continue
+            if spec.type in NUMERIC_TYPES:
+                converted = []
+                for value in values:
+                    try:
+                        converted.append(parse_date(value) if spec.type == 'date' else float(value))
+                    except (TypeError, ValueError):
+                        pass
+                numbers[field] = converted
+            elif spec.type in ('keyword', 'boolean'):
+                tokens[field] = [(self._normalized(spec, value), position) for position, value in enumerate(values)]
+            elif spec.type == 'text':
+                field_tokens, offset = [], 0
+                for value in values:
+                    value_tokens = self.analysis.tokens(spec.analyzer, value)
+                    field_tokens.extend((term, offset + position) for term, position in value_tokens)
+                    offset += (value_tokens[-1][1] + 1 if value_tokens else 0) + POSITION_GAP
+                tokens[field] = field_tokens
+        return tokens, numbers
+
+    @staticmethod
+    def _keyword(value):
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return str(value)
+
+    def _normalized(self, spec, value):
+        """This function is used to convert a value to the term stored by a keyword field"""
+        value = self._keyword(value)
+        return value if spec.type != 'keyword' else self.analysis.normalize(spec.analyzer, value)
+
+    def _query_terms(self, field, text):
+        spec = self.field_spec(field)
+        if spec is None:
+            return []
+        if spec.type == 'text':
+            return [term for term, _ in self.analysis.tokens(spec.search_analyzer, text)]
+        return [self._normalized(spec, text)]
+
+    def _exact_term(self, field, value):
+        """This function is used to convert the value of a term level query, normalized on keyword fields"""
+        spec = self.field_spec(field)
+        return self._normalized(spec, value) if spec is not None else self._keyword(value)
+
+    # documents
+
+    def _apply_index(self, doc_id, version, seq_no, source):
+        new_fields = {name: spec for name, spec in dynamic_mapping(source).items() if name not in self.properties}
+        if new_fields:
+            self.properties.update(new_fields)
+            self.fields = flatten_mapping(self.properties)
+        self._apply_delete(doc_id)
+        tokens, numbers = self._analyze(source)
+        self.id_map[doc_id] = (self.buffer, self.buffer.add(doc_id, version, seq_no, source, tokens, numbers))
+
+    def _apply_delete(self, doc_id):
+        location = self.id_map.pop(doc_id, None)
+        if location is not None:
+            location[0].deleted.add(location[1])
+
+    def index(self, source, doc_id=None, op_type='index', version=None, version_type=None):
+        """
+        This function is used to index a document, replacing the document with the same id
+
+        :param source: document source
+        :param doc_id: document id, generated when missing
+        :param op_type: index, or create to fail when the id exists
+        :param version: version of the document with external versioning
+        :param version_type: external (or external_gt) to keep the given version, which must be higher
+            than the current one
+        :return: dict with _id, _version, _seq_no and result
+        """
+        with self.lock:
+            doc_id = new_doc_id() if doc_id is None else str(doc_id)
+            current = self.id_map.get(doc_id)
+            if current is not None and op_type == 'create':
+                raise ConflictError("[{}]: version conflict, document already exists".format(doc_id))
+            if version_type in ('external', 'external_gt'):
+                version = int(version)
+                if current is not None and current[0].version(current[1]) >= version:
+                    raise ConflictError("[{}]: version conflict, current version [{}] is higher or equal to the "
+                                        "one provided [{}]".format(doc_id, current[0].version(current[1]), version))
+            else:
+                version = current[0].version(current[1]) + 1 if current is not None else 1
+            self.seq_no += 1
+            operation = {'op': 'index', 'id': doc_id, 'version': version, 'seq_no': self.seq_no, 'source': source}
+            self._log(operation)
+            self._apply(operation)
+            if self.buffer.doc_count >= self.flush_docs:
+                self.flush()
+            return {
+                '_id': doc_id,
+                '_version': version,
+                '_seq_no': self.seq_no,
+                'result': 'updated' if current is not None else 'created'
+            }
+
+    def delete(self, doc_id):
+        """
+        This function is used to delete a document
+
+        :param doc_id: document id
+        :return: dict with _id, _version, _seq_no and result
+        """
+        with self.lock:
+            doc_id = str(doc_id)
+            current = self.id_map.get(doc_id)
+            if current is None:
+                raise KeyError(doc_id)
+            self.seq_no += 1
+            operation = {'op': 'delete', 'id': doc_id, 'seq_no': self.seq_no}
+            self._log(operation)
+            self._apply(operation)
+            return {
+                '_id': doc_id,
+                '_version': current[0].version(current[1]) + 1,
+                '_seq_no': self.seq_no,
+                'result': 'deleted'
+            }
+
+    def get(self, doc_id):
+        """
+        This function is used to fetch a document
+
+        :param doc_id: document id
+        :return: dict with _id, _version, _seq_no and _source, or None when missing
+        """
+        with self.lock:
+            location = self.id_map.get(str(doc_id))
+            if location is None:
+                return None
+            segment, ordinal = location
+            return {
+                '_id': segment.doc_id(ordinal),
+                '_version': segment.version(ordinal),
+                '_seq_no': segment.seq_no(ordinal),
+                '_source': segment.source(ordinal)
+            }
+
+    def count(self):
+        """This function is used to return the number of live documents"""
+        return len(self.id_map)
+
+    def stats(self):
+        """This function is used to return document and segment counts"""
+        with self.lock:
+            segments = self.segments + [self.buffer]
+            return {
+                'docs': {'count': len(self.id_map), 'deleted': sum(len(segment.deleted) for segment in segments)},
+                'segments': {'count': len(self.segments), 'buffered_docs': self.buffer.doc_count},
+                'store': {'size_in_bytes': sum(segment.size() for segment in segments)}
+            }
+
+    # search
+
+    def _matches(self, query, stats):
+        """
+        This function is used to run a query against every segment
+
+        :return: list of (score, segment index, ordinal) of live documents
+        """
+        matches = []
+        for i, segment in enumerate(stats.segments):
+            for ordinal, score in self._query(segment, query, stats).items():
+                if ordinal not in segment.deleted:
+                    matches.append((score, i, ordinal))
+        return matches
+
+    def search(self, body=None, size=None, from_=None):
+        """
+        This function is used to run a search request body: query, aggs, sort, from/size,
+        search_after, slice, version, _source, docvalue_fields and profile are supported.
+        The profile section is an approximation of the elasticsearch one: the time of the
+        query, collector and aggregation phases of the whole index, reported as a single shard.
+
+        :param body: elasticsearch search body
+        :param size: number of hits, overrides body size
+        :param from_: hits offset, overrides body from
+        :return: elasticsearch shaped search response
+        """
+        start = time.time()
+        body = body or {}
+        timings = [time.perf_counter_ns()]
+        with self.lock:
+            stats = SearchStats(self.segments + [self.buffer])
+            matches = self._matches(body.get('query', {'match_all': {}}), stats)
+            if body.get('slice'):
+                matches = self._slice(matches, body['slice'], stats)
+            timings.append(time.perf_counter_ns())
+            response = {
+                'took': 0,
+                'timed_out': False,
+                '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                'hits': {'total': len(matches), 'max_score': None, 'hits': []}
+            }
+            aggs = body.get('aggs', body.get('aggregations'))
+            if aggs:
+                docs = [(stats.segments[i], ordinal) for _, i, ordinal in matches]
+                response['aggregations'] = self._aggregations(aggs, docs, stats)
+            timings.append(time.perf_counter_ns())
+
+            size = size if size is not None else body.get('size', 10)
+            offset = from_ if from_ is not None else body.get('from', 0)
+            if not size:
+                # elasticsearch 6 reports a max_score of 0 when no hits are collected
+                response['hits']['max_score'] = 0.0
+            else:
+                sort = self._sort_spec(body.get('sort'))
+                matches = self._sort(matches, sort, stats)
+                if body.get('search_after') is not None:
+                    after = body['search_after']
+                    matches = [m for m in matches if self._is_after(self._sort_values(m, sort, stats), after, sort)]
+                if matches:
+                    response['hits']['max_score'] = max(match[0] for match in matches)
+                response['hits']['hits'] = [
+                    self._hit(match, body, sort if body.get('sort') else None, stats)
+                    for match in matches[offset:offset + size]
+                ]
+            timings.append(time.perf_counter_ns())
+        if body.get('profile'):
+            response['profile'] = self._profile(body, aggs, timings)
+        response['took'] = int((time.time() - start) * 1000)
+        return response
+
+    def _profile(self, body, aggs, timings):
+        """
+        This function is used to build the profile section of a search response
+
+        :param body: elasticsearch search body
+        :param aggs: aggregations body
+        :param timings: perf_counter_ns at the start and at the end of the query, aggregation and collector phases
+        :return: elasticsearch shaped profile
+        """
+        query, aggregation, collector = (end - begin for begin, end in zip(timings, timings[1:]))
+        return {
+            'shards': [{
+                'id': '[embedded][{}][0]'.format(os.path.basename(self.path)),
+                'searches': [{
+                    'query': [{
+                        'type': next(iter(body.get('query', {'match_all': {}})), 'match_all'),
+                        'description': json.dumps(body.get('query', {'match_all': {}}), sort_keys=True),
+                        'time_in_nanos': query
+                    }],
+                    'rewrite_time': 0,
+                    'collector': [
+                        {'name': 'EmbeddedCollector', 'reason': 'search_top_hits', 'time_in_nanos': collector}
+                    ]
+                }],
+                'aggregations': [
+                    {'type': next(key for key in spec if key not in ('aggs', 'aggregations', 'meta')),
+                     'description': name, 'time_in_nanos': aggregation // len(aggs)}
+                    for name, spec in aggs.items()
+                ] if aggs else []
+            }]
+        }
+
+    @staticmethod
+    def _slice(matches, spec, stats):
+        """This function is used to keep the matches of one slice of a sliced scroll, split by id hash"""
+        slice_id, slices = int(spec['id']), int(spec['max'])
+        return [match for match in matches
+                if zlib.crc32(stats.segments[match[1]].doc_id(match[2]).encode('utf-8')) % slices == slice_id]
+
+    def _hit(self, match, body, sort, stats):
+        score, i, ordinal = match
+        segment = stats.segments[i]
+        hit = {
+            '_index': os.path.basename(self.path),
+            '_type': self.settings.get('doc_type', '_doc'),
+            '_id': segment.doc_id(ordinal),
+            '_score': score if not sort or ('_score', 'desc') in sort or ('_score', 'asc') in sort else None
+        }
+        if body.get('version'):
+            hit['_version'] = segment.version(ordinal)
+        source = self.filter_source(segment.source(ordinal), body.get('_source'))
+        if source is not None:
+            hit['_source'] = source
+        if body.get('docvalue_fields'):
+            fields = {}
+            for field in body['docvalue_fields']:
+                name = field['field'] if isinstance(field, dict) else field
+                values = self._field_values(segment, ordinal, name)
+                if values:
+                    fields[name] = [int(v) if isinstance(v, float) and v.is_integer() else v for v in values]
+            if fields:
+                hit['fields'] = fields
+        if sort:
+            hit['sort'] = self._sort_values(match, sort, stats)
+        return hit
+
+    @staticmethod
+    def filter_source(source, spec):
+        """
+        This function is used to apply _source filtering to a document
+
+        :param source: document source
+        :param spec: False, includes list/string or {'includes': [...], 'excludes': [...]}
+        :return: filtered source, or None when _source is disabled
+        """
+        if spec is None or spec is True:
+            return source
+        if spec is False:
+            return None
+        if isinstance(spec, str):
+            spec = [spec]
+        if isinstance(spec, list):
+            spec = {'includes': spec}
+        includes = spec.get('includes', spec.get('include')) or []
+        excludes = spec.get('excludes', spec.get('exclude')) or []
+        if isinstance(includes, str):
+            includes = [includes]
+        if isinstance(excludes, str):
+            excludes = [excludes]
+        return {
+            key: value for key, value in source.items()
+            if (not includes or any(fnmatchcase(key, pattern) for pattern in includes))
+            and not any(fnmatchcase(key, pattern) for pattern in excludes)
+        }
+
+    @staticmethod
+    def _sort_spec(sort):
+        if not sort:
+            return [('_score', 'desc'), ('_doc', 'asc')]
+        spec = []
+        for item in sort if isinstance(sort, list) else [sort]:
+            if isinstance(item, str):
+                spec.append((item, 'desc' if item == '_score' else 'asc'))
+            else:
+                field, order = next(iter(item.items()))
+                if isinstance(order, dict):
+                    order = order.get('order', 'desc' if field == '_score' else 'asc')
+                spec.append((field, order))
+        return spec
+
+    def _sort_value(self, match, field, order, stats):
+        score, i, ordinal = match
+        segment = stats.segments[i]
+        if field == '_score':
+            return score
+        if field == '_id':
+            return segment.doc_id(ordinal)
+        if field == '_doc':
+            return i, ordinal
+        values = self._field_values(segment, ordinal, field)
+        if not values:
+            return None
+        return min(values) if order == 'asc' else max(values)
+
+    def _sort(self, matches, sort, stats):
+        for field, order in reversed(sort):
+            keyed = [(self._sort_value(match, field, order, stats), match) for match in matches]
+            present = [item for item in keyed if item[0] is not None]
+            missing = [item for item in keyed if item[0] is None]
+            present.sort(key=lambda item: item[0], reverse=order == 'desc')
+            matches = [match for _, match in present + missing]
+        return matches
+
+    def _sort_values(self, match, sort, stats):
+        values = []
+        for field, order in sort:
+            value = self._sort_value(match, field, order, stats)
+            if field == '_doc':
+                value = match[1] * (1 << 32) + match[2]
+            elif isinstance(value, float) and field != '_score' and value.is_integer():
+                value = int(value)
+            values.append(value)
+        return values
+
+    @staticmethod
+    def _is_after(values, after, sort):
+        for value, cursor, (field, order) in zip(values, after, sort):
+            if value == cursor:
+                continue
+            if value is None:
+                return True
+            if cursor is None:
+                return False
+            return value > cursor if order == 'asc' else value < cursor
+        return False
+
+    def _field_values(self, segment, ordinal, field):
+        """
+        This function is used to read the values of a field used for sorting, docvalue_fields and aggregations:
+        doc values for numeric fields, the raw source values otherwise
+        """
+        spec = self.field_spec(field)
+        if spec is None:
+            return []
+        if spec.type in NUMERIC_TYPES:
+            return segment.values(field, ordinal)
+        return [self._normalized(spec, value) for value in source_values(segment.source(ordinal), spec.source)]
+
+    # queries
+
+    def _query(self, segment, query, stats):
+        """
+        This function is used to run a query clause against one segment
+
+        :param segment: segment
+        :param query: query clause, e.g. {"match": {"title": "guide"}}
+        :param stats: SearchStats
+        :return: dict of ordinal to score
+        """
+        if not query:
+            return self._all(segment)
+        kind, spec = next(iter(query.items()))
+        handler = getattr(self, '_q_' + kind, None)
+        if handler is None:
+            raise ValueError("no [query] registered for [{}]".format(kind))
+        return handler(segment, spec, stats)
+
+    @staticmethod
+    def _all(segment, score=1.0):
+        return {ordinal: score for ordinal in range(segment.doc_count)}
+
+    @staticmethod
+    def _field_and_spec(spec, value_key='value'):
+        """This function is used to unpack {field: value} and {field: {value_key: value, ...}} clauses"""
+        options = {key: value for key, value in spec.items() if key in ('boost', '_name')}
+        field, value = next((key, value) for key, value in spec.items() if key not in ('boost', '_name'))
+        if isinstance(value, dict):
+            options.update(value)
+        else:
+            options[value_key] = value
+        return field, options
+
+    def _q_match_all(self, segment, spec, stats):
+        return self._all(segment, float(spec.get('boost', 1.0)))
+
+    def _q_match_none(self, segment, spec, stats):
+        return {}
+
+    def _q_ids(self, segment, spec, stats):
+        ids = set(str(value) for value in spec.get('values', []))
+        return {ordinal: 1.0 for ordinal in range(segment.doc_count) if segment.doc_id(ordinal) in ids}
+
+    def _q_exists(self, segment, spec, stats):
+        return {ordinal: 1.0 for ordinal in range(segment.doc_count)
+                if self._field_values(segment, ordinal, spec['field'])}
+
+    def _q_constant_score(self, segment, spec, stats):
+        boost = float(spec.get('boost', 1.0))
+        return {ordinal: boost for ordinal in self._query(segment, spec['filter'], stats)}
+
+    def _term_scores(self, segment, field, term, stats, boost=1.0):
+        idf = stats.idf(field, term)
+        return {
+            ordinal: boost * idf * stats.tf_norm(field, len(positions), segment.length(field, ordinal))
+            for ordinal, positions in segment.postings(field, term).items()
+        }
+
+    def _numeric_filter(self, segment, field, test):
+        values = segment.doc_values if isinstance(segment, MemorySegment) else None
+        if values is not None:
+            return {ordinal: 1.0 for ordinal, numbers in values.get(field, {}).items() if any(map(test, numbers))}
+        return {ordinal: 1.0 for ordinal in range(segment.doc_count) if any(map(test, segment.values(field, ordinal)))}
+
+    def _numeric(self, field, value):
+        spec = self.field_spec(field)
+        return parse_date(value) if spec is not None and spec.type == 'date' else float(value)
+
+    def _is_numeric(self, field):
+        spec = self.field_spec(field)
+        return spec is not None and spec.type in NUMERIC_TYPES
+
+    @staticmethod
+    def _fuzziness(fuzziness, term):
+        if fuzziness is None:
+            return 0
+        fuzziness = str(fuzziness).upper()
+        if fuzziness.startswith('AUTO'):
+            low, high = 3, 6
+            if ':' in fuzziness:
+                low, high = (int(value) for value in fuzziness.split(':')[1].split(','))
+            return 0 if len(term) < low else 1 if len(term) < high else 2
+        return min(int(float(fuzziness)), 2)
+
+    def _fuzzy_scores(self, segment, field, term, fuzziness, stats, boost=1.0, prefix_length=0):
+        max_edits = self._fuzziness(fuzziness, term)
+        if not max_edits:
+            return self._term_scores(segment, field, term, stats, boost)
+        scores = {}
+        for candidate, edits in self._fuzzy_terms(segment, field, term, max_edits, prefix_length):
+            weight = boost * (1.0 - float(edits) / max(min(len(candidate), len(term)), 1))
+            for ordinal, score in self._term_scores(segment, field, candidate, stats, weight).items():
+                scores[ordinal] = max(scores.get(ordinal, 0.0), score)
+        return scores
+
+    def _fuzzy_terms(self, segment, field, term, max_edits, prefix_length):
+        """
+        This function is used to expand a term to the terms of a segment within max_edits edits.
+        Segments on disk never change, so their expansions are cached.
+
+        :return: list of (term, edit distance)
+        """
+        key = (field, term, max_edits, prefix_length)
+        cache = getattr(segment, 'expansions', None)
+        if cache is not None and key in cache:
+            return cache[key]
+        terms = self._prefix_range(segment.terms(field), term[:prefix_length])
+        expansions = LevenshteinAutomaton(term, max_edits).intersect(terms)
+        if cache is not None:
+            if len(cache) >= MAX_CACHED_EXPANSIONS:
+                cache.clear()
+            cache[key] = expansions
+        return expansions
+
+    def _q_match(self, segment, spec, stats):
+        field, options = self._field_and_spec(spec, 'query')
+        return self._match(segment, field, options, stats)
+
+    def _match(self, segment, field, options, stats):
+        boost = float(options.get('boost', 1.0))
+        if self._is_numeric(field):
+            value = self._numeric(field, options['query'])
+            return {ordinal: boost for ordinal in self._numeric_filter(segment, field, lambda v: v == value)}
+        terms = self._query_terms(field, options['query'])
+        if not terms:
+            return {}
+        per_term = [
+            self._fuzzy_scores(segment, field, term, options.get('fuzziness'), stats, boost,
+                               int(options.get('prefix_length', 0)))
+            for term in terms
+        ]
+        operator = str(options.get('operator', 'or')).lower()
+        required = len(terms) if operator == 'and' else self._minimum_should_match(
+            options.get('minimum_should_match'), len(terms), 1)
+        return self._combine(per_term, required)
+
+    @staticmethod
+    def _combine(per_term, required):
+        counts, scores = {}, {}
+        for term_scores in per_term:
+            for ordinal, score in term_scores.items():
+                counts[ordinal] = counts.get(ordinal, 0) + 1
+                scores[ordinal] = scores.get(ordinal, 0.0) + score
+        return {ordinal: score for ordinal, score in scores.items() if counts[ordinal] >= required}
+
+    @staticmethod
+    def _minimum_should_match(value, clauses, default):
+        if value is None:
+            return default
+        value = str(value)
+        if value.endswith('%'):
+            count = int(clauses * int(value[:-1]) / 100.0)
+        else:
+            count = int(value)
+        if count < 0:
+            count += clauses
+        return max(count, 0)
+
+    def _phrase(self, segment, field, text, slop, stats, boost=1.0, max_expansions=None):
+        terms = self._query_terms(field, text)
+        if not terms:
+            return {}
+        alternatives = [[term] for term in terms]
+        if max_expansions is not None:
+            dictionary = segment.terms(field)
+            low = bisect.bisect_left(dictionary, terms[-1])
+            high = bisect.bisect_left(dictionary, terms[-1] + '\U0010ffff')
+            alternatives[-1] = dictionary[low:min(high, low + max_expansions)]
+            if not alternatives[-1]:
+                return {}
+
+        positions = []
+        for options in alternatives:
+            merged = {}
+            for term in options:
+                for ordinal, term_positions in segment.postings(field, term).items():
+                    merged.setdefault(ordinal, []).extend(term_positions)
+            positions.append(merged)
+        candidates = set(positions[0])
+        for merged in positions[1:]:
+            candidates &= set(merged)
+
+        idf = sum(sum(stats.idf(field, term) for term in options) / len(options) for options in alternatives)
+        scores = {}
+        for ordinal in candidates:
+            freq = self._phrase_freq([sorted(merged[ordinal]) for merged in positions], slop)
+            if freq:
+                scores[ordinal] = boost * idf * stats.tf_norm(field, freq, segment.length(field, ordinal))
+        return scores
+
+    @staticmethod
+    def _phrase_freq(positions, slop):
+        """
+        This function is used to compute the sloppy frequency of a phrase in a document: for every occurrence
+        of the first term, the other terms are aligned to their nearest position and the match length is the
+        spread of the aligned positions; matches within slop count 1 / (1 + length)
+
+        :param positions: sorted positions of every phrase term
+        :param slop: allowed match length
+        :return: sloppy phrase frequency
+        """
+        freq = 0.0
+        for start in positions[0]:
+            low = high = start
+            for i in range(1, len(positions)):
+                term_positions = positions[i]
+                j = bisect.bisect_left(term_positions, start + i)
+                aligned = None
+                for k in (j - 1, j):
+                    if 0 <= k < len(term_positions):
+                        candidate = term_positions[k] - i
+                        if aligned is None or abs(candidate - start) < abs(aligned - start):
+                            aligned = candidate
+                low, high = min(low, aligned), max(high, aligned)
+            if high - low <= slop:
+                freq += 1.0 / (1 + high - low)
+        return freq
+
+    def _q_match_phrase(self, segment, spec, stats):
+        field, options = self._field_and_spec(spec, 'query')
+        return self._phrase(segment, field, options['query'], int(options.get('slop', 0)), stats,
+                            float(options.get('boost', 1.0)))
+
+    def _q_match_phrase_prefix(self, segment, spec, stats):
+        field, options = self._field_and_spec(spec, 'query')
+        return self._phrase(segment, field, options['query'], int(options.get('slop', 0)), stats,
+                            float(options.get('boost', 1.0)), int(options.get('max_expansions', MAX_EXPANSIONS)))
+
+    def _expand_fields(self, fields):
+        expanded = []
+        for field in fields or ['*']:
+            field, _, boost = field.partition('^')
+            boost = float(boost) if boost else 1.0
+            if '*' in field:
+                expanded.extend((name, boost) for name, spec in self.fields.items()
+                                if fnmatchcase(name, field) and spec.type == 'text')
+            else:
+                expanded.append((field, boost))
+        return expanded
+
+    def _q_multi_match(self, segment, spec, stats):
+        query_type = spec.get('type', 'best_fields')
+        tie_breaker = float(spec.get('tie_breaker', 0.0))
+        boost = float(spec.get('boost', 1.0))
+        per_field = []
+        for field, field_boost in self._expand_fields(spec.get('fields')):
+            if query_type == 'phrase':
+                scores = self._phrase(segment, field, spec['query'], int(spec.get('slop', 0)), stats, field_boost)
+            elif query_type == 'phrase_prefix':
+                scores = self._phrase(segment, field, spec['query'], int(spec.get('slop', 0)), stats, field_boost,
+                                      int(spec.get('max_expansions', MAX_EXPANSIONS)))
+            else:
+                options = {key: spec[key] for key in ('fuzziness', 'operator', 'minimum_should_match', 'prefix_length')
+                           if key in spec}
+                scores = self._match(segment, field, dict(options, query=spec['query'], boost=field_boost), stats)
+            per_field.append(scores)
+
+        combined = {}
+        for scores in per_field:
+            for ordinal, score in scores.items():
+                combined.setdefault(ordinal, []).append(score)
+        if query_type in ('most_fields', 'cross_fields'):
+            return {ordinal: boost * sum(scores) for ordinal, scores in combined.items()}
+        return {
+            ordinal: boost * (max(scores) + tie_breaker * (sum(scores) - max(scores)))
+            for ordinal, scores in combined.items()
+        }
+
+    def _q_term(self, segment, spec, stats):
+        field, options = self._field_and_spec(spec)
+        boost = float(options.get('boost', 1.0))
+        spec_type = self.field_spec(field)
+        if spec_type is None:
+            return {}
+        if spec_type.type in NUMERIC_TYPES:
+            value = self._numeric(field, options['value'])
+            return {ordinal: boost for ordinal in self._numeric_filter(segment, field, lambda v: v == value)}
+        return self._term_scores(segment, field, self._exact_term(field, options['value']), stats, boost)
+
+    def _q_terms(self, segment, spec, stats):
+        boost = float(spec.get('boost', 1.0))
+        field, values = next((key, value) for key, value in spec.items() if key != 'boost')
+        if self._is_numeric(field):
+            numbers = set(self._numeric(field, value) for value in values)
+            return {ordinal: boost for ordinal in self._numeric_filter(segment, field, lambda v: v in numbers)}
+        scores = {}
+        for value in values:
+            for ordinal in segment.postings(field, self._exact_term(field, value)):
+                scores[ordinal] = boost
+        return scores
+
+    def _q_range(self, segment, spec, stats):
+        field, options = self._field_and_spec(spec)
+        boost = float(options.get('boost', 1.0))
+        if self._is_numeric(field):
+            bounds = [(operator, self._numeric(field, options[operator]))
+                      for operator in ('gt', 'gte', 'lt', 'lte') if options.get(operator) is not None]
+        else:
+            bounds = [(operator, self._keyword(options[operator]))
+                      for operator in ('gt', 'gte', 'lt', 'lte') if options.get(operator) is not None]
+
+        def test(value):
+            for operator, bound in bounds:
+                if operator == 'gt' and not value > bound or operator == 'gte' and not value >= bound:
+                    return False
+                if operator == 'lt' and not value < bound or operator == 'lte' and not value <= bound:
+                    return False
+            return True
+
+        if self._is_numeric(field):
+            return {ordinal: boost for ordinal in self._numeric_filter(segment, field, test)}
+        return self._terms_matching(segment, field, test, boost)
+
+    def _terms_matching(self, segment, field, test, boost=1.0, terms=None):
+        scores = {}
+        for term in segment.terms(field) if terms is None else terms:
+            if test(term):
+                for ordinal in segment.postings(field, term):
+                    scores[ordinal] = boost
+        return scores
+
+    @staticmethod
+    def _prefix_range(terms, prefix):
+        if not prefix:
+            return terms
+        low = bisect.bisect_left(terms, prefix)
+        return terms[low:bisect.bisect_left(terms, prefix + '\U0010ffff', low)]
+
+    def _q_prefix(self, segment, spec, stats):
+        field, options = self._field_and_spec(spec)
+        prefix = options['value']
+        terms = self._prefix_range(segment.terms(field), prefix)
+        return self._terms_matching(segment, field, lambda term: True, float(options.get('boost', 1.0)), terms)
+
+    def _q_wildcard(self, segment, spec, stats):
+        field, options = self._field_and_spec(spec)
+        pattern = options.get('value', options.get('wildcard'))
+        prefix = re.split(r'[*?]', pattern, 1)[0]
+        terms = self._prefix_range(segment.terms(field), prefix)
+        return self._terms_matching(segment, field, lambda term: fnmatchcase(term, pattern),
+                                    float(options.get('boost', 1.0)), terms)
+
+    def _q_regexp(self, segment, spec, stats):
+        field, options = self._field_and_spec(spec)
+        pattern = options['value']
+        prefix = ''
+        for i, char in enumerate(pattern):
+            if char in REGEX_META:
+                # a quantifier applies to the previous literal, which is then not part of the prefix
+                if char in '?*{' and prefix:
+                    prefix = prefix[:-1]
+                break
+            prefix += char
+        regex = re.compile(pattern)
+        terms = self._prefix_range(segment.terms(field), prefix)
+        return self._terms_matching(segment, field, lambda term: regex.fullmatch(term) is not None,
+                                    float(options.get('boost', 1.0)), terms)
+
+    def _q_fuzzy(self, segment, spec, stats):
+        field, options = self._field_and_spec(spec)
+        return self._fuzzy_scores(segment, field, self._keyword(options['value']), options.get('fuzziness', 'AUTO'),
+                                  stats, float(options.get('boost', 1.0)), int(options.get('prefix_length', 0)))
+
+    def _q_bool(self, segment, spec, stats):
+        def clauses(key):
+            value = spec.get(key, [])
+            return value if isinstance(value, list) else [value]
+
+        must, filters, should, must_not = clauses('must'), clauses('filter'), clauses('should'), clauses('must_not')
+        result = None
+        for clause in must:
+            scores = self._query(segment, clause, stats)
+            result = scores if result is None else {o: s + scores[o] for o, s in result.items() if o in scores}
+        for clause in filters:
+            matched = self._query(segment, clause, stats)
+            result = {o: 0.0 for o in matched} if result is None else {
+                o: s for o, s in result.items() if o in matched}
+        if should:
+            required = self._minimum_should_match(spec.get('minimum_should_match'), len(should),
+                                                  0 if must or filters else 1)
+            per_clause = [self._query(segment, clause, stats) for clause in should]
+            combined = self._combine(per_clause, required)
+            if result is None:
+                result = combined
+            else:
+                counts = {}
+                for scores in per_clause:
+                    for ordinal in scores:
+                        counts[ordinal] = counts.get(ordinal, 0) + 1
+                result = {o: s + combined.get(o, 0.0) for o, s in result.items() if counts.get(o, 0) >= required}
+        if result is None:
+            result = self._all(segment, 0.0)
+        for clause in must_not:
+            for ordinal in self._query(segment, clause, stats):
+                result.pop(ordinal, None)
+        boost = float(spec.get('boost', 1.0))
+        return {ordinal: boost * score for ordinal, score in result.items()}
+
+    def _q_dis_max(self, segment, spec, stats):
+        tie_breaker = float(spec.get('tie_breaker', 0.0))
+        combined = {}
+        for clause in spec.get('queries', []):
+            for ordinal, score in self._query(segment, clause, stats).items():
+                combined.setdefault(ordinal, []).append(score)
+        boost = float(spec.get('boost', 1.0))
+        return {
+            ordinal: boost * (max(scores) + tie_breaker * (sum(scores) - max(scores)))
+            for ordinal, scores in combined.items()
+        }
+
+    def _q_query_string(self, segment, spec, stats):
+        return self._query(segment, self.parse_query_string(spec), stats)
+
+    _q_simple_query_string = _q_query_string
+
+    def parse_query_string(self, spec):
+        """
+        This function is used to translate a query_string query to a bool query. Supported syntax:
+        terms, "phrases", field:value, +required, -excluded / NOT, wildcards (*, ?), fuzzy (term~N)
+        and AND / OR operators
+
+        :param spec: query_string options
+        :return: bool query
+        """
+        default_operator = str(spec.get('default_operator', 'or')).lower()
+        fields = spec.get('fields') or ([spec['default_field']] if spec.get('default_field') else ['*'])
+        must, should, must_not = [], [], []
+        negate, conjunction = False, False
+        for sign, field, text in re.findall(r'([+-]?)(?:([\w.*]+):)?("[^"]*"|\S+)', spec['query']):
+            if text in ('AND', 'OR', '&&', '||') and not field:
+                conjunction = text in ('AND', '&&')
+                if conjunction and should:
+                    must.append(should.pop())
+                continue
+            if text == 'NOT' and not field:
+                negate = True
+                continue
+            targets = [field] if field else fields
+            if text.startswith('"'):
+                clause = {'multi_match': {'query': text.strip('"'), 'fields': targets, 'type': 'phrase'}}
+            elif '*' in text or '?' in text:
+                clause = {'bool': {'should': [{'wildcard': {name: text.lower()}}
+                                              for name, _ in self._expand_fields(targets)]}}
+            elif re.match(r'.+~\d*$', text):
+                term, _, distance = text.rpartition('~')
+                clause = {'multi_match': {'query': term, 'fields': targets, 'fuzziness': distance or 'AUTO'}}
+            else:
+                clause = {'multi_match': {'query': text, 'fields': targets}}
+
+            if sign == '-' or negate:
+                must_not.append(clause)
+            elif sign == '+' or conjunction or default_operator == 'and':
+                must.append(clause)
+            else:
+                should.append(clause)
+            negate, conjunction = False, False
+        return {'bool': {'must': must, 'should': should, 'must_not': must_not}}
+
+    # delete/update by query
+
+    def matching_ids(self, query):
+        """
+        This function is used to list the ids of the documents matching a query
+
+        :param query: query clause
+        :return: list of document ids
+        """
+        with self.lock:
+            stats = SearchStats(self.segments + [self.buffer])
+            return [stats.segments[i].doc_id(ordinal) for _, i, ordinal in self._matches(query or {}, stats)]
+
+    def delete_by_query(self, query):
+        """
+        This function is used to delete the documents matching a query
+
+        :param query: query clause
+        :return: number of deleted documents
+        """
+        with self.lock:
+            doc_ids = self.matching_ids(query)
+            for doc_id in doc_ids:
+                self.delete(doc_id)
+            return len(doc_ids)
+
+    def update_by_query(self, query, update):
+        """
+        This function is used to update the documents matching a query
+
+        :param query: query clause
+        :param update: function changing a document source in place, returns False for a noop
+        :return: tuple of (updated, noops)
+        """
+        with self.lock:
+            updated, noops = 0, 0
+            for doc_id in self.matching_ids(query):
+                source = json.loads(json.dumps(self.get(doc_id)['_source']))
+                if update(source) is False:
+                    noops += 1
+                    continue
+                self.index(source, doc_id=doc_id)
+                updated += 1
+            return updated, noops
+
+    # aggregations
+
+    def _aggregations(self, aggs, docs, stats):
+        """
+        This function is used to compute aggregations over a set of documents
+
+        :param aggs: aggregations body
+        :param docs: list of (segment, ordinal)
+        :param stats: SearchStats
+        :return: aggregations response
+        """
+        results = {}
+        for name, spec in aggs.items():
+            sub_aggs = spec.get('aggs', spec.get('aggregations'))
+            kind = next(key for key in spec if key not in ('aggs', 'aggregations', 'meta'))
+            options = spec[kind]
+            if kind in METRICS:
+                result = self._metric(kind, options, docs)
+            elif kind == 'filter':
+                result = self._bucket(self._filter_docs(options, docs, stats), sub_aggs, stats)
+            elif kind == 'filters':
+                filters = options['filters']
+                result = {'buckets': {key: self._bucket(self._filter_docs(query, docs, stats), sub_aggs, stats)
+                                      for key, query in filters.items()}}
+            elif kind in ('range', 'date_range'):
+                result = self._range_aggregation(options, docs, sub_aggs, stats, dates=kind == 'date_range')
+            elif kind == 'terms':
+                result = self._terms_aggregation(options, docs, sub_aggs, stats)
+            elif kind == 'histogram':
+                result = self._histogram(options, docs, sub_aggs, stats)
+            elif kind == 'date_histogram':
+                result = self._date_histogram(options, docs, sub_aggs, stats)
+            elif kind == 'composite':
+                result = self._composite(options, docs, sub_aggs, stats)
+            elif kind == 'missing':
+                result = self._bucket([doc for doc in docs if not self._field_values(doc[0], doc[1], options['field'])],
+                                      sub_aggs, stats)
+            else:
+                raise ValueError("unknown aggregation type [{}]".format(kind))
+            results[name] = result
+        return results
+
+    def _bucket(self, docs, sub_aggs, stats, **keys):
+        bucket = dict(keys, doc_count=len(docs))
+        if sub_aggs:
+            bucket.update(self._aggregations(sub_aggs, docs, stats))
+        return bucket
+
+    def _filter_docs(self, query, docs, stats):
+        matched = {}
+        for i, segment in enumerate(stats.segments):
+            matched[id(segment)] = self._query(segment, query, stats)
+        return [(segment, ordinal) for segment, ordinal in docs if ordinal in matched[id(segment)]]
+
+    def _metric(self, kind, options, docs):
+        field = options['field']
+        values = []
+        for segment, ordinal in docs:
+            values.extend(self._field_values(segment, ordinal, field))
+        spec = self.field_spec(field)
+        if spec is not None and spec.type not in NUMERIC_TYPES and kind not in ('value_count', 'cardinality'):
+            raise ValueError("field [{}] of type [text] is not supported for aggregation [{}]".format(field, kind))
+        if kind == 'value_count':
+            return {'value': len(values)}
+        if kind == 'cardinality':
+            return {'value': len(set(values))}
+        if kind == 'percentiles':
+            return {'values': {str(float(percent)): percentile(sorted(values), float(percent))
+                               for percent in options.get('percents', DEFAULT_PERCENTS)}}
+
+        count = len(values)
+        total = sum(values)
+        stats = {
+            'count': count,
+            'min': min(values) if values else None,
+            'max': max(values) if values else None,
+            'avg': total / count if count else None,
+            'sum': total
+        }
+        if kind == 'extended_stats':
+            squares = sum(value * value for value in values)
+            variance = squares / count - stats['avg'] ** 2 if count else None
+            stats.update(sum_of_squares=squares, variance=variance,
+                         std_deviation=math.sqrt(max(variance, 0.0)) if count else None)
+        if kind in ('stats', 'extended_stats'):
+            return stats
+        result = {'value': stats[kind]}
+        if kind in ('min', 'max') and result['value'] is not None and spec.type == 'date':
+            result['value_as_string'] = format_date(result['value'])
+        return result
+
+    def _range_aggregation(self, options, docs, sub_aggs, stats, dates=False):
+        field = options['field']
+        ranges = []
+        for spec in options['ranges']:
+            low = self._numeric(field, spec['from']) if spec.get('from') is not None else None
+            high = self._numeric(field, spec['to']) if spec.get('to') is not None else None
+            ranges.append((low, high, spec))
+        ranges.sort(key=lambda item: (item[0] if item[0] is not None else -math.inf,
+                                      item[1] if item[1] is not None else math.inf))
+
+        # date_range keys and bounds are also rendered as dates, e.g. *-2015-01-01T00:00:00.000Z
+        render = format_date if dates else float
+        buckets = []
+        for low, high, spec in ranges:
+            in_range = [
+                doc for doc in docs
+                if any((low is None or value >= low) and (high is None or value < high)
+                       for value in self._field_values(doc[0], doc[1], field))
+            ]
+            key = spec.get('key') or '{}-{}'.format('*' if low is None else render(low),
+                                                    '*' if high is None else render(high))
+            keys = {'key': key}
+            if low is not None:
+                keys['from'] = float(low)
+                if dates:
+                    keys['from_as_string'] = format_date(low)
+            if high is not None:
+                keys['to'] = float(high)
+                if dates:
+                    keys['to_as_string'] = format_date(high)
+            buckets.append(self._bucket(in_range, sub_aggs, stats, **keys))
+        if options.get('keyed'):
+            return {'buckets': {bucket.pop('key'): bucket for bucket in buckets}}
+        return {'buckets': buckets}
+
+    @staticmethod
+    def _bucket_key(value):
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value
+
+    def _terms_aggregation(self, options, docs, sub_aggs, stats):
+        field = options['field']
+        groups = {}
+        for doc in docs:
+            for value in set(self._field_values(doc[0], doc[1], field)):
+                groups.setdefault(value, []).append(doc)
+        buckets = [self._bucket(group, sub_aggs, stats, key=self._bucket_key(value)) for value, group in groups.items()]
+        if self._is_numeric(field) and self.field_spec(field).type == 'date':
+            for bucket in buckets:
+                bucket['key_as_string'] = format_date(bucket['key'])
+
+        order = options.get('order', {'_count': 'desc'})
+        for item in reversed(order if isinstance(order, list) else [order]):
+            key, direction = next(iter(item.items()))
+            if key in ('_key', '_term'):
+                sort_key = lambda bucket: bucket['key']
+            elif key == '_count':
+                sort_key = lambda bucket: bucket['doc_count']
+            else:
+                name, _, metric = key.partition('.')
+                sort_key = lambda bucket: self._order_value(bucket[name], metric)
+            if key == '_count':
+                buckets.sort(key=lambda bucket: bucket['key'])
+            buckets.sort(key=sort_key, reverse=direction == 'desc')
+
+        min_doc_count = int(options.get('min_doc_count', 1))
+        buckets = [bucket for bucket in buckets if bucket['doc_count'] >= min_doc_count]
+        size = int(options.get('size', 10))
+        return {
+            'doc_count_error_upper_bound': 0,
+            'sum_other_doc_count': sum(bucket['doc_count'] for bucket in buckets[size:]),
+            'buckets': buckets[:size]
+        }
+
+    def _date_histogram(self, options, docs, sub_aggs, stats):
+        field, interval = options['field'], options['interval']
+        groups = {}
+        for doc in docs:
+            for key in set(date_floor(value, interval) for value in self._field_values(doc[0], doc[1], field)):
+                groups.setdefault(key, []).append(doc)
+        min_doc_count = int(options.get('min_doc_count', 0))
+        keys = sorted(groups)
+        if keys and min_doc_count == 0:
+            keys, last = [keys[0]], keys[-1]
+            while keys[-1] < last:
+                keys.append(date_next(keys[-1], interval))
+        buckets = [self._bucket(groups.get(key, []), sub_aggs, stats, key_as_string=format_date(key),
+                                key=self._bucket_key(key)) for key in keys]
+        return {'buckets': [bucket for bucket in buckets if bucket['doc_count'] >= min_doc_count]}
+
+    def _source_keys(self, doc, source):
+        kind, options = next(iter(source.items()))
+        values = self._field_values(doc[0], doc[1], options['field'])
+        if kind == 'terms':
+            return set(self._bucket_key(value) for value in values)
+        if kind == 'histogram':
+            interval = float(options['interval'])
+            return set(self._bucket_key(math.floor(value / interval) * interval) for value in values)
+        if kind == 'date_histogram':
+            return set(self._bucket_key(date_floor(value, options['interval'])) for value in values)
+        raise ValueError("invalid source type [{}] in composite aggregation".format(kind))
+
+    def _composite(self, options, docs, sub_aggs, stats):
+        """
+        This function is used to compute one page of a composite aggregation: buckets of every combination
+        of the source values, ordered by key, after the key given in options.after
+        """
+        names = [next(iter(source)) for source in options['sources']]
+        sources = [source[name] for source, name in zip(options['sources'], names)]
+        directions = [next(iter(source.values())).get('order', 'asc') for source in sources]
+
+        def compare(left, right):
+            for a, b, direction in zip(left, right, directions):
+                if a != b:
+                    return (-1 if a < b else 1) * (-1 if direction == 'desc' else 1)
+            return 0
+
+        groups = {}
+        for doc in docs:
+            for key in itertools.product(*[sorted(self._source_keys(doc, source)) for source in sources]):
+                groups.setdefault(key, []).append(doc)
+        keys = sorted(groups, key=functools.cmp_to_key(compare))
+        if options.get('after'):
+            after = tuple(options['after'][name] for name in names)
+            keys = [key for key in keys if compare(key, after) > 0]
+
+        size = int(options.get('size', 10))
+        buckets = [self._bucket(groups[key], sub_aggs, stats, key=dict(zip(names, key))) for key in keys[:size]]
+        result = {'buckets': buckets}
+        if buckets:
+            result['after_key'] = buckets[-1]['key']
+        return result
+
+    @staticmethod
+    def _order_value(aggregation, metric):
+        value = aggregation.get(metric or 'value', aggregation.get('doc_count'))
+        return -math.inf if value is None else value
+
+    def _histogram(self, options, docs, sub_aggs, stats):
+        field = options['field']
+        interval = float(options['interval'])
+        offset = float(options.get('offset', 0))
+        groups = {}
+        for doc in docs:
+            for key in set(math.floor((value - offset) / interval) * interval + offset
+                           for value in self._field_values(doc[0], doc[1], field)):
+                groups.setdefault(key, []).append(doc)
+        min_doc_count = int(options.get('min_doc_count', 0))
+        keys = sorted(groups)
+        if keys and min_doc_count == 0:
+            steps = int(round((keys[-1] - keys[0]) / interval))
+            keys = [keys[0] + step * interval for step in range(steps + 1)]
+        buckets = [self._bucket(groups.get(key, []), sub_aggs, stats, key=key) for key in keys]
+        return {'buckets': [bucket for bucket in buckets if bucket['doc_count'] >= min_doc_count]}
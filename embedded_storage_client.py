@@ -0,0 +1,912 @@
+import base64
+import functools
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from elasticsearch import TransportError, NotFoundError, ConflictError, RequestError
+from elasticsearch.serializer import JSONSerializer
+
+from bulk_ingest import make_write_behind
+from embedded_index import EmbeddedIndex, ConflictError as DocumentConflict
+from settings import ELASTIC_INDEX, ELASTIC_DOC, ELASTIC_HOSTNAME, ELASTIC_PORT, EMBEDDED_DATA_DIR
+from storage_client import ElasticBookStorage, BOOK_UPDATE_SCRIPT, BOOK_DELETE_SCRIPT, BOOK_ID_FIELD, BOOK_ID_SCRIPT
+
+# client options that only concern the HTTP transport
+TRANSPORT_OPTIONS = ('request_timeout', 'filter_path', 'headers', 'opaque_id', 'api_key', 'http_auth', 'refresh',
+                     'routing', 'timeout', 'pretty', 'error_trace', 'human')
+
+INDEX_NAME_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_\-.+]*$')
+KEEP_ALIVE_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# index.version.created reported by get_settings, the id of elasticsearch 6.6.2
+ES_VERSION_ID = '6060299'
+
+# tasks API action of each by query request
+BY_QUERY_ACTIONS = {
+    'delete_by_query': 'indices:data/write/delete/byquery',
+    'update_by_query': 'indices:data/write/update/byquery',
+    'reindex': 'indices:data/write/reindex'
+}
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+
+
+def apply_book_updates(source, updates):
+    """
+    This function is used to apply the updates of BOOK_UPDATE_SCRIPT to a document, the way the Painless script does
+
+    :param source: document source, changed in place
+    :param updates: list of {"op", "field", "value"} updates
+    """
+    for update in updates:
+        field, value, op = update['field'], update.get('value'), update.get('op', 'set')
+        if op == 'set':
+            source[field] = value
+        elif op == 'inc':
+            source[field] = (source.get(field) or 0) + value
+        elif op == 'append':
+            current = source.get(field)
+            if current is None:
+                current = []
+            elif not isinstance(current, list):
+                current = [current]
+            if value not in current:
+                current.append(value)
+            source[field] = current
+        elif op == 'remove':
+            if isinstance(source.get(field), list):
+                source[field] = [item for item in source[field] if item != value]
+
+
+def transport_error(status, error_type, reason, **details):
+    """
+    This function is used to build the exception elasticsearch-py raises for an error response
+
+    :param status: HTTP status
+    :param error_type: elasticsearch error type
+    :param reason: error reason
+    :return: TransportError subclass
+    """
+    cause = dict({'type': error_type, 'reason': reason}, **details)
+    info = {'error': dict(cause, root_cause=[cause]), 'status': status}
+    exception = {400: RequestError, 404: NotFoundError, 409: ConflictError}.get(status, TransportError)
+    return exception(status, error_type, info)
+
+
+def index_not_found(index):
+    """
+    This function is used to build the error elasticsearch answers for a missing index
+
+    :param index: index name
+    :return: NotFoundError
+    """
+    return transport_error(404, 'index_not_found_exception', 'no such index', **{
+        'resource.type': 'index_or_alias', 'resource.id': index, 'index_uuid': '_na_', 'index': index})
+
+
+def setting_strings(value):
+    """This function is used to turn setting values into strings, the way get_settings reports them"""
+    if isinstance(value, dict):
+        return {key: setting_strings(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [setting_strings(item) for item in value]
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
+
+
+def client_method(func):
+    """
+    This decorator is used to give EmbeddedClient methods the calling conventions of elasticsearch-py:
+    query parameters may be passed as keyword arguments or as params, transport options are dropped
+    and errors whose status is listed in ignore are returned instead of raised
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        ignore = kwargs.pop('ignore', ())
+        ignore = ignore if isinstance(ignore, (list, tuple)) else (ignore,)
+        kwargs.update(kwargs.pop('params', None) or {})
+        for option in TRANSPORT_OPTIONS:
+            kwargs.pop(option, None)
+        try:
+            return func(self, *args, **kwargs)
+        except TransportError as ex:
+            if ex.status_code in ignore:
+                return ex.info
+            raise
+    return wrapper
+
+
+def is_false(value):
+    return value is False or str(value).lower() == 'false'
+
+
+def keep_alive_seconds(keep_alive):
+    """This function is used to convert a scroll keep alive such as "2m" to seconds"""
+    number, unit = re.match(r'^(\d+)([a-z]*)$', str(keep_alive)).groups()
+    return int(number) * KEEP_ALIVE_UNITS.get(unit or 'ms', 1)
+
+
+class EmbeddedClient(object):
+    """
+    In-process stand-in for the elasticsearch-py client, answering the calls ElasticBookStorage
+    makes (search/scroll, msearch, get/mget, index/delete, bulk, delete/update by query, stored
+    scripts, indices, cluster and tasks APIs) from EmbeddedIndex engines stored under data_dir.
+    Responses have the shape of an elasticsearch 6.x response.
+
+    :Example:
+        >>> es = EmbeddedClient("embedded_data")
+        >>> es.index(index="book_index", doc_type="book_doc", body={"title": "Solr in Action"})
+        >>> es.search(index="book_index", body={"query": {"match": {"title": "solr"}}})
+    """
+
+    def __init__(self, data_dir=EMBEDDED_DATA_DIR):
+        self.data_dir = data_dir
+        self.lock = threading.RLock()
+        self.engines = {}
+        self.scrolls = {}
+        self.task_results = {}
+        self.task_counter = 0
+        os.makedirs(data_dir, exist_ok=True)
+
+        self.scripts_path = os.path.join(data_dir, 'scripts.json')
+        self.scripts = {}
+        if os.path.exists(self.scripts_path):
+            with open(self.scripts_path) as f:
+                self.scripts = json.load(f)
+
+        self.aliases_path = os.path.join(data_dir, 'aliases.json')
+        self.aliases = {}
+        if os.path.exists(self.aliases_path):
+            with open(self.aliases_path) as f:
+                self.aliases = json.load(f)
+
+        self.transport = EmbeddedTransport()
+        self.indices = EmbeddedIndicesClient(self)
+        self.cluster = EmbeddedClusterClient(self)
+        self.tasks = EmbeddedTasksClient(self)
+
+    def resolve(self, index):
+        """
+        This function is used to resolve an alias to the index it points to
+
+        :param index: index or alias name
+        :return: index name
+        """
+        indices = self.aliases.get(index)
+        if indices is None:
+            return index
+        if len(indices) != 1:
+            raise transport_error(400, 'illegal_argument_exception',
+                                  "alias [{}] has more than one index associated with it [{}], can't execute "
+                                  "a single index op".format(index, indices))
+        return indices[0]
+
+    def save_aliases(self):
+        """This function is used to persist the aliases next to the indices"""
+        with open(self.aliases_path + '.tmp', 'w') as f:
+            json.dump(self.aliases, f)
+        os.replace(self.aliases_path + '.tmp', self.aliases_path)
+
+    def engine(self, index, create=False):
+        """
+        This function is used to return the engine of an index, aliases are resolved
+
+        :param index: index or alias name
+        :param create: create the index when it does not exist, like elasticsearch does on writes
+        :return: EmbeddedIndex
+        """
+        with self.lock:
+            index = self.resolve(index)
+            if index not in self.engines:
+                if not index or not INDEX_NAME_PATTERN.match(index) or index in ('.', '..'):
+                    raise transport_error(400, 'invalid_index_name_exception', "Invalid index name [{}]".format(index))
+                path = os.path.join(self.data_dir, index)
+                if not os.path.isdir(path) and not create:
+                    raise index_not_found(index)
+                self.engines[index] = EmbeddedIndex(path)
+            return self.engines[index]
+
+    def index_names(self):
+        """This function is used to list the existing indices"""
+        with self.lock:
+            names = set(self.engines)
+            names.update(name for name in os.listdir(self.data_dir)
+                         if os.path.isdir(os.path.join(self.data_dir, name)))
+            return sorted(names)
+
+    @staticmethod
+    def _shards():
+        return {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0}
+
+    @staticmethod
+    def _source_spec(options):
+        if is_false(options.get('_source', True)):
+            return False
+        includes = options.get('_source_includes', options.get('_source_include'))
+        excludes = options.get('_source_excludes', options.get('_source_exclude'))
+        if options.get('_source') not in (None, True) and str(options['_source']).lower() != 'true':
+            includes = options['_source']
+        if includes is None and excludes is None:
+            return None
+        split = lambda value: value.split(',') if isinstance(value, str) else list(value or [])
+        return {'includes': split(includes), 'excludes': split(excludes)}
+
+    def _doc(self, index, doc_type, doc, source_spec):
+        engine = self.engine(index)
+        response = {
+            '_index': self.resolve(index),
+            '_type': doc_type or engine.settings.get('doc_type', '_doc'),
+            '_id': doc['_id'],
+            '_version': doc['_version'],
+            'found': True
+        }
+        source = engine.filter_source(doc['_source'], source_spec)
+        if source is not None:
+            response['_source'] = source
+        return response
+
+    def _write_response(self, index, doc_type, result):
+        return {
+            '_index': self.resolve(index),
+            '_type': doc_type or self.engine(index).settings.get('doc_type', '_doc'),
+            '_id': result['_id'],
+            '_version': result['_version'],
+            'result': result['result'],
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            '_seq_no': result['_seq_no'],
+            '_primary_term': 1
+        }
+
+    def _purge_scrolls(self):
+        now = time.time()
+        for scroll_id in [key for key, context in self.scrolls.items() if context['expires'] < now]:
+            del self.scrolls[scroll_id]
+
+    def _scroll_page(self, scroll_id):
+        context = self.scrolls[scroll_id]
+        hits = context['hits'][:context['size']]
+        del context['hits'][:context['size']]
+        return {
+            '_scroll_id': scroll_id,
+            'took': 0,
+            'timed_out': False,
+            '_shards': self._shards(),
+            'hits': {'total': context['total'], 'max_score': context['max_score'], 'hits': hits}
+        }
+
+    @client_method
+    def search(self, body=None, index=None, doc_type=None, size=None, from_=None, scroll=None, **options):
+        engine = self.engine(index)
+        size = int(size) if size is not None else None
+        from_ = from_ if from_ is not None else options.get('from')
+        from_ = int(from_) if from_ is not None else None
+        try:
+            if scroll is None:
+                return engine.search(body, size=size, from_=from_)
+            response = engine.search(body, size=engine.count(), from_=0)
+        except (KeyError, ValueError, TypeError) as ex:
+            raise transport_error(400, 'parsing_exception', str(ex))
+
+        with self.lock:
+            self._purge_scrolls()
+            scroll_id = uuid.uuid4().hex
+            self.scrolls[scroll_id] = {
+                'hits': response['hits']['hits'],
+                'total': response['hits']['total'],
+                'max_score': response['hits']['max_score'],
+                'size': size if size is not None else (body or {}).get('size', 10),
+                'expires': time.time() + keep_alive_seconds(scroll)
+            }
+            page = self._scroll_page(scroll_id)
+        if 'aggregations' in response:
+            page['aggregations'] = response['aggregations']
+        return page
+
+    @client_method
+    def scroll(self, body=None, scroll_id=None, scroll=None, **options):
+        body = body or {}
+        scroll_id = scroll_id or body.get('scroll_id')
+        scroll = scroll or body.get('scroll')
+        with self.lock:
+            self._purge_scrolls()
+            if scroll_id not in self.scrolls:
+                raise transport_error(404, 'search_context_missing_exception', "No search context found")
+            if scroll:
+                self.scrolls[scroll_id]['expires'] = time.time() + keep_alive_seconds(scroll)
+            return self._scroll_page(scroll_id)
+
+    @client_method
+    def clear_scroll(self, body=None, scroll_id=None, **options):
+        scroll_ids = scroll_id or (body or {}).get('scroll_id', [])
+        if isinstance(scroll_ids, str):
+            scroll_ids = scroll_ids.split(',')
+        with self.lock:
+            if '_all' in scroll_ids:
+                scroll_ids = list(self.scrolls)
+            freed = [self.scrolls.pop(key) for key in scroll_ids if key in self.scrolls]
+        if scroll_ids and not freed:
+            raise transport_error(404, 'search_context_missing_exception', "No search context found")
+        return {'succeeded': True, 'num_freed': len(freed)}
+
+    @client_method
+    def count(self, body=None, index=None, doc_type=None, **options):
+        response = self.search(body={'query': (body or {}).get('query', {'match_all': {}})}, index=index, size=0)
+        return {'count': response['hits']['total'], '_shards': self._shards()}
+
+    @client_method
+    def msearch(self, body, index=None, doc_type=None, **options):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        if isinstance(body, str):
+            body = [json.loads(line) for line in body.splitlines() if line.strip()]
+        responses = []
+        for header, search_body in zip(body[::2], body[1::2]):
+            try:
+                response = self.search(body=search_body, index=header.get('index', index))
+                response['status'] = 200
+            except TransportError as ex:
+                response = {'error': ex.info['error'] if isinstance(ex.info, dict) else ex.info,
+                            'status': ex.status_code}
+            responses.append(response)
+        return {'took': 0, 'responses': responses}
+
+    @client_method
+    def get_source(self, index, id, doc_type=None, **options):
+        engine = self.engine(index)
+        doc = engine.get(id)
+        if doc is None:
+            raise NotFoundError(404, 'not_found', {'_index': self.resolve(index), '_type': doc_type, '_id': str(id),
+                                                   'found': False})
+        return engine.filter_source(doc['_source'], self._source_spec(options))
+
+    @client_method
+    def mget(self, body, index=None, doc_type=None, **options):
+        """Books are fetched by ids, or by docs when some of them have their own _source filtering"""
+        source_spec = self._source_spec(options)
+        docs = []
+        for item in body.get('docs') or [{'_id': doc_id} for doc_id in body['ids']]:
+            doc_id = item['_id']
+            doc = self.engine(index).get(doc_id)
+            if doc is None:
+                docs.append({'_index': self.resolve(index),
+                             '_type': doc_type or self.engine(index).settings.get('doc_type', '_doc'),
+                             '_id': str(doc_id), 'found': False})
+            else:
+                docs.append(self._doc(index, doc_type, doc, item.get('_source', source_spec)))
+        return {'docs': docs}
+
+    @client_method
+    def index(self, index, body, doc_type=None, id=None, op_type=None, version=None, version_type=None, **options):
+        try:
+            result = self.engine(index, create=True).index(body, doc_id=id, op_type=op_type or 'index',
+                                                           version=version, version_type=version_type)
+        except DocumentConflict as ex:
+            raise transport_error(409, 'version_conflict_engine_exception', str(ex))
+        return self._write_response(index, doc_type, result)
+
+    @client_method
+    def delete(self, index, id, doc_type=None, **options):
+        try:
+            result = self.engine(index).delete(id)
+        except KeyError:
+            raise NotFoundError(404, 'not_found', {'_index': index, '_type': doc_type, '_id': str(id),
+                                                   'result': 'not_found'})
+        return self._write_response(index, doc_type, result)
+
+    @client_method
+    def update(self, index, id, body, doc_type=None, **options):
+        """Only BOOK_DELETE_SCRIPT is run by the update API, books are updated by query"""
+        if self._script_source(body.get('script')) != BOOK_DELETE_SCRIPT:
+            raise transport_error(400, 'illegal_argument_exception',
+                                  "only the book delete script can run on the embedded backend")
+        engine = self.engine(index)
+        with engine.lock:
+            doc = engine.get(id)
+            if doc is None:
+                raise transport_error(404, 'document_missing_exception', "[{}]: document missing".format(id))
+            response = self._write_response(index, doc_type, engine.delete(id))
+        if not is_false(options.get('_source', False)):
+            response['get'] = {'found': True, '_source': doc['_source']}
+        return response
+
+    @client_method
+    def bulk(self, body, index=None, doc_type=None, **options):
+        start = time.time()
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        if isinstance(body, str):
+            body = [json.loads(line) for line in body.splitlines() if line.strip()]
+        lines = iter(body)
+        items, errors = [], False
+        for action in lines:
+            op, meta = next(iter(action.items()))
+            doc_index, doc_id = meta.get('_index', index), meta.get('_id')
+            doc_type_name = meta.get('_type', doc_type)
+            source = next(lines) if op in ('index', 'create') else None
+            try:
+                if op in ('index', 'create'):
+                    item = self.index(doc_index, source, doc_type=doc_type_name, id=doc_id, op_type=op,
+                                      version=meta.get('version', meta.get('_version')),
+                                      version_type=meta.get('version_type', meta.get('_version_type')))
+                    status = 201 if item['result'] == 'created' else 200
+                elif op == 'delete':
+                    item = self.delete(doc_index, doc_id, doc_type=doc_type_name)
+                    status = 200
+                else:
+                    raise transport_error(400, 'illegal_argument_exception', "Malformed action [{}]".format(op))
+                item['status'] = status
+            except TransportError as ex:
+                errors = True
+                error = ex.info.get('error', ex.error) if isinstance(ex.info, dict) else ex.error
+                item = {'_index': doc_index, '_type': doc_type_name, '_id': doc_id, 'status': ex.status_code,
+                        'error': error}
+            items.append({op: item})
+        return {'took': int((time.time() - start) * 1000), 'errors': errors, 'items': items}
+
+    def _script_source(self, script):
+        """
+        This function is used to read the source of an inline or stored script
+
+        :param script: script, None when the request has none
+        :return: stripped script source
+        """
+        if script is None:
+            return None
+        if isinstance(script, str):
+            script = {'source': script}
+        source = script.get('source')
+        if 'id' in script:
+            stored = self.scripts.get(script['id'])
+            if stored is None:
+                raise transport_error(404, 'resource_not_found_exception',
+                                      "unable to find script [{}]".format(script['id']))
+            source = stored['source']
+        return (source or '').strip()
+
+    def _script_update(self, script):
+        """
+        This function is used to turn an update script into a function updating a document source.
+        Painless is not available in-process: BOOK_UPDATE_SCRIPT, inline or stored, is run by apply_book_updates.
+
+        :param script: update script
+        :return: function changing a source in place
+        """
+        source = self._script_source(script)
+        if source != BOOK_UPDATE_SCRIPT.strip():
+            raise transport_error(400, 'illegal_argument_exception',
+                                  "only the book update script can run on the embedded backend")
+        updates = script.get('params', {}).get('updates', [])
+        return lambda doc: apply_book_updates(doc, updates)
+
+    def _by_query_response(self, response, options, api, description, start):
+        """
+        This function is used to answer a by query request, or to record it as a completed task
+        when it was sent with wait_for_completion=false
+
+        :param response: by query response
+        :param options: request options
+        :param api: delete_by_query, update_by_query or reindex
+        :param description: task description
+        :param start: request start time
+        :return: response, or the task id
+        """
+        if not is_false(options.get('wait_for_completion', True)):
+            return response
+        # the task status has every counter and no took, timed_out or failures
+        status = dict({'created': 0, 'updated': 0, 'deleted': 0}, **{
+            key: value for key, value in response.items() if key not in ('took', 'timed_out', 'failures')})
+        with self.lock:
+            self.task_counter += 1
+            task_id = 'embedded:{}'.format(self.task_counter)
+            self.task_results[task_id] = {
+                'completed': True,
+                'task': {
+                    'node': 'embedded',
+                    'id': self.task_counter,
+                    'type': 'transport',
+                    'action': BY_QUERY_ACTIONS[api],
+                    'status': status,
+                    'description': description,
+                    'start_time_in_millis': int(start * 1000),
+                    'running_time_in_nanos': int((time.time() - start) * 1e9),
+                    'cancellable': True,
+                    'headers': {}
+                },
+                'response': response
+            }
+        return {'task': task_id}
+
+    @staticmethod
+    def _by_query_stats(start, total, noops=0, **counts):
+        """
+        This function is used to build a by query response
+
+        :param start: request start time
+        :param total: number of matched documents
+        :param noops: number of documents left unchanged
+        :param counts: the created, updated and deleted counts the API reports
+        :return: by query response
+        """
+        stats = {'took': int((time.time() - start) * 1000), 'timed_out': False, 'total': total}
+        stats.update(counts)
+        stats.update({
+            'batches': 1,
+            'version_conflicts': 0,
+            'noops': noops,
+            'retries': {'bulk': 0, 'search': 0},
+            'throttled_millis': 0,
+            'requests_per_second': -1.0,
+            'throttled_until_millis': 0,
+            'failures': []
+        })
+        return stats
+
+    @client_method
+    def delete_by_query(self, index, body, doc_type=None, **options):
+        start = time.time()
+        try:
+            deleted = self.engine(index).delete_by_query(body.get('query'))
+        except (KeyError, ValueError, TypeError) as ex:
+            raise transport_error(400, 'parsing_exception', str(ex))
+        return self._by_query_response(self._by_query_stats(start, deleted, deleted=deleted), options,
+                                       'delete_by_query', 'delete-by-query [{}]'.format(index), start)
+
+    @client_method
+    def update_by_query(self, index, body=None, doc_type=None, **options):
+        start = time.time()
+        body = body or {}
+        update = self._script_update(body['script']) if 'script' in body else (lambda doc: None)
+        try:
+            updated, noops = self.engine(index).update_by_query(body.get('query'), update)
+        except (KeyError, ValueError, TypeError) as ex:
+            raise transport_error(400, 'parsing_exception', str(ex))
+        return self._by_query_response(self._by_query_stats(start, updated + noops, noops, updated=updated, deleted=0),
+                                       options, 'update_by_query', 'update-by-query [{}]'.format(index), start)
+
+    @client_method
+    def reindex(self, body, **options):
+        """
+        Copies the documents matching source.query into dest.index. With dest.version_type external the
+        source versions are kept and documents the destination already has in a newer version are counted
+        as version conflicts; conflicts abort the copy unless conflicts is proceed. Slices are accepted
+        and run as one. The only script it runs is the book id copy.
+        """
+        start = time.time()
+        source, dest = body['source'], body['dest']
+        script = self._script_source(body.get('script'))
+        if script not in (None, BOOK_ID_SCRIPT):
+            raise transport_error(400, 'illegal_argument_exception',
+                                  "only the book id script can run on the embedded backend")
+        source_engine = self.engine(source['index'])
+        dest_engine = self.engine(dest['index'], create=True)
+        version_type = dest.get('version_type')
+        op_type = dest.get('op_type', 'index')
+        try:
+            ids = source_engine.matching_ids(source.get('query'))
+        except (KeyError, ValueError, TypeError) as ex:
+            raise transport_error(400, 'parsing_exception', str(ex))
+
+        response = self._by_query_stats(start, len(ids), created=0, updated=0, deleted=0)
+        for doc_id in ids:
+            doc = source_engine.get(doc_id)
+            if doc is None:
+                continue
+            try:
+                doc_source = doc['_source'] if script is None else dict(doc['_source'], **{BOOK_ID_FIELD: doc_id})
+                result = dest_engine.index(doc_source, doc_id=doc_id, op_type=op_type,
+                                           version=doc['_version'], version_type=version_type)
+            except DocumentConflict as ex:
+                response['version_conflicts'] += 1
+                if body.get('conflicts') != 'proceed':
+                    response['failures'].append({'index': dest['index'], 'id': doc_id, 'status': 409,
+                                                 'cause': {'type': 'version_conflict_engine_exception',
+                                                           'reason': str(ex)}})
+                    break
+                continue
+            response['created' if result['result'] == 'created' else 'updated'] += 1
+        response['took'] = int((time.time() - start) * 1000)
+        return self._by_query_response(response, options, 'reindex',
+                                       'reindex from [{}] to [{}]'.format(source['index'], dest['index']), start)
+
+    @client_method
+    def put_script(self, id, body, context=None, **options):
+        with self.lock:
+            self.scripts[id] = body['script']
+            with open(self.scripts_path + '.tmp', 'w') as f:
+                json.dump(self.scripts, f)
+            os.replace(self.scripts_path + '.tmp', self.scripts_path)
+        return {'acknowledged': True}
+
+    def close(self):
+        """This function is used to flush every index and release its files"""
+        with self.lock:
+            for engine in self.engines.values():
+                engine.close()
+            self.engines = {}
+
+
+class EmbeddedTransport(object):
+    """Transport attributes elasticsearch.helpers rely on"""
+
+    def __init__(self):
+        self.serializer = JSONSerializer()
+
+
+class EmbeddedIndicesClient(object):
+    """Indices API of EmbeddedClient"""
+
+    def __init__(self, client):
+        self.client = client
+
+    @client_method
+    def create(self, index, body=None, **options):
+        with self.client.lock:
+            if index in self.client.index_names():
+                raise transport_error(400, 'resource_already_exists_exception',
+                                      "index [{}] already exists".format(index), index=index)
+            if index in self.client.aliases:
+                raise transport_error(400, 'invalid_index_name_exception',
+                                      "Invalid index name [{}], an alias with the same name already exists"
+                                      .format(index), index=index)
+            engine = self.client.engine(index, create=True)
+            body = body or {}
+            mappings = body.get('mappings', {})
+            if mappings and 'properties' not in mappings:
+                doc_type, mappings = next(iter(mappings.items()))
+                engine.settings['doc_type'] = doc_type
+            engine.settings.update(body.get('settings', {}))
+            engine.settings.update(creation_date=int(time.time() * 1000),
+                                   uuid=base64.urlsafe_b64encode(uuid.uuid4().bytes).decode('ascii').rstrip('='))
+            if '_meta' in mappings:
+                engine.settings['_meta'] = mappings['_meta']
+            engine.put_mapping(mappings.get('properties', {}))
+            if body.get('aliases'):
+                self.update_aliases({'actions': [{'add': {'index': index, 'alias': alias}}
+                                                 for alias in body['aliases']]})
+        return {'acknowledged': True, 'shards_acknowledged': True, 'index': index}
+
+    @client_method
+    def delete(self, index, **options):
+        with self.client.lock:
+            index = self.client.resolve(index)
+            engine = self.client.engine(index)
+            engine.close()
+            del self.client.engines[index]
+            shutil.rmtree(engine.path)
+            self._drop_index_aliases(index)
+        return {'acknowledged': True}
+
+    @client_method
+    def exists(self, index, **options):
+        return index in self.client.index_names() or index in self.client.aliases
+
+    def _drop_index_aliases(self, index):
+        for alias in [alias for alias, indices in self.client.aliases.items() if index in indices]:
+            self.client.aliases[alias].remove(index)
+            if not self.client.aliases[alias]:
+                del self.client.aliases[alias]
+        self.client.save_aliases()
+
+    @client_method
+    def get_alias(self, index=None, name=None, **options):
+        names = name.split(',') if isinstance(name, str) else name
+        indices = index.split(',') if isinstance(index, str) else index
+        response = {}
+        for alias, alias_indices in sorted(self.client.aliases.items()):
+            if names and alias not in names:
+                continue
+            for alias_index in alias_indices:
+                if not indices or alias_index in indices:
+                    response.setdefault(alias_index, {'aliases': {}})['aliases'][alias] = {}
+        if names and not response:
+            raise transport_error(404, 'aliases_not_found_exception', "alias [{}] missing".format(name))
+        return response
+
+    @client_method
+    def exists_alias(self, name, index=None, **options):
+        try:
+            return bool(self.get_alias(index=index, name=name))
+        except NotFoundError:
+            return False
+
+    @client_method
+    def update_aliases(self, body, **options):
+        """Applies add, remove and remove_index actions atomically: all of them or none"""
+        with self.client.lock:
+            aliases = {alias: list(indices) for alias, indices in self.client.aliases.items()}
+            removed = []
+            existing = set(self.client.index_names())
+            for action in body['actions']:
+                op, spec = next(iter(action.items()))
+                index = spec.get('index')
+                if index not in existing or index in removed:
+                    raise index_not_found(index)
+                if op == 'remove_index':
+                    removed.append(index)
+                    for alias in aliases:
+                        aliases[alias] = [name for name in aliases[alias] if name != index]
+                    continue
+                alias = spec['alias']
+                if op == 'add':
+                    if alias in existing and alias not in removed:
+                        raise transport_error(400, 'invalid_alias_name_exception',
+                                              "Invalid alias name [{}], an index exists with the same name as "
+                                              "the alias".format(alias), index=alias)
+                    if index not in aliases.setdefault(alias, []):
+                        aliases[alias].append(index)
+                elif op == 'remove':
+                    if index not in aliases.get(alias, []):
+                        raise transport_error(404, 'aliases_not_found_exception', "aliases [{}] missing"
+                                              .format(alias))
+                    aliases[alias].remove(index)
+                else:
+                    raise transport_error(400, 'illegal_argument_exception', "Unsupported action [{}]".format(op))
+
+            for index in removed:
+                engine = self.client.engine(index)
+                engine.close()
+                del self.client.engines[index]
+                shutil.rmtree(engine.path)
+            self.client.aliases = {alias: indices for alias, indices in aliases.items() if indices}
+            self.client.save_aliases()
+        return {'acknowledged': True}
+
+    @client_method
+    def refresh(self, index=None, **options):
+        return {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    @client_method
+    def forcemerge(self, index=None, max_num_segments=1, **options):
+        for name in [index] if index else self.client.index_names():
+            self.client.engine(name).force_merge(int(max_num_segments))
+        return {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    @client_method
+    def get_mapping(self, index, doc_type=None, **options):
+        engine = self.client.engine(index)
+        mapping = {'properties': engine.properties}
+        if '_meta' in engine.settings:
+            mapping['_meta'] = engine.settings['_meta']
+        return {self.client.resolve(index): {'mappings': {engine.settings.get('doc_type', '_doc'): mapping}}}
+
+    @client_method
+    def get_settings(self, index=None, name=None, **options):
+        response = {}
+        for index_name in [self.client.resolve(index)] if index else self.client.index_names():
+            settings = self.client.engine(index_name).settings
+            index_settings = {key: value for key, value in settings.items() if key not in ('doc_type', '_meta')}
+            index_settings.setdefault('number_of_shards', 1)
+            index_settings.setdefault('number_of_replicas', 1)
+            # indices created by a write have no creation date or uuid
+            index_settings.setdefault('creation_date', 0)
+            index_settings.setdefault('uuid', '_na_')
+            index_settings.update(provided_name=index_name, version={'created': ES_VERSION_ID})
+            response[index_name] = {'settings': {'index': setting_strings(index_settings)}}
+        return response
+
+    @client_method
+    def put_settings(self, body, index=None, **options):
+        """Index settings are kept with the index, an embedded index is always refreshed and never replicated"""
+        for index_name in [self.client.resolve(index)] if index else self.client.index_names():
+            engine = self.client.engine(index_name)
+            with engine.lock:
+                for key, value in body.get('index', body).items():
+                    if value is None:
+                        engine.settings.pop(key, None)
+                    else:
+                        engine.settings[key] = value
+        return {'acknowledged': True}
+
+
+class EmbeddedClusterClient(object):
+    """Cluster API of EmbeddedClient"""
+
+    def __init__(self, client):
+        self.client = client
+
+    @client_method
+    def health(self, index=None, **options):
+        shards = len(self.client.index_names())
+        return {
+            'cluster_name': 'embedded',
+            'status': 'green',
+            'timed_out': False,
+            'number_of_nodes': 1,
+            'number_of_data_nodes': 1,
+            'active_primary_shards': shards,
+            'active_shards': shards,
+            'relocating_shards': 0,
+            'initializing_shards': 0,
+            'unassigned_shards': 0,
+            'delayed_unassigned_shards': 0,
+            'number_of_pending_tasks': 0,
+            'number_of_in_flight_fetch': 0,
+            'task_max_waiting_in_queue_millis': 0,
+            'active_shards_percent_as_number': 100.0
+        }
+
+    @client_method
+    def stats(self, **options):
+        stats = [self.client.engine(name).stats() for name in self.client.index_names()]
+        return {
+            'cluster_name': 'embedded',
+            'status': 'green',
+            'indices': {
+                'count': len(stats),
+                'shards': {'total': len(stats), 'primaries': len(stats)},
+                'docs': {'count': sum(s['docs']['count'] for s in stats),
+                         'deleted': sum(s['docs']['deleted'] for s in stats)},
+                'store': {'size_in_bytes': sum(s['store']['size_in_bytes'] for s in stats)},
+                'segments': {'count': sum(s['segments']['count'] for s in stats)}
+            },
+            'nodes': {'count': {'total': 1, 'data': 1}}
+        }
+
+
+class EmbeddedTasksClient(object):
+    """Tasks API of EmbeddedClient, by query requests run synchronously and are reported as completed tasks"""
+
+    def __init__(self, client):
+        self.client = client
+
+    @client_method
+    def get(self, task_id=None, **options):
+        if task_id not in self.client.task_results:
+            raise transport_error(404, 'resource_not_found_exception', "task [{}] isn't running".format(task_id))
+        return self.client.task_results[task_id]
+
+
+def get_embedded_client():
+    """
+    This function is used to return the process wide EmbeddedClient, created once per process
+    like connection.get_client, so the index files are only opened by one engine
+
+    :return: EmbeddedClient
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _client = EmbeddedClient()
+                _client_pid = pid
+    return _client
+
+
+class EmbeddedBookStorage(ElasticBookStorage):
+    """
+    ElasticBookStorage running on the pure-Python EmbeddedClient instead of an elasticsearch cluster.
+    Every query method is inherited unchanged: they hand their request bodies to self.es, which answers
+    them in-process, so queries cost no network round trip. Enabled with STORAGE_BACKEND = "embedded".
+
+    :Example:
+        >>> elk = EmbeddedBookStorage()
+        >>> elk.create_book_index()
+        >>> books = elk.fuzzy_queries("comprihensiv guide", fields=["title", "summary"])
+    """
+
+    def __init__(self):
+        self.book_index = ELASTIC_INDEX
+        self.book_doc = ELASTIC_DOC
+        self.ELK_HOSTNAME = ELASTIC_HOSTNAME
+        self.ELK_PORT = ELASTIC_PORT
+
+        self.es = get_embedded_client()
+        # documents are in process memory already
+        self.documents = None
+        self.write_behind = make_write_behind(self.es, self.book_index, self.book_doc, id_field=BOOK_ID_FIELD)
+
+    def close(self):
+        """This function is used to send the queued writes and flush the embedded indices to disk"""
+        if self.write_behind is not None:
+            self.write_behind.close()
+        self.es.close()
@@ -0,0 +1,212 @@
+import csv
+import gzip
+import io
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import record_error
+from settings import COLUMNS, EXPORT_DIR, EXPORT_WORKERS, EXPORT_RETENTION
+
+FILE_TYPES = ('csv', 'ndjson')
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def open_export_file(path, compression='none'):
+    """
+    This function is used to open a text file for writing, optionally compressed
+
+    :param path: file path
+    :param compression: none, gzip or zstd
+    :return: writable text file object
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    if compression == 'zstd':
+        import zstandard
+
+        writer = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+        return io.TextIOWrapper(writer, encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def csv_row(book):
+    """
+    This function is used to flatten a book to a CSV row, joining the authors with |
+
+    :param book: book source
+    :return: CSV row
+    """
+    row = {column: book.get(column) for column in COLUMNS}
+    if isinstance(row['authors'], list):
+        row['authors'] = "|".join(row['authors'])
+    return row
+
+
+def write_rows(books, f, file_type):
+    """
+    This function is used to write books to a file one at a time, so any number
+    of books is written in constant memory. The books are not modified.
+
+    :param books: iterable of book sources
+    :param f: writable text file object
+    :param file_type: csv or ndjson
+    :return: number of written rows
+
+    Example:
+        >>> with open("books.csv", "w", newline="") as f:
+        ...     write_rows(books, f, "csv")
+    """
+    count = 0
+    if file_type == 'csv':
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        for book in books:
+            writer.writerow(csv_row(book))
+            count += 1
+    elif file_type == 'ndjson':
+        for book in books:
+            f.write(json.dumps(book) + "\n")
+            count += 1
+    else:
+        raise ValueError("file type {} is not supported".format(file_type))
+    return count
+
+
+class ExportManager(object):
+    """
+    Runs exports as background jobs. Each job streams the hits of an action through the
+    scroll API straight into a (compressed) CSV/NDJSON file. Job status is kept as a JSON
+    file next to the export, so any gunicorn worker can report on or serve any job.
+    Jobs finished more than retention seconds ago are deleted when a new job is submitted.
+    """
+
+    def __init__(self, builder, export_dir=EXPORT_DIR, workers=EXPORT_WORKERS, retention=EXPORT_RETENTION):
+        self.builder = builder
+        self.export_dir = export_dir
+        self.retention = retention
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        os.makedirs(export_dir, exist_ok=True)
+
+    def _status_path(self, job_id):
+        return os.path.join(self.export_dir, "{}.json".format(job_id))
+
+    def _save_status(self, status):
+        path = self._status_path(status['job_id'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(status, f)
+        os.replace(path + '.tmp', path)
+
+    def status(self, job_id):
+        """
+        This function is used to return the status of an export job
+
+        :param job_id: job id
+        :return: job status or None for unknown jobs
+        """
+        try:
+            with open(self._status_path(uuid.UUID(job_id).hex)) as f:
+                return json.load(f)
+        except (ValueError, OSError):
+            return None
+
+    def file_path(self, job_id):
+        """
+        This function is used to return the exported file of a finished job
+
+        :param job_id: job id
+        :return: file path or None when the job is unknown or not finished
+        """
+        status = self.status(job_id)
+        if status is None or status['state'] != 'done':
+            return None
+        return os.path.join(self.export_dir, status['file_name'])
+
+    def cleanup(self):
+        """
+        This function is used to delete the files and status of the jobs finished more than retention seconds ago
+
+        :return: number of deleted jobs
+        """
+        deleted = 0
+        expired = time.time() - self.retention
+        for name in os.listdir(self.export_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.export_dir, name)) as f:
+                    status = json.load(f)
+                if status['finished'] is None or status['finished'] > expired:
+                    continue
+                for path in (status['file_name'], status['file_name'] + '.part', name):
+                    try:
+                        os.remove(os.path.join(self.export_dir, path))
+                    except FileNotFoundError:
+                        pass
+                deleted += 1
+            except (ValueError, KeyError, OSError) as ex:
+                record_error(ex)
+        return deleted
+
+    def submit(self, action, payload, file_type='ndjson', compression='none'):
+        """
+        This function is used to start an export job in the background
+
+        :param action: action to export
+        :param payload: action payload
+        :param file_type: csv or ndjson
+        :param compression: none, gzip or zstd
+        :return: job status
+
+        Example:
+            >>> exports = ExportManager(QueryBuilder())
+            >>> job = exports.submit('fetch_all', {}, file_type='csv', compression='gzip')
+        """
+        if file_type not in FILE_TYPES:
+            raise ValueError("file type {} is not supported".format(file_type))
+        if compression not in COMPRESSIONS:
+            raise ValueError("compression {} is not supported".format(compression))
+
+        self.cleanup()
+        job_id = uuid.uuid4().hex
+        status = {
+            'job_id': job_id,
+            'action': action,
+            'state': 'pending',
+            'file_name': "{}_{}.{}{}".format(action, job_id, file_type, COMPRESSIONS[compression]),
+            'rows': 0,
+            'error': None,
+            'submitted': time.time(),
+            'finished': None
+        }
+        self._save_status(status)
+        # the job updates its own copy, the submitted status is returned as it was saved
+        self.executor.submit(self._run, dict(status), payload, file_type, compression)
+        return status
+
+    def _run(self, status, payload, file_type, compression):
+        path = os.path.join(self.export_dir, status['file_name'])
+        try:
+            status['state'] = 'running'
+            self._save_status(status)
+
+            results = self.builder.command(action=status['action'], payload=dict(payload, stream=True))
+            if results is None:
+                raise ValueError("action {} returned no results".format(status['action']))
+            if isinstance(results, dict):
+                books = results['docs'] if 'docs' in results else [results]
+            else:
+                books = (self.builder.hit_source(book) for book in results)
+
+            with open_export_file(path + '.part', compression) as f:
+                status['rows'] = write_rows(books, f, file_type)
+            os.replace(path + '.part', path)
+            status['state'] = 'done'
+        except Exception as ex:
+            record_error(ex)
+            status['state'] = 'failed'
+            status['error'] = "{}: {}".format(type(ex).__name__, ex)
+        status['finished'] = time.time()
+        self._save_status(status)
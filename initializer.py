@@ -1,5 +1,9 @@
 #  This file is used to initialize ElasticSearch with Data
-from storage_client import ElasticBookStorage
+#  Usage: python initializer.py [books.ndjson]
+import logging
+import sys
+
+from storage_client import make_storage
 
 # https://www.kaggle.com/ymaricar/cmu-book-summary-dataset
 
@@ -169,9 +173,16 @@ DATA = [
 
 
 if __name__ == "__main__":
-    elk = ElasticBookStorage()
+    # the ingest and bulk load reports are logged
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    elk = make_storage()
     elk.create_book_index()
 
-    elk.bulk_insert(data=DATA)
+    if len(sys.argv) > 1:
+        elk.bulk_insert(data=sys.argv[1], bulk_load=True)
+    else:
+        # the seed keeps positional ids, so running it again (on every container start) replaces it
+        elk.bulk_insert(data=DATA, bulk_load=True, first_id=0)
 
 
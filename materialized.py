@@ -0,0 +1,226 @@
+import threading
+import time
+
+from settings import MATERIALIZED_TTL, MATERIALIZED_MAX_BUCKETS
+
+
+class MaterializedAggregates(object):
+    """
+    Catalog-wide aggregates (books and reviews per publisher, books per year, num_reviews stats)
+    computed once with a single aggregation request and then kept up to date in memory:
+    created, removed and bulk inserted books are applied incrementally, by query writes force
+    a full recompute. Reads return the last published view without any request.
+
+    A recompute refreshes the index first, so every acknowledged write is counted. Writes applied while
+    a recompute is running are not known to be in its snapshot or not: they are not applied, the
+    recomputed view expires right away instead.
+
+    Every process keeps its own aggregates, writes served by other gunicorn workers are picked up
+    by the full recompute done once the view is older than ttl seconds.
+
+    :Example:
+        >>> materialized = MaterializedAggregates(ElasticBookStorage())
+        >>> materialized.get()['books_per_year']['2015']
+        4
+    """
+
+    def __init__(self, storage, ttl=MATERIALIZED_TTL):
+        self.storage = storage
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.rebuild_lock = threading.Lock()
+        self.view = None
+        self.expires = 0
+        self.rebuilding = False
+        self.stale = False
+        self.books = 0
+        self.publishers = {}
+        self.years = {}
+        self.reviews = {'count': 0, 'sum': 0, 'min': None, 'max': None}
+
+    def get(self):
+        """
+        This function is used to read the aggregates, recomputed first when they are missing or expired
+
+        :return: {'books', 'reviews_per_publisher', 'books_per_year', 'num_reviews'}, shared and read only
+        """
+        view = self.view
+        if view is None or self.expires < time.time():
+            with self.rebuild_lock:
+                if self.view is None or self.expires < time.time():
+                    self.rebuild()
+                view = self.view
+        return view
+
+    def rebuild(self):
+        """
+        This function is used to recompute every aggregate from the book index, once refreshed.
+        The requests run outside the lock, writes applied meanwhile mark the result stale (see _applicable).
+        """
+        body = {
+            "aggs": {
+                "publishers": {
+                    "terms": {"field": "publisher.keyword", "size": MATERIALIZED_MAX_BUCKETS},
+                    "aggs": {"reviews": {"sum": {"field": "num_reviews"}}}
+                },
+                "years": {"date_histogram": {"field": "publish_date", "interval": "year", "min_doc_count": 1}},
+                "reviews": {"stats": {"field": "num_reviews"}}
+            }
+        }
+        with self.lock:
+            self.rebuilding, self.stale = True, False
+        try:
+            expires = time.time() + self.ttl
+            self.storage.es.indices.refresh(index=self.storage.book_index)
+            books = self.storage.es.count(index=self.storage.book_index)['count']
+            aggregations = self.storage._aggregate(body)
+        except Exception:
+            with self.lock:
+                self.rebuilding = False
+            raise
+        with self.lock:
+            self.rebuilding = False
+            self.books = books
+            self.publishers = {
+                bucket['key']: {'books': bucket['doc_count'], 'reviews': bucket['reviews']['value'] or 0}
+                for bucket in aggregations['publishers']['buckets']
+            }
+            self.years = {bucket['key_as_string'][:4]: bucket['doc_count']
+                          for bucket in aggregations['years']['buckets']}
+            stats = aggregations['reviews']
+            self.reviews = {'count': stats['count'], 'sum': stats['sum'] or 0, 'min': stats['min'],
+                            'max': stats['max']}
+            self.expires = 0 if self.stale else expires
+            self._publish()
+
+    def invalidate(self):
+        """This function is used to force a full recompute on the next read"""
+        with self.lock:
+            self.expires = 0
+            self.stale = self.rebuilding
+
+    def _applicable(self):
+        """
+        This function is used to tell whether a write can be applied incrementally, the lock must be held.
+        During a recompute the write may or may not be in its snapshot, the recomputed view is marked stale.
+
+        :return: boolean
+        """
+        if self.rebuilding:
+            self.stale = True
+            return False
+        return self.view is not None
+
+    @staticmethod
+    def _keys(book):
+        publisher = book.get('publisher')
+        publish_date = book.get('publish_date')
+        return (
+            publisher.lower() if isinstance(publisher, str) else None,
+            str(publish_date)[:4] if publish_date else None,
+            book.get('num_reviews')
+        )
+
+    def add(self, books):
+        """
+        This function is used to apply created books to the aggregates
+
+        :param books: list of book sources
+        """
+        with self.lock:
+            if not self._applicable():
+                return
+            for book in books:
+                publisher, year, reviews = self._keys(book)
+                self.books += 1
+                if publisher is not None:
+                    counts = self.publishers.setdefault(publisher, {'books': 0, 'reviews': 0})
+                    counts['books'] += 1
+                    counts['reviews'] += reviews or 0
+                if year is not None:
+                    self.years[year] = self.years.get(year, 0) + 1
+                if reviews is not None:
+                    self.reviews['count'] += 1
+                    self.reviews['sum'] += reviews
+                    self.reviews['min'] = reviews if self.reviews['min'] is None else min(self.reviews['min'], reviews)
+                    self.reviews['max'] = reviews if self.reviews['max'] is None else max(self.reviews['max'], reviews)
+            self._publish()
+
+    def remove(self, book):
+        """
+        This function is used to apply a removed book to the aggregates. Removing the book holding the
+        min or max num_reviews forces a full recompute, the next extreme is not known in memory.
+
+        :param book: source of the removed book
+        """
+        with self.lock:
+            if not self._applicable():
+                return
+            publisher, year, reviews = self._keys(book)
+            self.books -= 1
+            if publisher in self.publishers:
+                counts = self.publishers[publisher]
+                counts['books'] -= 1
+                counts['reviews'] -= reviews or 0
+                if counts['books'] <= 0:
+                    del self.publishers[publisher]
+            if year in self.years:
+                self.years[year] -= 1
+                if self.years[year] <= 0:
+                    del self.years[year]
+            if reviews is not None:
+                self.reviews['count'] -= 1
+                self.reviews['sum'] -= reviews
+                if reviews in (self.reviews['min'], self.reviews['max']):
+                    self.invalidate()
+            self._publish()
+
+    def ingested(self, books, failed):
+        """
+        This function is used as BulkIngestEngine on_indexed callback: batches indexed without failures
+        are applied incrementally, a batch with failures forces a full recompute
+
+        :param books: sources of the batch
+        :param failed: number of failed items of the batch
+        """
+        if failed:
+            self.invalidate()
+        else:
+            self.add(books)
+
+    def apply(self, action, payload, results):
+        """
+        This function is used to apply a QueryBuilder write action to the aggregates
+
+        :param action: write action
+        :param payload: action payload
+        :param results: elasticsearch response of the action, remove_book_by_id carries the removed
+            source in get._source (see ElasticBookStorage.remove_book_doc)
+        """
+        if action == 'append_book':
+            if results and results.get('result') == 'created':
+                self.add([payload])
+        elif action == 'remove_book_by_id':
+            removed = (results or {}).get('get', {}).get('_source')
+            if results and results.get('result') == 'deleted' and removed:
+                self.remove(removed)
+            elif results:
+                self.invalidate()
+        else:
+            self.invalidate()
+
+    def _publish(self):
+        """This function is used to build the view returned by get, once per change"""
+        count = self.reviews['count']
+        self.view = {
+            'books': self.books,
+            'reviews_per_publisher': {publisher: dict(counts) for publisher, counts in self.publishers.items()},
+            'books_per_year': dict(sorted(self.years.items())),
+            'num_reviews': {
+                'count': count,
+                'min': self.reviews['min'] if count else None,
+                'max': self.reviews['max'] if count else None,
+                'avg': self.reviews['sum'] / count if count else None,
+                'sum': self.reviews['sum']
+            }
+        }
@@ -0,0 +1,371 @@
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import time
+
+from elasticsearch import Transport, AsyncTransport
+
+from settings import METRICS_MULTIPROC_DIR, METRICS_LATENCY_BUCKETS, METRICS_HITS_BUCKETS, METRICS_BYTES_BUCKETS
+
+# prometheus_client picks its multiprocess mode at import time
+if METRICS_MULTIPROC_DIR:
+    os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', METRICS_MULTIPROC_DIR)
+    os.environ.setdefault('prometheus_multiproc_dir', METRICS_MULTIPROC_DIR)
+
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, \
+    generate_latest  # noqa: E402
+from prometheus_client import multiprocess  # noqa: E402
+
+logger = logging.getLogger('book_storage.errors')
+
+# action of the request being served, set by ActionTimer so lower layers can label their metrics
+current_action = contextvars.ContextVar('current_action', default='none')
+
+# list collecting the errors recorded while an API request is served, see RecordedErrors
+recorded_errors = contextvars.ContextVar('recorded_errors', default=None)
+
+# list collecting the took (ms) of the elasticsearch responses of the command being served, for the slow query log
+es_took = contextvars.ContextVar('es_took', default=None)
+
+REQUEST_SECONDS = Histogram(
+    'book_storage_request_seconds', 'End to end time of an API request',
+    ['action'], buckets=METRICS_LATENCY_BUCKETS
+)
+COMMAND_SECONDS = Histogram(
+    'book_storage_command_seconds', 'Time spent in QueryBuilder.command',
+    ['action'], buckets=METRICS_LATENCY_BUCKETS
+)
+STORAGE_SECONDS = Histogram(
+    'book_storage_call_seconds', 'Time spent in an ElasticBookStorage method',
+    ['method'], buckets=METRICS_LATENCY_BUCKETS
+)
+ES_REQUEST_SECONDS = Histogram(
+    'book_storage_es_request_seconds', 'Round trip time of an elasticsearch request',
+    ['action', 'endpoint'], buckets=METRICS_LATENCY_BUCKETS
+)
+ES_TOOK_SECONDS = Histogram(
+    'book_storage_es_took_seconds', 'Time elasticsearch reports in the took field of its response',
+    ['action', 'endpoint'], buckets=METRICS_LATENCY_BUCKETS
+)
+ES_OVERHEAD_SECONDS = Histogram(
+    'book_storage_es_overhead_seconds', 'Round trip time minus took: network, queueing and (de)serialization',
+    ['action', 'endpoint'], buckets=METRICS_LATENCY_BUCKETS
+)
+SERIALIZATION_SECONDS = Histogram(
+    'book_storage_serialization_seconds', 'Time spent converting results to the response body',
+    ['action'], buckets=METRICS_LATENCY_BUCKETS
+)
+HITS = Histogram(
+    'book_storage_hits', 'Number of hits returned by an action',
+    ['action'], buckets=METRICS_HITS_BUCKETS
+)
+RESPONSE_BYTES = Histogram(
+    'book_storage_response_bytes', 'Size of the response body of an API request',
+    ['action'], buckets=METRICS_BYTES_BUCKETS
+)
+ERRORS = Counter(
+    'book_storage_errors', 'Errors raised while serving an action, by exception type',
+    ['action', 'exception']
+)
+COALESCED_REQUESTS = Counter(
+    'book_storage_coalesced_requests', 'Reads served by an identical in-flight request instead of elasticsearch',
+    ['action']
+)
+ES_ERRORS = Counter(
+    'book_storage_es_errors', 'Failed elasticsearch requests, by exception type',
+    ['action', 'endpoint', 'exception']
+)
+
+ES_RETRIES = Counter(
+    'book_storage_es_retries', 'Elasticsearch requests retried after a backoff, by reason',
+    ['action', 'endpoint', 'reason']
+)
+HEDGED_REQUESTS = Counter(
+    'book_storage_es_hedged_requests', 'Reads sent a second time to another shard copy, by the copy that answered',
+    ['action', 'endpoint', 'winner']
+)
+CIRCUIT_STATE = Gauge(
+    'book_storage_es_circuit_state', 'Elasticsearch circuit breaker state: 0 closed, 1 half open, 2 open',
+    multiprocess_mode='max'
+)
+CIRCUIT_REJECTIONS = Counter(
+    'book_storage_es_circuit_rejections', 'Elasticsearch requests failed fast while the circuit breaker is open',
+    ['action']
+)
+
+
+def record_error(ex):
+    """
+    This function is used to report an error swallowed by a storage or query method:
+    it is logged to the book_storage.errors logger and counted under the current action
+
+    :param ex: exception
+    """
+    logger.error("%s in %s: %s", type(ex).__name__, current_action.get(), ex)
+    ERRORS.labels(current_action.get(), type(ex).__name__).inc()
+    errors = recorded_errors.get()
+    if errors is not None:
+        errors.append(ex)
+
+
+def forward_errors(errors):
+    """
+    This function is used to record errors swallowed by another caller's call, e.g. the leader of a
+    coalesced call, in the request being served without counting them again
+
+    :param errors: list of exceptions
+    """
+    recorded = recorded_errors.get()
+    if recorded is not None:
+        recorded.extend(errors)
+
+
+def es_endpoint(url):
+    """
+    This function is used to name the elasticsearch endpoint of a request url, without ids
+
+    :param url: request url
+    :return: endpoint name
+
+    Example:
+        >>> es_endpoint('/book_index/_search')
+        '_search'
+        >>> es_endpoint('/book_index/book_doc/AX3b')
+        '_doc'
+        >>> es_endpoint('/_cluster/health')
+        '_cluster/health'
+    """
+    parts = [part for part in url.split('?')[0].split('/') if part]
+    if not parts:
+        return '_root'
+    if parts[0] in ('_cluster', '_nodes', '_cat') and len(parts) > 1:
+        return '/'.join(parts[:2])
+    names = [part for part in parts if part.startswith('_')]
+    return names[-1] if names else '_doc'
+
+
+def response_took(response):
+    """
+    This function is used to read the took of an elasticsearch response in seconds
+
+    :param response: elasticsearch response
+    :return: took in seconds, or None when the response has none
+    """
+    if not isinstance(response, dict):
+        return None
+    if 'took' in response:
+        return response['took'] / 1000.0
+    took = [item['took'] for item in response.get('responses', []) if 'took' in item]
+    return max(took) / 1000.0 if took else None
+
+
+def observe_es_request(url, start, response=None, error=None):
+    """
+    This function is used to record the round trip, took and overhead of an elasticsearch request
+
+    :param url: request url
+    :param start: time.perf_counter() before the request
+    :param response: elasticsearch response
+    :param error: exception raised by the request
+    """
+    seconds = time.perf_counter() - start
+    action, endpoint = current_action.get(), es_endpoint(url)
+    ES_REQUEST_SECONDS.labels(action, endpoint).observe(seconds)
+    if error is not None:
+        ES_ERRORS.labels(action, endpoint, type(error).__name__).inc()
+        return
+    took = response_took(response)
+    if took is not None:
+        ES_TOOK_SECONDS.labels(action, endpoint).observe(took)
+        ES_OVERHEAD_SECONDS.labels(action, endpoint).observe(max(seconds - took, 0.0))
+        tooks = es_took.get()
+        if tooks is not None:
+            tooks.append(round(took * 1000))
+
+
+class InstrumentedTransport(Transport):
+    """Transport recording every elasticsearch request, see observe_es_request"""
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        start = time.perf_counter()
+        try:
+            response = super(InstrumentedTransport, self).perform_request(method, url, headers, params, body)
+        except Exception as ex:
+            observe_es_request(url, start, error=ex)
+            raise
+        observe_es_request(url, start, response)
+        return response
+
+
+class InstrumentedAsyncTransport(AsyncTransport):
+    """Asyncio flavour of InstrumentedTransport"""
+
+    async def perform_request(self, method, url, headers=None, params=None, body=None):
+        start = time.perf_counter()
+        try:
+            response = await super(InstrumentedAsyncTransport, self).perform_request(
+                method, url, headers, params, body)
+        except Exception as ex:
+            observe_es_request(url, start, error=ex)
+            raise
+        observe_es_request(url, start, response)
+        return response
+
+
+class ActionTimer(object):
+    """
+    Context manager timing a block into a histogram labelled by action. The action is the
+    current_action while the block runs and exceptions escaping it are counted as errors.
+
+    :Example:
+        >>> with ActionTimer(COMMAND_SECONDS, 'fetch_all'):
+        ...     results = builder.command('fetch_all', {})
+    """
+
+    def __init__(self, histogram, action):
+        self.histogram = histogram
+        self.action = action or 'none'
+
+    def __enter__(self):
+        self.token = current_action.set(self.action)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.labels(self.action).observe(time.perf_counter() - self.start)
+        if exc is not None:
+            ERRORS.labels(self.action, exc_type.__name__).inc()
+        current_action.reset(self.token)
+        return False
+
+
+class RecordedErrors(object):
+    """
+    Context manager collecting the errors swallowed by record_error while the block runs, so an API
+    request can answer with an error status instead of a null result.
+
+    :Example:
+        >>> with RecordedErrors() as errors:
+        ...     results = builder.command('fetch_all', {})
+        >>> failed = results is None and errors
+    """
+
+    def __enter__(self):
+        self.errors = []
+        self.token = recorded_errors.set(self.errors)
+        return self.errors
+
+    def __exit__(self, exc_type, exc, tb):
+        recorded_errors.reset(self.token)
+        return False
+
+
+def hit_count(results):
+    """
+    This function is used to count the hits of command results
+
+    :param results: command results
+    :return: number of hits, or None when the results are not a hit list
+    """
+    if isinstance(results, dict) and isinstance(results.get('results'), list):
+        results = results['results']
+    return len(results) if isinstance(results, list) else None
+
+
+def observe_results(action, results):
+    """
+    This function is used to record the number of hits returned by an action
+
+    :param action: action name
+    :param results: command results, streamed results are not counted
+    """
+    hits = hit_count(results)
+    if hits is not None:
+        HITS.labels(action).observe(hits)
+
+
+def observe_response(action, start, size):
+    """
+    This function is used to record the serialization time and body size of a response
+
+    :param action: action name
+    :param start: time.perf_counter() before the results were converted
+    :param size: response body size in bytes
+    """
+    SERIALIZATION_SECONDS.labels(action).observe(time.perf_counter() - start)
+    RESPONSE_BYTES.labels(action).observe(size)
+
+
+async def _timed_awaitable(name, start, awaitable):
+    try:
+        return await awaitable
+    finally:
+        STORAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+def timed_method(name, func):
+    """
+    This function is used to time a storage method into STORAGE_SECONDS.
+    Coroutines, and awaitables returned by the async storage, are timed until they complete.
+    Instances with timed_calls = False (SearchRecorder, which only builds requests) are not timed.
+
+    :param name: method name
+    :param func: method
+    :return: timed method
+    """
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                STORAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not self.timed_calls:
+            return func(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            result = func(self, *args, **kwargs)
+        except Exception:
+            STORAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+            raise
+        if inspect.isawaitable(result):
+            return _timed_awaitable(name, start, result)
+        STORAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+        return result
+    return wrapper
+
+
+def timed_storage(cls):
+    """
+    Class decorator timing every public method defined by a storage class
+
+    :param cls: storage class
+    :return: cls
+    """
+    for name, func in list(vars(cls).items()):
+        if not name.startswith('_') and inspect.isfunction(func):
+            setattr(cls, name, timed_method(name, func))
+    return cls
+
+
+def render_metrics():
+    """
+    This function is used to render the metrics in the Prometheus text format.
+    With METRICS_MULTIPROC_DIR the metrics of every worker are aggregated.
+
+    :return: (body, content type)
+    """
+    if METRICS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -18,5 +18,9 @@ echo 'Kibana Initialization completed'
 
 python initializer.py
 
+# gunicorn workers aggregate their metrics through files, stale files of a previous run are dropped
+export METRICS_MULTIPROC_DIR=${METRICS_MULTIPROC_DIR:-/tmp/book_storage_metrics}
+rm -rf "${METRICS_MULTIPROC_DIR}" && mkdir -p "${METRICS_MULTIPROC_DIR}"
+
 echo " Run gunicorn"
 gunicorn --workers=4 -b 0.0.0.0:5000 wsgi:app --reload
\ No newline at end of file
@@ -1,10 +1,95 @@
-from storage_client import ElasticBookStorage
-from utils import prepare_for_save, toJSON, save_json_to_file, save_attr_dict_to_csv
+import json
+import time
+from concurrent.futures import Future
+
+from cache import make_query_cache, cache_key
+from materialized import MaterializedAggregates
+from storage_client import SearchRecorder, SearchPlan, make_storage, profiling
+from settings import MAX_PAGE_SIZE, COMPOSITE_PAGE_SIZE, MATERIALIZED_AGGREGATES, SINGLE_FLIGHT
+from single_flight import SingleFlight
+from slow_queries import SlowQueryLog
+from export import FILE_TYPES, write_rows
+from metrics import ActionTimer, COMMAND_SECONDS, record_error, observe_results, es_took
+from serialization import dumps
+from utils import encode_cursor, decode_cursor
+
+# every action understood by QueryBuilder.command
+ACTIONS = ('append_book', 'retrieve_book_by_id', 'remove_book_by_id', 'search_book_by_parameter', 'fuzzy_queries',
+           'wild_card_query', 'regex_query', 'match_phrase_query', 'match_phrase_prefix', 'term_query',
+           'delete_by_query', 'update_by_query', 'bool_query', 'range_query', 'metric_aggregations',
+           'filter_aggregations', 'reviews_range_aggregation', 'aggregate', 'composite_aggregation',
+           'catalog_aggregates', 'get_task', 'get_cluster_health', 'get_cluster_stats', 'multi_get', 'fetch_all')
+
+# actions whose elasticsearch response is not returned to the caller
+NO_RESULT_ACTIONS = ('append_book', 'remove_book_by_id')
+
+# actions that modify the index and invalidate the query cache
+WRITE_ACTIONS = ('append_book', 'remove_book_by_id', 'update_by_query', 'delete_by_query')
+
+# actions whose results are never cached (catalog_aggregates are served from memory already)
+UNCACHED_ACTIONS = WRITE_ACTIONS + ('get_cluster_health', 'get_cluster_stats', 'get_task', 'catalog_aggregates')
+
+# payload options of delete_by_query and update_by_query
+BY_QUERY_OPTIONS = ('wait_for_completion', 'slices', 'requests_per_second', 'refresh')
+
+# actions answered by the _mget request of a batch
+MGET_ACTIONS = ('multi_get', 'retrieve_book_by_id')
+
+
+def action_label(action):
+    """
+    This function is used to name an action in the metrics, unknown actions share one label
+    so request bodies cannot create new time series
+
+    :param action: requested action
+    :return: metric label
+    """
+    return action if action in ACTIONS else 'unknown'
 
 
 class QueryBuilder(object):
     def __init__(self):
-        self.client = ElasticBookStorage()
+        self.client = make_storage()
+        self.cache = make_query_cache()
+        self.materialized = MaterializedAggregates(self.client) if MATERIALIZED_AGGREGATES else None
+        self.single_flight = SingleFlight() if SINGLE_FLIGHT else None
+        self.slow_queries = SlowQueryLog()
+
+    def is_coalesced(self, action, payload):
+        """
+        This function is used to decide whether concurrent identical requests of an action can share one call
+
+        :param action: parameter
+        :param payload: provided payload
+        :return: boolean
+        """
+        return self.single_flight is not None and action not in WRITE_ACTIONS and \
+            not payload.get('stream') and not payload.get('profile')
+
+    def refreshed(self, action, payload):
+        """
+        This function is used to make a write wait until it is searchable while the query cache is enabled:
+        the cache is invalidated when the write is acknowledged, a search cached before the next refresh
+        would otherwise keep the results from before the write
+
+        :param action: parameter
+        :param payload: provided payload
+        :return: payload, with refresh set to wait_for for writes
+        """
+        if self.cache is None or action not in WRITE_ACTIONS or payload.get('refresh'):
+            return payload
+        return dict(payload, refresh='wait_for')
+
+    def is_cacheable(self, action, payload):
+        """
+        This function is used to decide whether the results of an action can be served from the query cache
+
+        :param action: parameter
+        :param payload: provided payload
+        :return: boolean
+        """
+        return self.cache is not None and action not in UNCACHED_ACTIONS and \
+            not payload.get('stream') and not payload.get('profile')
 
     @staticmethod
     def get_source(results):
@@ -20,16 +105,149 @@ class QueryBuilder(object):
         """
         if results:
             if isinstance(results, list):
-                json_results = [book['_source'] for book in results]
+                json_results = [QueryBuilder.hit_source(book) for book in results]
                 return json_results
+            elif isinstance(results, dict) and 'results' in results and ('next' in results or 'profile' in results):
+                return dict(results, results=QueryBuilder.get_source(results['results']) or [])
             else:
                 return [results]
 
+    @staticmethod
+    def encode_results(results):
+        """
+        This function is used to encode the API response of elasticsearch results to JSON bytes in one pass,
+        with orjson when available (see serialization.dumps), instead of building and re-encoding it with jsonify
+
+        :param results: elasticsearch results
+        :return: JSON bytes
+
+        Example:
+            >>> builder = QueryBuilder()
+            >>> body = builder.encode_results(results)
+        """
+        return dumps(QueryBuilder.get_source(results))
+
+    @staticmethod
+    def hit_source(book):
+        """
+        This function is used to get the returned fields of a single hit: its _source
+        (or its _id and _score when _source is disabled) plus any docvalue fields
+
+        :param book: elasticsearch hit
+        :return: json result
+        """
+        source = book['_source'] if '_source' in book else {'_id': book.get('_id'), '_score': book.get('_score')}
+        if 'fields' in book:
+            source = dict(source, **book['fields'])
+        return source
+
+    @staticmethod
+    def get_projection(payload):
+        """
+        This function is used to read the field projection of a payload. The projection is given as
+            "projection": {"includes": [...], "excludes": [...], "docvalue_fields": [...], "ids_only": true}
+        and is mapped to the elasticsearch _source includes/excludes and docvalue_fields options.
+        ids_only returns only the id and score of every hit.
+
+        :param payload: provided payload
+        :return: projection or None when the payload is not projected
+
+        Example:
+            >>> QueryBuilder.get_projection({'projection': {'includes': ['title']}})
+            {'_source': {'includes': ['title'], 'excludes': []}}
+        """
+        options = payload.get('projection')
+        if not options:
+            return None
+
+        projection = {}
+        if options.get('ids_only'):
+            projection['_source'] = False
+        elif options.get('includes') or options.get('excludes'):
+            projection['_source'] = {
+                'includes': options.get('includes', []),
+                'excludes': options.get('excludes', [])
+            }
+        if options.get('docvalue_fields'):
+            projection['docvalue_fields'] = options['docvalue_fields']
+        return projection or None
+
+    @staticmethod
+    def get_page(payload):
+        """
+        This function is used to read the pagination options of a payload.
+        A page is requested with page_size plus either from or an opaque search_after
+        cursor returned by a previous page.
+
+        :param payload: provided payload
+        :return: page options or None when the payload is not paginated
+
+        Example:
+            >>> QueryBuilder.get_page({'page_size': 10, 'from': 20})
+            {'size': 10, 'from': 20}
+        """
+        if 'page_size' not in payload or payload.get('stream'):
+            return None
+
+        page = {'size': min(int(payload['page_size']), MAX_PAGE_SIZE)}
+        if payload.get('search_after'):
+            page['search_after'] = decode_cursor(payload['search_after'])
+        else:
+            page['from'] = int(payload.get('from', 0))
+        return page
+
+    @staticmethod
+    def paginate(results, payload):
+        """
+        This function is used to add the next page cursors to a page of hits
+
+        :param results: page of hits
+        :param payload: provided payload
+        :return: {'results': hits, 'next': {'page_size', 'from', 'search_after'}}, or the
+            results unchanged when the payload is not paginated.
+            Next cursors are None on the last page.
+        """
+        page = QueryBuilder.get_page(payload)
+        if page is None or not isinstance(results, list):
+            return results
+
+        more = len(results) == page['size']
+        return {
+            'results': results,
+            'next': {
+                'page_size': page['size'],
+                'from': page['from'] + len(results) if more and 'from' in page else None,
+                'search_after': encode_cursor(results[-1]['sort']) if more and 'sort' in results[-1] else None
+            }
+        }
+
+    @staticmethod
+    def stream_source(results):
+        """
+        This function is used to lazily convert elasticsearch results to NDJSON lines.
+        Hits are consumed one at a time so streamed results are never held in memory.
+
+        :param results: elasticsearch response or hits generator
+        :return: generator of NDJSON lines
+
+        Example:
+            >>> builder = QueryBuilder()
+            >>> lines = builder.stream_source(builder.command(action='fetch_all', payload={'stream': True}))
+        """
+        if results is None:
+            return
+        if isinstance(results, dict):
+            yield json.dumps(results) + "\n"
+            return
+        for book in results:
+            yield json.dumps(QueryBuilder.hit_source(book)) + "\n"
+
     @staticmethod
     def save_results(results, file_name, file_type):
         """
         This function saves elastic search results to file.
-        The supported types are: csv, json, pickle
+        The supported types are: csv, json, ndjson.
+        For large result sets use the background ExportManager instead.
 
         :param results: elasticsearch results
         :param file_name: file name to store
@@ -39,21 +257,41 @@ class QueryBuilder(object):
             >>> builder = QueryBuilder()
             >>> builder.save_results(results, "results", "csv")
         """
-        prepared_data = prepare_for_save(results)  # modify actors field
         file = "{}.{}".format(file_name, file_type)
 
         if file_type == "json":
-            jsonified_data = toJSON(prepared_data)  # jsonify data from ELK
-            save_json_to_file(jsonified_data, file)
+            with open(file, 'w') as f:
+                json.dump(results, f)
 
-        elif file_type == "csv":
-            save_attr_dict_to_csv(prepared_data, file)  # save data as CSV
+        elif file_type in FILE_TYPES:
+            with open(file, 'w', newline='') as f:
+                write_rows(results, f, file_type)
         else:
             print("this type is not supported")
 
+    @staticmethod
+    def with_profile(results, profiles):
+        """
+        This function is used to add the profile sections of the searches of a profiled command to its results
+
+        :param results: command results
+        :param profiles: profile section of every search response, None when the command is not profiled
+        :return: results unchanged when not profiled or failed, else {'results': results, 'profile': profiles}
+            (a page keeps its next cursors)
+        """
+        if profiles is None or results is None:
+            return results
+        if isinstance(results, dict) and 'next' in results and 'results' in results:
+            return dict(results, profile=profiles)
+        return {'results': results, 'profile': profiles}
+
     def command(self, action, payload):
         """
-        This function is used to fetch elastic search results based on action parameter
+        This function is used to fetch elastic search results based on action parameter.
+        Commands slower than SLOW_QUERY_SECONDS are written to the slow query log (see SlowQueryLog).
+        With "profile": true in the payload the searches are run with the elasticsearch profile API,
+        bypassing the query cache and request coalescing, and their profile sections are returned
+        alongside the results.
 
         :param action: parameter
         :param payload: provided payload
@@ -62,108 +300,388 @@ class QueryBuilder(object):
         Example:
             >>> builder = QueryBuilder()
             >>> results = builder.command(action='fuzzy_queries', query='comprehesiv guide', fields=['title', 'summary'])
+            >>> builder.command('regex_query', {'field': 'title', 'query': 'el.*', 'profile': True})['profile']
         """
+        stream = payload.get('stream')
+        profiles = [] if payload.get('profile') and not stream else None
+        start, took = time.perf_counter(), []
+        took_token, profiling_token = es_took.set(took), profiling.set(profiles)
         try:
-            if action == 'append_book':
-
-                self.client.create_book_doc(
-                    title=payload['title'],
-                    authors=payload['authors'],
-                    summary=payload['summary'],
-                    publisher=payload['publisher'],
-                    num_reviews=payload['num_reviews'],
-                    publish_date=payload['publish_date'],
-                )
-                results = None
-
-            elif action == 'retrieve_book_by_id':
-                results = self.client.retrieve_book_by_id(book_id=payload['book_id'])
-
-            elif action == 'remove_book_by_id':
-                self.client.remove_book_doc(book_id=payload['book_id'])
-                results = None
-
-            elif action == 'search_book_by_parameter':
-                results = self.client.search_book_by_param(payload['field'], payload['query'])
-
-            elif action == 'fuzzy_queries':
-                results = self.client.fuzzy_queries(query=payload['query'], fields=payload['fields'])
-
-            elif action == 'wild_card_query':
-                results = self.client.wild_card_query(field=payload['field'], query=payload['query'])
-
-            elif action == 'regex_query':
-                results = self.client.regex_query(field=payload['field'], query=payload['query'])
-
-            elif action == 'match_phrase_query':
-                results = self.client.match_phrase_query(
-                    query=payload['query'],
-                    slop=payload['slop'],
-                    fields=payload['fields']
-                )
-
-            elif action == 'match_phrase_prefix':
-                results = self.client.match_phrase_prefix(query=payload['query'], slop=payload['slop'])
-
-            elif action == 'term_query':
-                results = self.client.term_query(field=payload['field'], term=payload['term'])
-
-            elif action == 'delete_by_query':
-                results = self.client.delete_by_query(fields=payload['fields'], query=payload['query'])
-
-            elif action == 'update_by_query':
-                results = self.client.update_by_query(
-                    fields=payload['fields'],
-                    query=payload['query'],
-                    field_to_update=payload['field_to_update'],
-                    new_value=payload['new_value']
-                )
-
-            elif action == 'bool_query':
-
-                data = dict()
-                if 'should' in payload.keys():
-                    data['should'] = payload['should']
-                if 'must' in payload.keys():
-                    data['must'] = payload['must']
-                if 'must_not' in payload.keys():
-                    data['must_not'] = payload['must_not']
-
-                results = self.client.query_combination(**data)
-
-            elif action == 'range_query':
-                results = self.client.range_query(
-                    field=payload['field'],
-                    range=payload['range']
-                )
-
-            elif action == 'metric_aggregations':
-                results = self.client.metric_aggregations(
-                    field=payload['field'],
-                    metric=payload['metric']
-                )
-
-            elif action == 'filter_aggregations':
-                results = self.client.filter_aggregations(
-                    term=payload['term'],
-                    query=payload['query'],
-                    metric=payload['metric'],
-                    field=payload['field']
-                )
-            elif action == 'reviews_range_aggregation':
-                results = self.client.reviews_range_aggregation(
-                    ranges=payload['ranges']
-                )
-            elif action == 'get_cluster_health':
-                results = self.client.get_cluster_health()
-            elif action == 'get_cluster_stats':
-                results = self.client.get_cluster_stats()
-            elif action == 'multi_get':
-                results = self.client.multi_get_books(
-                    ids=payload['ids']
-                )
-            elif action == "fetch_all":
-                results = self.client.fetch_all_docs()
-            return results
-        except Exception as ex:
-            print(ex)
+            results = self._command(action, payload)
+        finally:
+            es_took.reset(took_token)
+            profiling.reset(profiling_token)
+        if not stream:
+            self.slow_queries.observe(action_label(action), payload, time.perf_counter() - start, took, results)
+        return self.with_profile(results, profiles)
+
+    def _command(self, action, payload):
+        """
+        This function is used to run an action, see command
+
+        :param action: parameter
+        :param payload: provided payload
+        :return: result
+        """
+        label = action_label(action)
+        payload = self.refreshed(action, payload)
+        with ActionTimer(COMMAND_SECONDS, label):
+            try:
+                if self.is_cacheable(action, payload):
+                    key = cache_key(action, payload)
+                    results = self.cache.get(key)
+                    if results is None:
+                        generation = self.cache.generation()
+                        results = self._execute(action, payload)
+                        if results is not None:
+                            self.cache.set(key, results, generation)
+                    observe_results(label, results)
+                    return results
+
+                results = self._execute(action, payload)
+                if isinstance(results, Future):
+                    # a queued append_book that is not waited for, applied once acknowledged
+                    results.add_done_callback(
+                        lambda done: self._written(action, payload, None if done.exception() else done.result()))
+                elif action in WRITE_ACTIONS:
+                    self._written(action, payload, results)
+                if action == 'get_task' and results and results['completed']:
+                    # background by query tasks may change documents until they complete
+                    if self.cache is not None:
+                        self.cache.clear()
+                    if self.materialized is not None:
+                        self.materialized.invalidate()
+                if action in NO_RESULT_ACTIONS:
+                    results = None
+                observe_results(label, results)
+                return results
+            except Exception as ex:
+                record_error(ex)
+
+    def _written(self, action, payload, results):
+        """
+        This function is used to keep the query cache and the materialized aggregates in step with a write action
+
+        :param action: write action
+        :param payload: provided payload
+        :param results: elasticsearch response of the action
+        """
+        if self.cache is not None:
+            self.cache.clear()
+        if self.materialized is not None:
+            self.materialized.apply(action, payload, results)
+
+    def _execute(self, action, payload):
+        """
+        This function is used to dispatch and paginate an action, concurrent identical reads
+        wait for the request already in flight and share its results (see SingleFlight)
+
+        :param action: parameter
+        :param payload: provided payload
+        :return: paginated results
+        """
+        if not self.is_coalesced(action, payload):
+            return self.paginate(self._dispatch(action, payload), payload)
+        return self.single_flight.do(cache_key(action, payload),
+                                     lambda: self.paginate(self._dispatch(action, payload), payload))
+
+    def bulk_insert(self, data, **kwargs):
+        """
+        This function is used to bulk insert books while keeping the query cache and the
+        materialized aggregates in step with the index
+
+        :param data: list of dict, iterator of dict or NDJSON file path
+        :param kwargs: ElasticBookStorage.bulk_insert options
+        :return: ingest report
+
+        Example:
+            >>> builder = QueryBuilder()
+            >>> report = builder.bulk_insert("books.ndjson", bulk_load=True)
+        """
+        replaces = kwargs.get('id_field') is not None or kwargs.get('first_id') is not None
+        if self.materialized is not None and not replaces:
+            kwargs.setdefault('on_indexed', self.materialized.ingested)
+        if self.cache is not None:
+            # the cache is cleared on return, the inserted books must be searchable by then
+            kwargs.setdefault('refresh', True)
+        report = self.client.bulk_insert(data, **kwargs)
+        if self.materialized is not None and replaces:
+            # books given an id may replace indexed ones, they cannot be counted incrementally
+            self.materialized.invalidate()
+        if self.cache is not None:
+            self.cache.clear()
+        return report
+
+    def batch(self, payloads):
+        """
+        This function is used to run many actions with as few round trips as possible.
+        Search and aggregation actions are compiled into a single _msearch request, multi_get and
+        retrieve_book_by_id into a single _mget request, projected books with their own _source filtering.
+        Other actions (writes, cluster info) are executed one by one, in order, before the combined requests.
+
+        :param payloads: list of command payloads, each one with its action
+        :return: list of {'action', 'results'} or {'action', 'error'} items, in the same order
+
+        Example:
+            >>> builder = QueryBuilder()
+            >>> items = builder.batch([{'action': 'fetch_all'}, {'action': 'multi_get', 'ids': [1, 2]}])
+        """
+        items = [None] * len(payloads)
+        recorder = SearchRecorder(self.client)
+        generation = self.cache.generation() if self.cache is not None else None
+        plans, plan_slots = [], []
+        book_ids, projections, id_slots = [], [], []
+
+        for i, payload in enumerate(payloads):
+            action = payload.get('action')
+            items[i] = {'action': action}
+            try:
+                if payload.get('stream'):
+                    raise ValueError('stream is not supported in batch requests')
+
+                if self.is_cacheable(action, payload):
+                    cached = self.cache.get(cache_key(action, payload))
+                    if cached is not None:
+                        items[i]['results'] = cached
+                        continue
+
+                if action in MGET_ACTIONS:
+                    ids = list(payload['ids']) if action == 'multi_get' else [payload['book_id']]
+                    id_slots.append((i, len(book_ids), len(ids)))
+                    book_ids.extend(ids)
+                    projections.extend([self.get_projection(payload)] * len(ids))
+                elif action in UNCACHED_ACTIONS:
+                    items[i]['results'] = self.command(action, payload)
+                else:
+                    plan = self._dispatch(action, payload, client=recorder)
+                    if not isinstance(plan, SearchPlan):
+                        raise ValueError('invalid payload for action {}'.format(action))
+                    plans.append(plan)
+                    plan_slots.append(i)
+            except Exception as ex:
+                items[i]['error'] = "{}: {}".format(type(ex).__name__, ex)
+
+        if plans:
+            try:
+                responses = self.client._msearch(plans)
+                for i, plan, response in zip(plan_slots, plans, responses):
+                    if 'error' in response:
+                        items[i]['error'] = response['error']
+                    else:
+                        items[i]['results'] = self.paginate(response['hits']['hits'], payloads[i]) \
+                            if plan.kind == 'hits' else response['aggregations']
+            except Exception as ex:
+                for i in plan_slots:
+                    items[i]['error'] = "{}: {}".format(type(ex).__name__, ex)
+
+        if book_ids:
+            try:
+                docs = self.client._mget_docs(book_ids, projections)
+                for i, start, count in id_slots:
+                    slot_docs = docs[start:start + count]
+                    if items[i]['action'] == 'multi_get':
+                        items[i]['results'] = {'docs': [doc.get('_source', {'_id': doc['_id']}) for doc in slot_docs]}
+                    elif slot_docs[0].get('found'):
+                        items[i]['results'] = slot_docs[0].get('_source', {'_id': slot_docs[0]['_id']})
+                    else:
+                        items[i]['error'] = 'book not found'
+            except Exception as ex:
+                for i, _, _ in id_slots:
+                    items[i]['error'] = "{}: {}".format(type(ex).__name__, ex)
+
+        for i in plan_slots + [slot[0] for slot in id_slots]:
+            if items[i].get('results') is not None and self.is_cacheable(items[i]['action'], payloads[i]):
+                self.cache.set(cache_key(items[i]['action'], payloads[i]), items[i]['results'], generation)
+        return items
+
+    def _dispatch(self, action, payload, client=None):
+        """
+        This function is used to call the storage client method matching the action parameter
+
+        :param action: parameter
+        :param payload: provided payload
+        :param client: storage client to use instead of self.client
+        :return: storage client response
+        """
+        client = client or self.client
+        results = None
+        stream = payload.get('stream', False)
+        page = self.get_page(payload)
+        projection = self.get_projection(payload)
+
+        if action == 'append_book':
+
+            results = client.create_book_doc(
+                title=payload['title'],
+                authors=payload['authors'],
+                summary=payload['summary'],
+                publisher=payload['publisher'],
+                num_reviews=payload['num_reviews'],
+                publish_date=payload['publish_date'],
+                wait=payload.get('wait_for_ack', True),
+                refresh=payload.get('refresh')
+            )
+
+        elif action == 'retrieve_book_by_id':
+            results = client.retrieve_book_by_id(book_id=payload['book_id'], projection=projection)
+
+        elif action == 'remove_book_by_id':
+            # the materialized aggregates need the source of the removed book, returned by the delete itself
+            results = client.remove_book_doc(book_id=payload['book_id'], refresh=payload.get('refresh'),
+                                             with_source=self.materialized is not None)
+
+        elif action == 'search_book_by_parameter':
+            results = client.search_book_by_param(
+                payload['field'],
+                payload['query'],
+                stream=stream,
+                page=page,
+                projection=projection
+            )
+
+        elif action == 'fuzzy_queries':
+            results = client.fuzzy_queries(
+                query=payload['query'],
+                fields=payload['fields'],
+                stream=stream,
+                page=page,
+                projection=projection
+            )
+
+        elif action == 'wild_card_query':
+            results = client.wild_card_query(
+                field=payload['field'],
+                query=payload['query'],
+                stream=stream,
+                page=page,
+                projection=projection
+            )
+
+        elif action == 'regex_query':
+            results = client.regex_query(
+                field=payload['field'],
+                query=payload['query'],
+                stream=stream,
+                page=page,
+                projection=projection
+            )
+
+        elif action == 'match_phrase_query':
+            results = client.match_phrase_query(
+                query=payload['query'],
+                slop=payload['slop'],
+                fields=payload['fields'],
+                stream=stream,
+                page=page,
+                projection=projection
+            )
+
+        elif action == 'match_phrase_prefix':
+            results = client.match_phrase_prefix(
+                query=payload['query'],
+                slop=payload['slop'],
+                fields=payload.get('fields'),
+                stream=stream,
+                page=page,
+                projection=projection
+            )
+
+        elif action == 'term_query':
+            results = client.term_query(
+                field=payload['field'],
+                term=payload['term'],
+                stream=stream,
+                page=page,
+                projection=projection
+            )
+
+        elif action == 'delete_by_query':
+            results = client.delete_by_query(
+                fields=payload['fields'],
+                query=payload['query'],
+                **{option: payload[option] for option in BY_QUERY_OPTIONS if option in payload}
+            )
+
+        elif action == 'update_by_query':
+            if 'updates' in payload:
+                updates = payload['updates']
+            else:
+                updates = [{'op': 'set', 'field': payload['field_to_update'], 'value': payload['new_value']}]
+
+            results = client.update_by_query(
+                fields=payload['fields'],
+                query=payload['query'],
+                updates=updates,
+                **{option: payload[option] for option in BY_QUERY_OPTIONS if option in payload}
+            )
+
+        elif action == 'bool_query':
+
+            data = dict()
+            if 'should' in payload.keys():
+                data['should'] = payload['should']
+            if 'must' in payload.keys():
+                data['must'] = payload['must']
+            if 'must_not' in payload.keys():
+                data['must_not'] = payload['must_not']
+
+            results = client.query_combination(stream=stream, page=page, projection=projection, **data)
+
+        elif action == 'range_query':
+            results = client.range_query(
+                field=payload['field'],
+                range=payload['range'],
+                stream=stream,
+                page=page,
+                projection=projection
+            )
+
+        elif action == 'metric_aggregations':
+            results = client.metric_aggregations(
+                field=payload['field'],
+                metric=payload['metric']
+            )
+
+        elif action == 'filter_aggregations':
+            results = client.filter_aggregations(
+                term=payload['term'],
+                query=payload['query'],
+                metric=payload['metric'],
+                field=payload['field']
+            )
+        elif action == 'reviews_range_aggregation':
+            results = client.reviews_range_aggregation(
+                ranges=payload['ranges']
+            )
+        elif action == 'aggregate':
+            results = client.aggregate(
+                metrics=payload.get('metrics'),
+                buckets=payload.get('buckets'),
+                filters=payload.get('filters')
+            )
+        elif action == 'composite_aggregation':
+            results = client.composite_aggregation(
+                sources=payload['sources'],
+                size=payload.get('size', COMPOSITE_PAGE_SIZE),
+                after=payload.get('after'),
+                metrics=payload.get('metrics'),
+                filters=payload.get('filters')
+            )
+        elif action == 'catalog_aggregates':
+            if self.materialized is None:
+                raise ValueError('materialized aggregates are disabled')
+            results = self.materialized.get()
+        elif action == 'get_task':
+            results = client.get_task(task_id=payload['task_id'])
+        elif action == 'get_cluster_health':
+            results = client.get_cluster_health()
+        elif action == 'get_cluster_stats':
+            results = client.get_cluster_stats()
+        elif action == 'multi_get':
+            results = client.multi_get_books(
+                ids=payload['ids'],
+                projection=projection
+            )
+        elif action == "fetch_all":
+            results = client.fetch_all_docs(stream=stream, page=page, projection=projection)
+        return results
@@ -0,0 +1,26 @@
+#  This file is used to rebuild the book index without downtime, see ElasticBookStorage.reindex
+#  Usage: python reindex.py [--shards 3] [--replicas 1] [--slices 4] [--delete-source]
+import argparse
+import json
+import sys
+
+from settings import REINDEX_SLICES
+from storage_client import make_storage
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy the book index into a new index and swap the alias to it")
+    parser.add_argument('--shards', type=int, default=None, help="primary shards of the new index")
+    parser.add_argument('--replicas', type=int, default=None, help="replicas per shard of the new index")
+    parser.add_argument('--slices', type=int, default=REINDEX_SLICES, help="parallel slices of the copy")
+    parser.add_argument('--delete-source', action='store_true', help="delete the previous index after the swap")
+    args = parser.parse_args()
+
+    elk = make_storage()
+    report = elk.reindex(number_of_shards=args.shards, number_of_replicas=args.replicas, slices=args.slices,
+                         delete_source=args.delete_source)
+    if hasattr(elk, 'close'):
+        elk.close()
+    if report is None:
+        sys.exit(1)
+    print(json.dumps(report, indent=2))
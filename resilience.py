@@ -0,0 +1,395 @@
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from aiohttp.client_exceptions import ClientConnectorError
+from elasticsearch import TransportError, ConnectionError, ConnectionTimeout
+from urllib3.exceptions import ConnectTimeoutError
+
+from metrics import InstrumentedTransport, InstrumentedAsyncTransport, ES_RETRIES, HEDGED_REQUESTS, CIRCUIT_STATE, \
+    CIRCUIT_REJECTIONS, current_action, es_endpoint
+from settings import ES_MAX_RETRIES, ES_RETRY_ON_TIMEOUT, ES_ACTION_TIMEOUTS, ES_RETRY_ON_STATUS, \
+    ES_RETRY_INITIAL_BACKOFF, ES_RETRY_MAX_BACKOFF, ES_BREAKER_FAILURES, ES_BREAKER_RESET, ES_HEDGE_AFTER, \
+    ES_HEDGE_THREADS
+
+# endpoints of the requests that only read, besides GET and HEAD requests
+READ_ENDPOINTS = ('_search', '_msearch', '_mget', '_count')
+
+# whether the requests being sent are retried on 429 by their caller, see CallerRetries
+caller_retries = contextvars.ContextVar('caller_retries', default=False)
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of sending a request while the circuit breaker is open"""
+
+    def __str__(self):
+        return "CircuitOpenError(elasticsearch is unavailable, retry in {:.0f}s)".format(self.info['retry_after'])
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker shared by every elasticsearch request of a process. It opens after max_failures
+    consecutive failed requests (connection errors, timeouts and ES_RETRY_ON_STATUS or 5xx responses,
+    once retries are exhausted), then requests fail fast with CircuitOpenError. After reset_timeout
+    seconds one request is let through to probe the cluster: it closes the circuit when it succeeds
+    and opens it again when it fails.
+
+    :Example:
+        >>> breaker = CircuitBreaker(max_failures=5, reset_timeout=30)
+        >>> breaker.allow()
+        >>> breaker.record()
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+    STATES = (CLOSED, HALF_OPEN, OPEN)
+
+    def __init__(self, max_failures=ES_BREAKER_FAILURES, reset_timeout=ES_BREAKER_RESET):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+        self.rejected = 0
+
+    def _set_state(self, state):
+        self.state = state
+        CIRCUIT_STATE.set(self.STATES.index(state))
+
+    def retry_after(self):
+        """This function is used to return the seconds before the cluster is probed again, None when closed"""
+        if self.state == self.CLOSED:
+            return None
+        return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+
+    def allow(self):
+        """This function is used to let a request through, or raise CircuitOpenError while the circuit is open"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return
+            self.rejected += 1
+        CIRCUIT_REJECTIONS.labels(current_action.get()).inc()
+        raise CircuitOpenError('N/A', 'circuit breaker open', {'retry_after': self.retry_after() or 0.0})
+
+    def record(self, error=None):
+        """
+        This function is used to record the outcome of a request let through
+
+        :param error: exception raised by the request, None when it succeeded
+        """
+        with self.lock:
+            self.probing = False
+            if error is None or not is_failure(error):
+                self.failures = 0
+                if self.state != self.CLOSED:
+                    self._set_state(self.CLOSED)
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def release(self):
+        """This function is used to give back the probe of a request cancelled before its outcome was known"""
+        with self.lock:
+            self.probing = False
+
+    def stats(self):
+        """This function is used to return the breaker state"""
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'retry_after': self.retry_after(),
+            'rejected': self.rejected
+        }
+
+
+# circuit breaker of the cluster, shared by the sync and async transports
+breaker = CircuitBreaker()
+
+_hedge_pool = None
+_hedge_pool_pid = None
+_hedge_lock = threading.Lock()
+
+
+def error_status(error):
+    """
+    This function is used to pick the HTTP status of an API request whose command failed: elasticsearch
+    client errors keep their status, an open circuit is 503 with a Retry-After header, other elasticsearch
+    and connection failures are 502 and any other error 500
+
+    :param error: exception recorded by the command
+    :return: (status, headers)
+    """
+    if isinstance(error, CircuitOpenError):
+        return 503, {'Retry-After': str(int(breaker.retry_after() or 0) + 1)}
+    status = getattr(error, 'status_code', None)
+    if isinstance(error, TransportError) and isinstance(status, int) and 400 <= status < 500:
+        return status, {}
+    if isinstance(error, TransportError):
+        return 502, {}
+    return 500, {}
+
+
+def is_unsent(error):
+    """
+    This function is used to tell whether a connection error proves the request never reached the
+    cluster: the connection could not be established (refused, unreachable host, connect timeout)
+
+    :param error: ConnectionError, its info is the exception of the http library
+    :return: boolean
+    """
+    return isinstance(getattr(error, 'info', None), (ConnectTimeoutError, ClientConnectorError))
+
+
+def is_failure(error):
+    """
+    This function is used to tell whether an exception means the cluster is unhealthy
+
+    :param error: exception raised by a request
+    :return: boolean
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, ConnectionError):
+        return True
+    status = getattr(error, 'status_code', None)
+    return isinstance(error, TransportError) and isinstance(status, int) and \
+        (status in ES_RETRY_ON_STATUS or status >= 500)
+
+
+def is_read(method, url, params):
+    """
+    This function is used to tell whether a request only reads and can be sent again safely.
+    Scroll requests are excluded, sending one twice skips a page or leaks a search context.
+
+    :param method: HTTP method
+    :param url: request url
+    :param params: query parameters
+    :return: boolean
+    """
+    if 'scroll' in url or 'scroll' in (params or {}):
+        return False
+    return method in ('GET', 'HEAD') or es_endpoint(url) in READ_ENDPOINTS
+
+
+def retry_reason(error, method, url, params):
+    """
+    This function is used to tell whether a failed request is retried after a backoff
+
+    :param error: exception raised by the request
+    :param method: HTTP method
+    :param url: request url
+    :param params: query parameters
+    :return: retry reason (metric label), or None when the error is raised
+    """
+    if isinstance(error, CircuitOpenError):
+        return None
+    if isinstance(error, ConnectionTimeout):
+        # the request may have been executed, only reads are sent again
+        return 'timeout' if ES_RETRY_ON_TIMEOUT and is_read(method, url, params) else None
+    if isinstance(error, ConnectionError):
+        # like timeouts, a write may have been executed unless the connection was never established
+        return 'connection' if is_read(method, url, params) or is_unsent(error) else None
+    if isinstance(error, TransportError) and error.status_code in ES_RETRY_ON_STATUS:
+        if error.status_code == 429:
+            # the cluster rejected the request before running it, unless the caller retries it itself
+            return None if caller_retries.get() else '429'
+        # a 502/503 of a proxy does not prove a write was not applied, only reads are sent again
+        return str(error.status_code) if is_read(method, url, params) else None
+    return None
+
+
+class CallerRetries(object):
+    """
+    Context manager telling the transport that the requests sent while the block runs are retried on 429
+    by their caller (e.g. streaming_bulk max_retries), so a rejected request is not retried by both.
+
+    :Example:
+        >>> with CallerRetries():
+        ...     results = list(helpers.streaming_bulk(client, actions, max_retries=5))
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+
+    def __enter__(self):
+        self.token = caller_retries.set(self.enabled)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        caller_retries.reset(self.token)
+        return False
+
+
+def backoff_delay(attempt):
+    """
+    This function is used to compute the delay before a retry: exponential backoff with full jitter
+
+    :param attempt: number of the failed attempt, from 0
+    :return: seconds
+    """
+    return random.uniform(0, min(ES_RETRY_MAX_BACKOFF, ES_RETRY_INITIAL_BACKOFF * 2 ** attempt))
+
+
+def request_params(params):
+    """
+    This function is used to add the timeout of the current action to the query parameters of a request
+
+    :param params: query parameters
+    :return: query parameters
+    """
+    timeout = ES_ACTION_TIMEOUTS.get(current_action.get())
+    if timeout is None or 'request_timeout' in (params or {}):
+        return params
+    return dict(params or {}, request_timeout=timeout)
+
+
+def is_hedged(method, url, params):
+    """This function is used to tell whether a request is hedged, see ES_HEDGE_AFTER"""
+    return ES_HEDGE_AFTER is not None and is_read(method, url, params)
+
+
+def hedge_params(params):
+    """
+    This function is used to build the query parameters of a hedged request: a random preference,
+    unless the request sets one, routes it to a random copy of every shard
+
+    :param params: query parameters
+    :return: query parameters
+    """
+    if 'preference' in (params or {}):
+        return params
+    return dict(params or {}, preference=uuid.uuid4().hex)
+
+
+def hedge_pool():
+    """This function is used to return the process wide thread pool running hedged requests"""
+    global _hedge_pool, _hedge_pool_pid
+
+    if _hedge_pool is None or _hedge_pool_pid != os.getpid():
+        with _hedge_lock:
+            if _hedge_pool is None or _hedge_pool_pid != os.getpid():
+                _hedge_pool = ThreadPoolExecutor(max_workers=ES_HEDGE_THREADS, thread_name_prefix='es-hedge')
+                _hedge_pool_pid = os.getpid()
+    return _hedge_pool
+
+
+class ResilientTransport(InstrumentedTransport):
+    """
+    Transport adding a resilience layer to every elasticsearch request: the timeout of the current
+    action (ES_ACTION_TIMEOUTS), retries with exponential backoff and jitter (see retry_reason) on
+    connection errors, read timeouts and ES_RETRY_ON_STATUS responses, the process circuit breaker and, with
+    ES_HEDGE_AFTER, hedged reads. The client must be created with max_retries=0, retries are done here.
+    """
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        params = request_params(params)
+        breaker.allow()
+        attempt = 0
+        while True:
+            try:
+                if is_hedged(method, url, params):
+                    response = self._hedged(method, url, headers, params, body)
+                else:
+                    response = super(ResilientTransport, self).perform_request(method, url, headers, params, body)
+            except Exception as ex:
+                reason = retry_reason(ex, method, url, params)
+                if reason is not None and attempt < ES_MAX_RETRIES:
+                    ES_RETRIES.labels(current_action.get(), es_endpoint(url), reason).inc()
+                    time.sleep(backoff_delay(attempt))
+                    attempt += 1
+                    continue
+                breaker.record(ex)
+                raise
+            breaker.record()
+            return response
+
+    def _hedged(self, method, url, headers, params, body):
+        """
+        This function is used to send a read, and send it again to another shard copy when it did not
+        answer within ES_HEDGE_AFTER seconds. The first successful answer is returned, the other request
+        is left to complete in the hedge pool.
+        """
+        def send(request_params):
+            return super(ResilientTransport, self).perform_request(method, url, headers, request_params, body)
+
+        pool = hedge_pool()
+        primary = pool.submit(contextvars.copy_context().run, send, params)
+        if wait([primary], timeout=ES_HEDGE_AFTER).done:
+            return primary.result()
+
+        hedge = pool.submit(contextvars.copy_context().run, send, hedge_params(params))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    HEDGED_REQUESTS.labels(current_action.get(), es_endpoint(url),
+                                           'hedge' if future is hedge else 'primary').inc()
+                    return future.result()
+        raise primary.exception()
+
+
+class ResilientAsyncTransport(InstrumentedAsyncTransport):
+    """Asyncio flavour of ResilientTransport, the losing request of a hedged read is cancelled"""
+
+    async def perform_request(self, method, url, headers=None, params=None, body=None):
+        params = request_params(params)
+        breaker.allow()
+        attempt = 0
+        while True:
+            try:
+                if is_hedged(method, url, params):
+                    response = await self._hedged(method, url, headers, params, body)
+                else:
+                    response = await super(ResilientAsyncTransport, self).perform_request(
+                        method, url, headers, params, body)
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as ex:
+                reason = retry_reason(ex, method, url, params)
+                if reason is not None and attempt < ES_MAX_RETRIES:
+                    ES_RETRIES.labels(current_action.get(), es_endpoint(url), reason).inc()
+                    await asyncio.sleep(backoff_delay(attempt))
+                    attempt += 1
+                    continue
+                breaker.record(ex)
+                raise
+            breaker.record()
+            return response
+
+    async def _hedged(self, method, url, headers, params, body):
+        async def send(request_params):
+            return await super(ResilientAsyncTransport, self).perform_request(
+                method, url, headers, request_params, body)
+
+        primary = asyncio.ensure_future(send(params))
+        done, _ = await asyncio.wait([primary], timeout=ES_HEDGE_AFTER)
+        if done:
+            return primary.result()
+
+        hedge = asyncio.ensure_future(send(hedge_params(params)))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    HEDGED_REQUESTS.labels(current_action.get(), es_endpoint(url),
+                                           'hedge' if task is hedge else 'primary').inc()
+                    return task.result()
+        raise primary.exception()
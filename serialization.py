@@ -0,0 +1,68 @@
+import json
+
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from settings import FAST_JSON
+
+# orjson options: dict keys are not always strings (e.g. numeric bucket keys) and NaN stays null
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+def use_orjson():
+    """This function is used to tell whether the orjson fast path is enabled and installed"""
+    return FAST_JSON and orjson is not None
+
+
+def dumps(value, default=None):
+    """
+    This function is used to encode a value to JSON bytes in one pass, with orjson when available
+
+    :param value: json serializable value
+    :param default: function converting values the encoder does not support
+    :return: JSON bytes
+
+    Example:
+        >>> dumps({'title': 'Solr in Action'})
+        b'{"title":"Solr in Action"}'
+    """
+    if use_orjson():
+        return orjson.dumps(value, default=default, option=ORJSON_OPTIONS)
+    return json.dumps(value, default=default, separators=(',', ':')).encode('utf-8')
+
+
+def loads(data):
+    """
+    This function is used to decode JSON text or bytes, with orjson when available
+
+    :param data: JSON str or bytes
+    :return: decoded value
+    """
+    if use_orjson():
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONSerializer(JSONSerializer):
+    """
+    elasticsearch-py serializer decoding responses and encoding request bodies with orjson,
+    falling back to the stdlib JSONSerializer without it. Types orjson does not know (Decimal, ...)
+    are converted by JSONSerializer.default.
+    """
+
+    def loads(self, s):
+        if not use_orjson():
+            return super(FastJSONSerializer, self).loads(s)
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return super(FastJSONSerializer, self).loads(s)
+
+    def dumps(self, data):
+        if isinstance(data, str) or not use_orjson():
+            return super(FastJSONSerializer, self).dumps(data)
+        return orjson.dumps(data, default=self.default, option=ORJSON_OPTIONS).decode('utf-8')
@@ -4,11 +4,151 @@ import os
 ELASTIC_INDEX = "book_index"
 ELASTIC_DOC = "book_doc"
 ELASTIC_HOSTNAME = os.environ.get("ELASTIC_HOSTNAME", "localhost")
-ELASTIC_PORT = 9200
+ELASTIC_PORT = int(os.environ.get("ELASTIC_PORT", 9200))
 HITS_SIZE = 10000
 
+# Index Mapping Settings
+# bump BOOK_MAPPING_VERSION whenever BOOK_PROPERTIES or BOOK_INDEX_SETTINGS in storage_client.py change
+BOOK_MAPPING_VERSION = 3
+AUTOCOMPLETE_MIN_GRAM = 1
+AUTOCOMPLETE_MAX_GRAM = 20
+
+# Storage Backend Settings
+# elasticsearch: the cluster at ELASTIC_HOSTNAME
+# embedded: in-process pure-Python engine persisted under EMBEDDED_DATA_DIR (single process, run gunicorn --workers=1)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "elasticsearch")
+EMBEDDED_DATA_DIR = os.environ.get("EMBEDDED_DATA_DIR", "embedded_data")
+EMBEDDED_FLUSH_DOCS = 10000
+EMBEDDED_MAX_SEGMENTS = 8
+
+# Pagination Settings (from + page_size is capped by the index max_result_window, use search_after beyond it)
+MAX_PAGE_SIZE = 1000
+# the tie breaker is the book_id keyword (a copy of the document id) read from doc values, sorting on _id would
+# load every id of the index in fielddata
+PAGE_SORT = [{"_score": "desc"}, {"book_id": "asc"}]
+
+# Aggregation Settings (composite pages are capped by MAX_PAGE_SIZE)
+TERMS_AGGREGATION_SIZE = 10
+DATE_HISTOGRAM_INTERVAL = "year"
+COMPOSITE_PAGE_SIZE = 100
+
+# Materialized Aggregates Settings (opt-in, each worker keeps its own aggregates and fully recomputes them
+# every MATERIALIZED_TTL seconds, so writes served by other workers show up after at most MATERIALIZED_TTL)
+MATERIALIZED_AGGREGATES = os.environ.get("MATERIALIZED_AGGREGATES", "false").lower() == "true"
+MATERIALIZED_TTL = 300
+MATERIALIZED_MAX_BUCKETS = 10000
+
+# Delete/Update By Query Settings
+BY_QUERY_SLICES = "auto"
+BY_QUERY_REQUESTS_PER_SECOND = -1
+UPDATE_SCRIPT_ID = "book_update"
+USE_STORED_SCRIPTS = True
+
+# Reindex Settings (ELASTIC_INDEX is an alias over book_index_v<mapping version>_<timestamp> indices)
+REINDEX_SLICES = 4
+REINDEX_BATCH_SIZE = 1000
+REINDEX_CATCH_UP_PASSES = 5
+REINDEX_POLL_INTERVAL = 1
+
+# Connection Pool Settings (keep ES_POOL_MAXSIZE >= BULK_THREAD_COUNT and the threads per gunicorn worker)
+ES_POOL_MAXSIZE = int(os.environ.get("ES_POOL_MAXSIZE", 10))
+ES_TIMEOUT = int(os.environ.get("ES_TIMEOUT", 10))
+ES_MAX_RETRIES = 3
+ES_RETRY_ON_TIMEOUT = True
+ES_KEEP_ALIVE = True
+ES_ASYNC_POOL_MAXSIZE = int(os.environ.get("ES_ASYNC_POOL_MAXSIZE", 100))
+
+# Resilience Settings
+# ES_MAX_RETRIES and ES_RETRY_ON_TIMEOUT apply to these retries, timeouts are only retried for reads.
+# timeout of the elasticsearch requests of an action in seconds, ES_TIMEOUT for the others
+ES_ACTION_TIMEOUTS = {
+    'retrieve_book_by_id': 2,
+    'multi_get': 5,
+    'get_cluster_health': 2,
+    'get_cluster_stats': 5,
+    'fetch_all': 30,
+    'delete_by_query': 60,
+    'update_by_query': 60
+}
+# statuses retried for reads, writes are only retried on 429 (rejected before they run)
+ES_RETRY_ON_STATUS = (429, 502, 503)
+ES_RETRY_INITIAL_BACKOFF = 0.1
+ES_RETRY_MAX_BACKOFF = 5
+# consecutive failed requests opening the circuit, and seconds before a request probes the cluster again
+ES_BREAKER_FAILURES = 5
+ES_BREAKER_RESET = 30
+# seconds a read waits before being sent again to another shard copy, first answer wins; None disables hedging
+ES_HEDGE_AFTER = None
+ES_HEDGE_THREADS = 8
+
+# Serialization Settings (orjson encodes responses and decodes elasticsearch responses when installed)
+FAST_JSON = True
+
+# Streaming Settings
+SCROLL_SIZE = 1000
+SCROLL_TIMEOUT = "2m"
+
+# Bulk Ingest Settings
+BULK_CHUNK_SIZE = 500
+BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+BULK_THREAD_COUNT = 4
+BULK_MAX_RETRIES = 5
+BULK_INITIAL_BACKOFF = 2
+BULK_MAX_BACKOFF = 60
+# index settings while a bulk load runs, restored afterwards
+BULK_LOAD_REFRESH_INTERVAL = "-1"
+BULK_LOAD_REPLICAS = 0
+BULK_LOAD_MAX_NUM_SEGMENTS = 1
+
+# Write-Behind Settings
+# when enabled create_book_doc queues books and a background thread sends them as one _bulk request once
+# WRITE_BEHIND_MAX_DOCS are queued or the oldest one waited WRITE_BEHIND_MAX_DELAY seconds
+WRITE_BEHIND = os.environ.get("WRITE_BEHIND", "false").lower() == "true"
+WRITE_BEHIND_MAX_DOCS = 500
+WRITE_BEHIND_MAX_DELAY = 0.005
+
+# Query Cache Settings
+# none: disabled
+# redis: shared by all workers and invalidated by every write, requires the redis package
+# memory: per worker LRU invalidated by the writes of the same worker only, for single worker deployments
+# While a cache is enabled writes wait for the refresh that makes them searchable (refresh=wait_for)
+QUERY_CACHE_BACKEND = os.environ.get("QUERY_CACHE_BACKEND", "none")
+QUERY_CACHE_MAX_ENTRIES = 1024
+QUERY_CACHE_TTL = 60
+QUERY_CACHE_REDIS_URL = os.environ.get("QUERY_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# Document Cache Settings
+# per worker LRU of full book sources by id serving retrieve_book_by_id and multi_get, bounded by
+# DOC_CACHE_MAX_BYTES (0, the default, disables it). The writes of a worker update its cache, a write served by
+# another worker is hidden for up to DOC_CACHE_TTL seconds
+DOC_CACHE_MAX_BYTES = int(os.environ.get("DOC_CACHE_MAX_BYTES", 0))
+DOC_CACHE_TTL = float(os.environ.get("DOC_CACHE_TTL", 5))
+
+# Single Flight Settings (concurrent identical reads of a worker share one elasticsearch request)
+SINGLE_FLIGHT = os.environ.get("SINGLE_FLIGHT", "true").lower() == "true"
+
+# Export Settings (finished exports, their files and status, are deleted EXPORT_RETENTION seconds after they finish)
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "exports")
+EXPORT_WORKERS = 2
+EXPORT_RETENTION = int(os.environ.get("EXPORT_RETENTION", 24 * 3600))
+
 # API Settings
 API_PORT = 5000
 
+# Slow Query Log Settings
+# commands slower than SLOW_QUERY_SECONDS are logged to the book_storage.slow_queries logger (None disables the log)
+# and the last SLOW_QUERY_LOG_SIZE are returned by GET /ask/storage/slow/
+SLOW_QUERY_SECONDS = float(os.environ.get("SLOW_QUERY_SECONDS", 0.5))
+SLOW_QUERY_LOG_SIZE = 100
+SLOW_QUERY_MAX_VALUE_LENGTH = 256
+
+# Metrics Settings
+# directory shared by the gunicorn workers to aggregate their metrics, empty for a single process.
+# It must be emptied before the workers start (see modules/run.sh)
+METRICS_MULTIPROC_DIR = os.environ.get("METRICS_MULTIPROC_DIR", "")
+METRICS_LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+METRICS_HITS_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 500, 1000, 5000, 10000)
+METRICS_BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
 # Data Columns
 COLUMNS = ["title", "authors", "summary", "publish_date", "num_reviews", "publisher"]
@@ -0,0 +1,125 @@
+import asyncio
+import threading
+
+from metrics import COALESCED_REQUESTS, RecordedErrors, current_action, forward_errors
+
+
+class _Call(object):
+    """
+    In-flight call of a SingleFlight key: the waiters block on done until result or error is set.
+    errors are the ones the call swallowed (see record_error), so the waiters can answer with an error status too.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.errors = []
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent identical calls within a process: the first caller of a key runs the
+    function, callers arriving while it runs wait for it and receive the same result (or exception)
+    instead of sending the same elasticsearch request again. The errors the function swallowed are
+    recorded in every caller's request, see RecordedErrors. Nothing is kept once the call returns,
+    repeated calls are the query cache's job.
+
+    Waiters share the result object, it must be treated as read only.
+
+    :Example:
+        >>> flight = SingleFlight()
+        >>> results = flight.do(cache_key('fetch_all', {}), lambda: storage.get_all_books())
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        This function is used to run func once for all the concurrent callers of a key
+
+        :param key: call key, see cache.cache_key
+        :param func: function without arguments
+        :return: result of func
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            COALESCED_REQUESTS.labels(current_action.get()).inc()
+            call.done.wait()
+            forward_errors(call.errors)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            with RecordedErrors() as call.errors:
+                call.result = func()
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            forward_errors(call.errors)
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """This function is used to return the number of executed and shared calls"""
+        return {'in_flight': len(self.calls), 'executed': self.leaders, 'coalesced': self.shared}
+
+
+class AsyncSingleFlight(SingleFlight):
+    """
+    Asyncio flavour of SingleFlight, waiters await the future of the running call.
+    It must be used from a single event loop.
+    """
+
+    async def do(self, key, func):
+        """
+        This function is used to await func once for all the concurrent callers of a key
+
+        :param key: call key, see cache.cache_key
+        :param func: coroutine function without arguments
+        :return: result of func
+        """
+        future = self.calls.get(key)
+        if future is not None:
+            self.shared += 1
+            COALESCED_REQUESTS.labels(current_action.get()).inc()
+            # shield: a cancelled waiter must not cancel the call of the others
+            result, errors = await asyncio.shield(future)
+            forward_errors(errors)
+            return result
+
+        future = self.calls[key] = asyncio.get_event_loop().create_future()
+        self.leaders += 1
+        try:
+            with RecordedErrors() as errors:
+                result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as ex:
+            future.set_exception(ex)
+            # the exception is raised here, waiters (if any) retrieve it from the future
+            future.exception()
+            raise
+        else:
+            future.set_result((result, errors))
+            return result
+        finally:
+            forward_errors(errors)
+            del self.calls[key]
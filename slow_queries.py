@@ -0,0 +1,113 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from cache import IGNORED_PAYLOAD_KEYS
+from metrics import hit_count
+from settings import SLOW_QUERY_SECONDS, SLOW_QUERY_LOG_SIZE, SLOW_QUERY_MAX_VALUE_LENGTH
+
+logger = logging.getLogger('book_storage.slow_queries')
+
+# payload keys that only change how the results are returned
+SLOW_QUERY_IGNORED_KEYS = IGNORED_PAYLOAD_KEYS + ('profile',)
+
+
+def normalize_payload(payload):
+    """
+    This function is used to normalize a payload for the slow query log: keys are sorted, keys that do not
+    change the query are dropped and long strings are truncated
+
+    :param payload: provided payload
+    :return: normalized payload
+
+    Example:
+        >>> normalize_payload({'action': 'regex_query', 'query': 'el.*', 'field': 'title'})
+        {'field': 'title', 'query': 'el.*'}
+    """
+    def normalize(value):
+        if isinstance(value, dict):
+            return {k: normalize(value[k]) for k in sorted(value)}
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        if isinstance(value, str) and len(value) > SLOW_QUERY_MAX_VALUE_LENGTH:
+            return value[:SLOW_QUERY_MAX_VALUE_LENGTH] + '...'
+        return value
+
+    return normalize({k: v for k, v in payload.items() if k not in SLOW_QUERY_IGNORED_KEYS})
+
+
+def payload_shape(payload):
+    """
+    This function is used to build the shape of a normalized payload, its values replaced by "?",
+    so slow queries differing only by their values can be grouped
+
+    :param payload: normalized payload
+    :return: shape string
+
+    Example:
+        >>> payload_shape({'field': 'title', 'query': 'el.*'})
+        '{"field":"?","query":"?"}'
+    """
+    def shape(value):
+        if isinstance(value, dict):
+            return {k: shape(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [shape(value[0])] if value else []
+        return '?'
+
+    return json.dumps(shape(payload), sort_keys=True, separators=(',', ':'))
+
+
+class SlowQueryLog(object):
+    """
+    Log of the commands slower than threshold seconds: action, normalized payload and its shape,
+    the took reported by elasticsearch (summed over the requests of the command), the total time
+    and the hit count. Entries are written as JSON to the book_storage.slow_queries logger and the
+    last ones are kept in memory.
+
+    :Example:
+        >>> slow_queries = SlowQueryLog(threshold=0.5)
+        >>> slow_queries.observe('regex_query', {'field': 'title', 'query': 'el.*'}, 0.8, [650], results)
+        >>> slow_queries.recent()[0]['es_took_ms']
+        650
+    """
+
+    def __init__(self, threshold=SLOW_QUERY_SECONDS, size=SLOW_QUERY_LOG_SIZE):
+        self.threshold = threshold
+        self.entries = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def observe(self, action, payload, seconds, took, results):
+        """
+        This function is used to log a command when it is slower than the threshold
+
+        :param action: action
+        :param payload: provided payload
+        :param seconds: total time of the command
+        :param took: list of the took (ms) of its elasticsearch responses
+        :param results: command results
+        """
+        if self.threshold is None or seconds < self.threshold:
+            return
+        payload = normalize_payload(payload)
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+            'action': action,
+            'payload': payload,
+            'shape': payload_shape(payload),
+            'es_took_ms': sum(took) if took else None,
+            'es_requests': len(took),
+            'total_ms': round(seconds * 1000, 1),
+            'hits': hit_count(results)
+        }
+        with self.lock:
+            self.entries.append(entry)
+        logger.warning(json.dumps(entry, default=str))
+
+    def recent(self):
+        """This function is used to return the last slow queries, the slowest first"""
+        with self.lock:
+            entries = list(self.entries)
+        return sorted(entries, key=lambda entry: entry['total_ms'], reverse=True)
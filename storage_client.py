@@ -1,13 +1,170 @@
-from elasticsearch import Elasticsearch
-from elasticsearch import helpers
+import contextvars
+import functools
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import NotFoundError, helpers
 from elasticsearch_dsl import Search, Q, UpdateByQuery
 
-from settings import ELASTIC_INDEX, ELASTIC_DOC, ELASTIC_HOSTNAME, ELASTIC_PORT, HITS_SIZE
+from bulk_ingest import BulkIngestEngine, BulkLoadMode, make_write_behind, new_doc_id
+from cache import make_document_cache
+from connection import get_client
+from metrics import record_error, timed_storage
+
+from settings import ELASTIC_INDEX, ELASTIC_DOC, ELASTIC_HOSTNAME, ELASTIC_PORT, HITS_SIZE, SCROLL_SIZE, \
+    SCROLL_TIMEOUT, PAGE_SORT, BY_QUERY_SLICES, BY_QUERY_REQUESTS_PER_SECOND, UPDATE_SCRIPT_ID, USE_STORED_SCRIPTS, \
+    STORAGE_BACKEND, BOOK_MAPPING_VERSION, AUTOCOMPLETE_MIN_GRAM, AUTOCOMPLETE_MAX_GRAM, REINDEX_SLICES, \
+    REINDEX_BATCH_SIZE, REINDEX_CATCH_UP_PASSES, REINDEX_POLL_INTERVAL, TERMS_AGGREGATION_SIZE, \
+    DATE_HISTOGRAM_INTERVAL, COMPOSITE_PAGE_SIZE, MAX_PAGE_SIZE
 
 
 # https://dzone.com/articles/23-useful-elasticsearch-example-queries
 
+# search request recorded by SearchRecorder, kind is either "hits" or "aggregations"
+SearchPlan = namedtuple('SearchPlan', ['kind', 'body'])
+
+# Painless script applying params.updates, a list of {"op", "field", "value"} updates.
+# The source never changes, so it is compiled once no matter which values are written.
+BOOK_UPDATE_SCRIPT = """
+for (def update : params.updates) {
+    def field = update.field;
+    if (update.op == 'set') {
+        ctx._source[field] = update.value;
+    } else if (update.op == 'inc') {
+        ctx._source[field] = (ctx._source[field] == null ? 0 : ctx._source[field]) + update.value;
+    } else if (update.op == 'append') {
+        if (ctx._source[field] == null) {
+            ctx._source[field] = [];
+        } else if (!(ctx._source[field] instanceof List)) {
+            ctx._source[field] = [ctx._source[field]];
+        }
+        if (!ctx._source[field].contains(update.value)) {
+            ctx._source[field].add(update.value);
+        }
+    } else if (update.op == 'remove') {
+        if (ctx._source[field] instanceof List) {
+            ctx._source[field].removeIf(value -> value == update.value);
+        }
+    }
+}
+"""
+
+# supported operations of BOOK_UPDATE_SCRIPT
+UPDATE_OPERATIONS = ('set', 'inc', 'append', 'remove')
+
+# script deleting a book through the update API, whose response can carry the deleted source
+BOOK_DELETE_SCRIPT = "ctx.op = 'delete'"
+
+# keyword copy of the document id every book is written with, the tie breaker of PAGE_SORT
+BOOK_ID_FIELD = "book_id"
+
+# script of the reindex copy, filling the id copy of books written before it was mapped
+BOOK_ID_SCRIPT = "ctx._source.book_id = ctx._id"
+
+# analysis of the book index: an edge n-gram analyzer for the autocomplete sub-fields and
+# a lower casing normalizer, so exact matches on keyword sub-fields ignore case
+BOOK_INDEX_SETTINGS = {
+    "analysis": {
+        "filter": {
+            "autocomplete_filter": {
+                "type": "edge_ngram",
+                "min_gram": AUTOCOMPLETE_MIN_GRAM,
+                "max_gram": AUTOCOMPLETE_MAX_GRAM
+            }
+        },
+        "analyzer": {
+            "autocomplete": {
+                "type": "custom",
+                "tokenizer": "standard",
+                "filter": ["lowercase", "autocomplete_filter"]
+            }
+        },
+        "normalizer": {
+            "lowercase_keyword": {
+                "type": "custom",
+                "filter": ["lowercase"]
+            }
+        }
+    }
+}
+
+# book fields, see BOOK_MAPPING_VERSION.
+# keyword: exact matches, aggregations and sorting (doc values are only kept where they are used)
+# autocomplete: prefixes of every word indexed once, so search-as-you-type is a plain phrase query
+# index_phrases/index_prefixes: two-word shingles and 2-10 character prefixes for phrase and prefix queries
+# norms are dropped on short fields where the length should not change the score
+# book_id: BOOK_ID_FIELD, sorted on its doc values
+BOOK_PROPERTIES = {
+    "book_id": {
+        "type": "keyword"
+    },
+    "title": {
+        "type": "text",
+        "index_phrases": True,
+        "fields": {
+            "keyword": {"type": "keyword", "normalizer": "lowercase_keyword", "ignore_above": 256,
+                        "doc_values": False},
+            "autocomplete": {"type": "text", "analyzer": "autocomplete", "search_analyzer": "standard",
+                             "norms": False}
+        }
+    },
+    "authors": {
+        "type": "text",
+        "norms": False,
+        "fields": {
+            "keyword": {"type": "keyword", "normalizer": "lowercase_keyword", "ignore_above": 256},
+            "autocomplete": {"type": "text", "analyzer": "autocomplete", "search_analyzer": "standard",
+                             "norms": False}
+        }
+    },
+    "summary": {
+        "type": "text",
+        "index_phrases": True,
+        "index_prefixes": {"min_chars": 2, "max_chars": 10}
+    },
+    "publish_date": {
+        "type": "date"
+    },
+    "num_reviews": {
+        "type": "integer"
+    },
+    "publisher": {
+        "type": "text",
+        "norms": False,
+        "fields": {
+            "keyword": {"type": "keyword", "normalizer": "lowercase_keyword", "ignore_above": 256}
+        }
+    }
+}
+
+# fields with a keyword sub-field, used by exact matches
+KEYWORD_FIELDS = ('title', 'authors', 'publisher')
+
+# fields with an edge n-gram autocomplete sub-field
+AUTOCOMPLETE_FIELDS = ('title', 'authors')
+
+# metric and bucket aggregations understood by aggregate, composite sources are bucket types too
+AGGREGATION_METRICS = ('avg', 'sum', 'min', 'max', 'value_count', 'stats', 'extended_stats', 'percentiles',
+                       'cardinality')
+BUCKET_AGGREGATIONS = ('terms', 'date_histogram', 'histogram', 'range')
+COMPOSITE_SOURCES = ('terms', 'date_histogram', 'histogram')
+
+# response filter keeping only what hit lists are built from (and took, for the metrics), so elasticsearch does not
+# send and the client does not decode _index/_type/hits.total of every hit. Searches filling the document cache
+# also keep hits.hits._version
+HITS_FILTER_PATH = 'took,hits.hits._id,hits.hits._score,hits.hits._source,hits.hits.fields,' \
+                   'hits.hits.sort'
+
+# list collecting the profile section of every search response while a profiled command is served,
+# None otherwise, see QueryBuilder.command
+profiling = contextvars.ContextVar('profiling', default=None)
+
+
+@timed_storage
 class ElasticBookStorage(object):
+    update_script_stored = False
+    timed_calls = True
 
     def __init__(self):
         self.book_index = ELASTIC_INDEX
@@ -15,86 +172,618 @@ class ElasticBookStorage(object):
         self.ELK_HOSTNAME = ELASTIC_HOSTNAME
         self.ELK_PORT = ELASTIC_PORT
 
-        self.es = Elasticsearch([{
-            'host': self.ELK_HOSTNAME,
-            'port': self.ELK_PORT
-        }])
+        self.es = get_client()
+        self.documents = make_document_cache()
+        self.write_behind = make_write_behind(self.es, self.book_index, self.book_doc, id_field=BOOK_ID_FIELD)
 
-    def create_book_index(self):
+    @staticmethod
+    def _page_body(body, page):
         """
-        The following function is used to create the book index
-        :return: pass
-        :Examples:
+        The following function is used to restrict a search body to one page of hits.
+        Hits are sorted by score with the book id as tie breaker, so pages are stable
+        and every hit carries the sort values used as search_after cursor.
+
+        :param body: search body
+        :param page: page options, {'size': n} plus either 'from' or 'search_after'
+        :return: paged search body
+        """
+        body = dict(body, size=page['size'], sort=PAGE_SORT)
+        if page.get('search_after') is not None:
+            body['search_after'] = page['search_after']
+        else:
+            body['from'] = page.get('from', 0)
+        return body
+
+    @staticmethod
+    def _source_params(projection):
+        """
+        The following function is used to turn a projection into get/mget _source query parameters
+
+        :param projection: projection, {'_source': ..., 'docvalue_fields': [...]}
+        :return: query parameters
+        """
+        if not projection or '_source' not in projection:
+            return {}
+        source = projection['_source']
+        if source is False:
+            return {'_source': 'false'}
+        params = {}
+        if source.get('includes'):
+            params['_source_includes'] = ','.join(source['includes'])
+        if source.get('excludes'):
+            params['_source_excludes'] = ','.join(source['excludes'])
+        return params
+
+    def _search(self, body, stream=False, page=None, projection=None):
+        """
+        The following function is used to run a search body against the book index.
+        When stream is enabled the hits are pulled lazily page by page using the scroll API,
+        so the number of results is not capped by HITS_SIZE and memory stays flat.
+        When page is provided only that page of hits is fetched.
+        When projection is provided only the projected fields are fetched.
+        The response is stripped down to the hits, see HITS_FILTER_PATH.
+        While a command is profiled the search is run with the profile API, see profiling.
+
+        :param body: search body
+        :param stream: return a generator over all hits instead of a list
+        :param page: page options, {'size': n} plus either 'from' or 'search_after'
+        :param projection: projection, {'_source': includes/excludes or False, 'docvalue_fields': [...]}
+        :return: list of hits or hits generator
+
+        :Example:
             >>> elk = ElasticBookStorage()
-            >>> elk.create_book_index()
+            >>> hits = elk._search({"query": {"match_all": {}}}, stream=True)
+            >>> hits = elk._search({"query": {"match_all": {}}}, page={'size': 10, 'from': 20})
+            >>> hits = elk._search({"query": {"match_all": {}}}, projection={'_source': False})
+        """
+        if projection:
+            body = dict(body, **projection)
+        if stream:
+            return helpers.scan(
+                self.es,
+                query=body,
+                index=self.book_index,
+                size=SCROLL_SIZE,
+                scroll=SCROLL_TIMEOUT
+            )
+        if page is not None:
+            body = self._page_body(body, page)
+        profiles = profiling.get()
+        filter_path = HITS_FILTER_PATH
+        if profiles is not None:
+            body, filter_path = dict(body, profile=True), filter_path + ',profile'
+        # hits with their full source populate the document cache, an empty _source list filters nothing
+        caching = self.documents is not None and not projection and body.get('_source') in (None, True, [])
+        if caching:
+            body, filter_path = dict(body, version=True), filter_path + ',hits.hits._version'
+        size = HITS_SIZE if page is None else None
+        results = self.es.search(index=self.book_index, body=body, size=size, filter_path=filter_path)
+        if profiles is not None:
+            profiles.append(results.get("profile"))
+        hits = results.get("hits", {}).get("hits", [])
+        if caching:
+            self.documents.put_docs(hits)
+        return hits
+
+    def _aggregate(self, body):
+        """
+        The following function is used to run an aggregation body against the book index
+
+        :param body: aggregation body
+        :return: aggregations
+        """
+        profiles = profiling.get()
+        if profiles is None:
+            return self.es.search(index=self.book_index, body=body, size=0)["aggregations"]
+        results = self.es.search(index=self.book_index, body=dict(body, profile=True), size=0)
+        profiles.append(results.get("profile"))
+        return results["aggregations"]
+
+    @staticmethod
+    def _by_query_params(wait_for_completion=True, slices=BY_QUERY_SLICES,
+                         requests_per_second=BY_QUERY_REQUESTS_PER_SECOND, refresh=None):
+        """
+        The following function is used to build the query parameters of delete/update by query requests
+
+        :param wait_for_completion: block until done, or return a task id right away
+        :param slices: number of parallel slices, or "auto" for one slice per shard
+        :param requests_per_second: throttle in sub-requests per second, -1 to disable
+        :param refresh: refresh the shards involved before completing (by query requests have no wait_for)
+        :return: query parameters
+        """
+        params = {
+            'wait_for_completion': 'true' if wait_for_completion else 'false',
+            'slices': slices,
+            'requests_per_second': requests_per_second,
+            'conflicts': 'proceed'
+        }
+        if refresh:
+            params['refresh'] = 'true'
+        return params
+
+    @staticmethod
+    def _task_status(task):
+        """
+        The following function is used to summarise the progress of a by query task
+
+        :param task: tasks API response
+        :return: task progress
+        """
+        status = task.get('response') or task['task'].get('status', {})
+        return {
+            'task_id': "{}:{}".format(task['task']['node'], task['task']['id']),
+            'completed': task.get('completed', False),
+            'total': status.get('total', 0),
+            'created': status.get('created', 0),
+            'updated': status.get('updated', 0),
+            'deleted': status.get('deleted', 0),
+            'batches': status.get('batches', 0),
+            'version_conflicts': status.get('version_conflicts', 0),
+            'failures': status.get('failures', []),
+            'error': task.get('error')
+        }
+
+    def _delete_by_query(self, body, params):
+        """
+        The following function is used to delete the documents matching the provided body
+
+        :param body: query body
+        :param params: query parameters, see _by_query_params
+        :return: count of deleted documents, or the task id when not waiting for completion
         """
         try:
-            body = {
-                "mappings": {
-                    "book_doc": {
-                        "properties": {
-                            "title": {
-                                "type": "text"
-                            },
-                            "authors": {
-                                "type": "text"
-                            },
-                            "summary": {
-                                "type": "text"
-                            },
-                            "publish_date": {
-                                "type": "date"
-                            },
-                            "num_reviews": {
-                                "type": "integer"
-                            },
-                            "publisher": {
-                                "type": "text"
-                            }
-                        }
-                    }
+            response = self.es.delete_by_query(index=self.book_index, body=body, params=params)
+        finally:
+            self._clear_documents()
+        if 'task' in response:
+            return {'task_id': response['task']}
+        return {'count': response['deleted']}
+
+    def _put_update_script(self):
+        """
+        The following function is used to store BOOK_UPDATE_SCRIPT in the cluster state
+        under UPDATE_SCRIPT_ID, so update requests only have to reference it
+        """
+        self.es.put_script(id=UPDATE_SCRIPT_ID, body={'script': {'lang': 'painless', 'source': BOOK_UPDATE_SCRIPT}})
+        ElasticBookStorage.update_script_stored = True
+
+    @staticmethod
+    def _update_script(updates):
+        """
+        The following function is used to build the script of an update by query request.
+        Values only travel in params, so every request reuses the same compiled script.
+
+        :param updates: list of {"op", "field", "value"} updates, op is one of UPDATE_OPERATIONS
+        :return: script
+        """
+        for update in updates:
+            if update.get('op', 'set') not in UPDATE_OPERATIONS:
+                raise ValueError("update operation {} is not supported".format(update.get('op')))
+            if not update.get('field'):
+                raise ValueError("update field is missing")
+
+        params = {'updates': [
+            {'op': update.get('op', 'set'), 'field': update['field'], 'value': update.get('value')}
+            for update in updates
+        ]}
+        if USE_STORED_SCRIPTS:
+            return {'id': UPDATE_SCRIPT_ID, 'params': params}
+        return {'lang': 'painless', 'source': BOOK_UPDATE_SCRIPT, 'params': params}
+
+    def _update_by_query(self, body, params):
+        """
+        The following function is used to update the documents matching the provided body
+
+        :param body: query and script body
+        :param params: query parameters, see _by_query_params
+        :return: update by query response, or the task id when not waiting for completion
+        """
+        if USE_STORED_SCRIPTS and not self.update_script_stored:
+            self._put_update_script()
+        try:
+            response = self.es.update_by_query(index=self.book_index, body=body, params=params)
+        finally:
+            self._clear_documents()
+        if 'task' in response:
+            return {'task_id': response['task']}
+        return response
+
+    def _get_task(self, task_id):
+        """
+        The following function is used to fetch the progress of a task
+
+        :param task_id: task id
+        :return: task progress
+        """
+        status = self._task_status(self.es.tasks.get(task_id=task_id))
+        if status['completed']:
+            # background by query tasks may change documents until they complete
+            self._clear_documents()
+        return status
+
+    def _clear_documents(self):
+        """The following function is used to drop every cached document after a write to unknown ids"""
+        if self.documents is not None:
+            self.documents.clear()
+
+    def _mget(self, book_ids, projection=None):
+        """
+        The following function is used to fetch the source of several books.
+        Without projection the books are read through the document cache, see _mget_docs.
+
+        :param book_ids: list of book ids
+        :param projection: projection, see _search
+        :return: book sources, or ids when the projection disables _source or the book is not found
+        """
+        if projection or self.documents is None:
+            book_results = self.es.mget(
+                index=self.book_index,
+                doc_type=self.book_doc,
+                body={'ids': book_ids},
+                params=self._source_params(projection)
+            )
+            return {'docs': [book.get('_source', {'_id': book['_id']}) for book in book_results['docs']]}
+        return {'docs': [book.get('_source', {'_id': book['_id']}) for book in self._mget_docs(book_ids)]}
+
+    def _msearch(self, plans):
+        """
+        The following function is used to run several recorded search requests in one _msearch round trip
+
+        :param plans: list of SearchPlan
+        :return: list of elasticsearch responses, in the same order
+        """
+        lines = []
+        for plan in plans:
+            lines.append({'index': self.book_index})
+            lines.append(dict({'size': 0 if plan.kind == 'aggregations' else HITS_SIZE}, **plan.body))
+        return self.es.msearch(body=lines)['responses']
+
+    def _mget_docs(self, book_ids, projections=None):
+        """
+        The following function is used to fetch several books with _mget.
+        Books in the document cache are served from it, only the other ones are sent to _mget.
+        When some of the books are projected, they are all fetched in one _mget, each doc with its own _source.
+
+        :param book_ids: list of book ids
+        :param projections: list of projections (see _search) matching book_ids, None for whole books
+        :return: list of mget docs (only _id, _source and found for cached books), including not found ones
+        """
+        if projections and any(projections):
+            docs = []
+            for book_id, projection in zip(book_ids, projections):
+                doc = {'_id': str(book_id)}
+                if projection and '_source' in projection:
+                    doc['_source'] = projection['_source']
+                docs.append(doc)
+            return self.es.mget(index=self.book_index, doc_type=self.book_doc, body={'docs': docs})['docs']
+
+        if self.documents is None:
+            return self.es.mget(index=self.book_index, doc_type=self.book_doc, body={'ids': book_ids})['docs']
+
+        cached = self.documents.get_many(book_ids)
+        missing = [book_id for book_id in book_ids if str(book_id) not in cached]
+        fetched = {}
+        if missing:
+            docs = self.es.mget(index=self.book_index, doc_type=self.book_doc, body={'ids': missing})['docs']
+            self.documents.put_docs(docs)
+            fetched = {doc['_id']: doc for doc in docs}
+        return [
+            {'_id': str(book_id), '_source': cached[str(book_id)], 'found': True} if str(book_id) in cached
+            else fetched[str(book_id)]
+            for book_id in book_ids
+        ]
+
+    def book_index_body(self, number_of_shards=None, number_of_replicas=None):
+        """
+        This function is used to build the settings and versioned mapping of the book index.
+        The mapping version is stored in the mapping _meta, see mapping_version.
+
+        :param number_of_shards: primary shards, the cluster default when None
+        :param number_of_replicas: replicas per shard, the cluster default when None
+        :return: create index body
+        """
+        settings = dict(BOOK_INDEX_SETTINGS)
+        if number_of_shards is not None:
+            settings["number_of_shards"] = number_of_shards
+        if number_of_replicas is not None:
+            settings["number_of_replicas"] = number_of_replicas
+        return {
+            "settings": settings,
+            "mappings": {
+                self.book_doc: {
+                    "_meta": {"mapping_version": BOOK_MAPPING_VERSION},
+                    "properties": BOOK_PROPERTIES
                 }
             }
-            self.es.indices.create(index=self.book_index, body=body, ignore=400)
+        }
+
+    def mapping_version(self):
+        """
+        This function is used to read the mapping version of the live book index
+
+        :return: mapping version, 1 for indices created before mappings were versioned, None without index
+        :Examples:
+            >>> elk = ElasticBookStorage()
+            >>> elk.mapping_version() == BOOK_MAPPING_VERSION
+            True
+        """
+        try:
+            return self._mapping_version(self.es.indices.get_mapping(index=self.book_index, ignore=404))
         except Exception as ex:
-            print(ex, flush=True)
-        pass
+            record_error(ex)
 
-    def bulk_insert(self, data):
+    @staticmethod
+    def _mapping_version(mappings):
         """
-        The following function is used to insert bulk data to ElasticSearch
+        The following function is used to read the mapping version of a get mapping response
 
-        :param data: list of dict
-        :return:
+        :param mappings: get mapping response, an error body when there is no index
+        :return: mapping version, see mapping_version
+        """
+        for index_mappings in mappings.values():
+            if not isinstance(index_mappings, dict) or 'mappings' not in index_mappings:
+                continue
+            for mapping in index_mappings['mappings'].values():
+                return mapping.get('_meta', {}).get('mapping_version', 1)
+        return None
+
+    def new_index_name(self):
+        """
+        This function is used to name a new concrete book index, the book_index alias points to one of them
+
+        :return: index name, e.g. book_index_v3_20200120153000
+        """
+        return "{}_v{}_{}".format(self.book_index, BOOK_MAPPING_VERSION, time.strftime("%Y%m%d%H%M%S"))
+
+    def live_indices(self):
+        """
+        This function is used to list the concrete indices served under book_index
+
+        :return: the indices the book_index alias points to, [book_index] when book_index is an index
+            created before aliases were used, [] when there is no book index
+        """
+        if self.es.indices.exists_alias(name=self.book_index):
+            return sorted(self.es.indices.get_alias(name=self.book_index))
+        if self.es.indices.exists(index=self.book_index):
+            return [self.book_index]
+        return []
+
+    def create_book_index(self, number_of_shards=None, number_of_replicas=None):
+        """
+        The following function is used to create the book index, see book_index_body.
+        The index gets a versioned name and book_index is an alias to it, so it can be rebuilt
+        without downtime, see reindex.
+        :param number_of_shards: primary shards, the cluster default when None
+        :param number_of_replicas: replicas per shard, the cluster default when None
+        :return: create index response, None when the book index already exists
+        :Examples:
+            >>> elk = ElasticBookStorage()
+            >>> elk.create_book_index(number_of_shards=3, number_of_replicas=1)
+        """
+        try:
+            if self.live_indices():
+                return None
+            body = dict(self.book_index_body(number_of_shards, number_of_replicas), aliases={self.book_index: {}})
+            return self.es.indices.create(index=self.new_index_name(), body=body)
+        except Exception as ex:
+            record_error(ex)
+
+    def _wait_for_task(self, task_id):
+        """
+        The following function is used to wait for a task to complete
+
+        :param task_id: task id
+        :return: task progress, see _task_status
+        """
+        while True:
+            status = self._get_task(task_id)
+            if status['completed']:
+                return status
+            time.sleep(REINDEX_POLL_INTERVAL)
+
+    def _copy_index(self, source, target, slices):
+        """
+        The following function is used to copy every document of source into target with a sliced
+        _reindex task. Versions are kept (external versioning) so later catch up passes can compare them,
+        and BOOK_ID_SCRIPT copies the id of every document into BOOK_ID_FIELD.
+
+        :param source: source index
+        :param target: target index
+        :param slices: number of parallel slices
+        :return: number of copied documents
+        """
+        body = {
+            "source": {"index": source, "size": REINDEX_BATCH_SIZE},
+            "dest": {"index": target, "version_type": "external"},
+            "script": {"lang": "painless", "source": BOOK_ID_SCRIPT},
+            "conflicts": "proceed"
+        }
+        response = self.es.reindex(body=body, slices=slices, wait_for_completion=False, refresh=True)
+        status = self._wait_for_task(response['task'])
+        if status['error'] or status['failures']:
+            raise RuntimeError("reindex of {} into {} failed: {}".format(
+                source, target, status['error'] or status['failures']))
+        return status['created'] + status['updated']
+
+    def _scan_versions(self, index, slices):
+        """
+        The following function is used to read the version of every document of an index
+        with a parallel sliced scroll, without fetching the sources
+
+        :param index: index name
+        :param slices: number of parallel slices
+        :return: {document id: version}
+        """
+        def scan_slice(slice_id):
+            body = {"query": {"match_all": {}}, "_source": False, "version": True}
+            if slices > 1:
+                body["slice"] = {"id": slice_id, "max": slices}
+            hits = helpers.scan(self.es, query=body, index=index, size=REINDEX_BATCH_SIZE, scroll=SCROLL_TIMEOUT)
+            return {hit['_id']: hit['_version'] for hit in hits}
+
+        versions = {}
+        with ThreadPoolExecutor(max_workers=slices) as executor:
+            for slice_versions in executor.map(scan_slice, range(slices)):
+                versions.update(slice_versions)
+        return versions
+
+    def _catch_up(self, source, target, slices):
+        """
+        The following function is used to apply to target the writes source received since it was copied:
+        documents with a newer version in source are copied again and documents deleted from source are
+        deleted from target
+
+        :param source: source index
+        :param target: target index
+        :param slices: number of parallel slices used to compare the indices
+        :return: number of documents copied or deleted
+        """
+        self.es.indices.refresh(index=source)
+        self.es.indices.refresh(index=target)
+        source_versions = self._scan_versions(source, slices)
+        target_versions = self._scan_versions(target, slices)
+        changed = [doc_id for doc_id, version in source_versions.items() if version > target_versions.get(doc_id, 0)]
+        deleted = [doc_id for doc_id in target_versions if doc_id not in source_versions]
+
+        actions = [{'_op_type': 'delete', '_index': target, '_type': self.book_doc, '_id': doc_id}
+                   for doc_id in deleted]
+        for start in range(0, len(changed), REINDEX_BATCH_SIZE):
+            batch = changed[start:start + REINDEX_BATCH_SIZE]
+            docs = self.es.mget(index=source, doc_type=self.book_doc, body={'ids': batch})
+            actions.extend({'_op_type': 'index', '_index': target, '_type': self.book_doc, '_id': doc['_id'],
+                            '_source': dict(doc['_source'], **{BOOK_ID_FIELD: doc['_id']}),
+                            '_version': doc['_version'], '_version_type': 'external'}
+                           for doc in docs['docs'] if doc.get('found'))
+        if actions:
+            # a version conflict means target already has the newer document, a missing one was deleted again
+            helpers.bulk(self.es, actions, chunk_size=REINDEX_BATCH_SIZE, raise_on_error=False, refresh=True)
+        return len(actions)
+
+    def reindex(self, number_of_shards=None, number_of_replicas=None, slices=REINDEX_SLICES, delete_source=False):
+        """
+        The following function is used to rebuild the book index without downtime: a new versioned index is
+        created with the current book_index_body, the live index is copied into it with a sliced _reindex,
+        the writes made during the copy are caught up by comparing document versions, and the book_index
+        alias is swapped to the new index in one atomic _aliases request. Reads and writes keep going to the
+        live index until the swap. An index created before aliases were used is replaced by the alias.
+
+        :param number_of_shards: primary shards of the new index
+        :param number_of_replicas: replicas per shard of the new index
+        :param slices: number of parallel slices of the copy and of the catch up scans
+        :param delete_source: delete the previous index once the alias is swapped
+        :return: reindex report
+        :Examples:
+            >>> elk = ElasticBookStorage()
+            >>> elk.reindex(number_of_shards=3, number_of_replicas=1, slices=3)
+        """
+        target = None
+        try:
+            start = time.time()
+            sources = self.live_indices()
+            if len(sources) != 1:
+                raise ValueError("{} must point to exactly one index to be reindexed, found {}".format(
+                    self.book_index, sources))
+            source = sources[0]
+            target = self.new_index_name()
+            if target == source:
+                raise ValueError("{} is already the live index".format(target))
+            self.es.indices.create(index=target, body=self.book_index_body(number_of_shards, number_of_replicas))
+
+            copied = self._copy_index(source, target, slices)
+            caught_up, passes = 0, 0
+            while passes < REINDEX_CATCH_UP_PASSES:
+                passes += 1
+                changed = self._catch_up(source, target, slices)
+                caught_up += changed
+                if not changed:
+                    break
+
+            if source == self.book_index:
+                actions = [{'remove_index': {'index': source}}, {'add': {'index': target, 'alias': self.book_index}}]
+            else:
+                actions = [{'remove': {'index': source, 'alias': self.book_index}},
+                           {'add': {'index': target, 'alias': self.book_index}}]
+            self.es.indices.update_aliases(body={'actions': actions})
+            target, created = None, target
+            if delete_source and source != self.book_index:
+                self.es.indices.delete(index=source)
+
+            return {
+                'source': source,
+                'target': created,
+                'copied': copied,
+                'caught_up': caught_up,
+                'catch_up_passes': passes,
+                'source_deleted': delete_source or source == self.book_index,
+                'took': round(time.time() - start, 3)
+            }
+        except Exception as ex:
+            record_error(ex)
+            if target is not None:
+                self.es.indices.delete(index=target, ignore=404)
+
+    def bulk_load_mode(self):
+        """
+        The following function is used to tune the book index for a bulk load, see BulkLoadMode:
+        refreshes and replicas are disabled until the block exits, then the settings are restored,
+        the index is force merged, refreshed once and the load throughput is logged
+
+        :return: BulkLoadMode context manager
+        :Examples:
+            >>> elk = ElasticBookStorage()
+            >>> with elk.bulk_load_mode():
+            ...     elk.bulk_insert("books_1.ndjson")
+            ...     elk.bulk_insert("books_2.ndjson")
+        """
+        return BulkLoadMode(self.es, self.book_index)
+
+    def bulk_insert(self, data, bulk_load=False, refresh=False, **kwargs):
+        """
+        The following function is used to insert bulk data to ElasticSearch.
+        Data is streamed through the BulkIngestEngine, so any iterator or NDJSON file can be loaded.
+        Every book gets its id copied into BOOK_ID_FIELD.
+
+        :param data: list of dict, iterator of dict or NDJSON file path
+        :param bulk_load: run the insert in bulk_load_mode
+        :param refresh: refresh the index once the data is in, so it is searchable on return (bulk_load always does)
+        :param kwargs: BulkIngestEngine options (chunk_size, max_chunk_bytes, thread_count, id_field, first_id, ...)
+        :return: ingest report
 
         Example:
             >>> data = [{ "title": "Solr in Action", "authors": ["trey grainger", "timothy potter"], "summary" : "Comprehensive guide","publish_date" : "2015-12-03", "num_reviews": 18, "publisher": "manning" }]
             >>> bulk_insert(data)
+            >>> bulk_insert("books.ndjson", bulk_load=True, thread_count=8)
         """
         try:
-            actions = [
-                {
-                    "_index": self.book_index,
-                    "_type": self.book_doc,
-                    "_id": i,
-                    "_source": data[i]
-                }
-                for i in range(len(data))
-            ]
-            helpers.bulk(self.es, actions=actions)
+            engine = BulkIngestEngine(self.es, self.book_index, self.book_doc, id_copy=BOOK_ID_FIELD, **kwargs)
+            if not bulk_load:
+                report = engine.ingest(data)
+                if refresh:
+                    self.es.indices.refresh(index=self.book_index)
+                return report
+            with self.bulk_load_mode() as mode:
+                report = engine.ingest(data)
+            return dict(report, bulk_load=mode.report)
         except Exception as e:
-            print(e, flush=True)
+            record_error(e)
+        finally:
+            # documents given an id_field may replace cached books
+            self._clear_documents()
 
-    def create_book_doc(self, title, authors, summary, publisher, num_reviews, publish_date):
+    def create_book_doc(self, title, authors, summary, publisher, num_reviews, publish_date, wait=True, refresh=None):
         """
-        The following function is used to create a book entry to elasticsearch using the provided info
+        The following function is used to create a book entry to elasticsearch using the provided info.
+        With the write-behind buffer (WRITE_BEHIND) the book is queued and sent in a _bulk request
+        shared with the other queued books. The id is generated here, so it is copied into BOOK_ID_FIELD.
         :param title: book title
         :param authors: book authors
         :param summary: book summary
         :param publisher: book publisher
         :param num_reviews: book number of reviews
         :param publish_date: book publish date
-        :return: pass
+        :param wait: wait for the durable ack of a queued book, or return a Future of it right away
+        :param refresh: None, "wait_for" to return once the book is searchable, or True to refresh now
+        :return: index response, or its Future when a queued book is not waited for
 
         :Example:
             >>> title="Some book"
@@ -105,9 +794,11 @@ class ElasticBookStorage(object):
             >>> publish_date = "2014-04-05"
             >>> elk = ElasticBookStorage()
             >>> elk.create_book_doc(title, authors, summary, publisher, num_reviews, publish_date)
+            >>> future = elk.create_book_doc(title, authors, summary, publisher, num_reviews, publish_date, wait=False)
         """
         try:
             body = {
+                BOOK_ID_FIELD: new_doc_id(),
                 "title": title,
                 "authors": authors,
                 "summary": summary,
@@ -115,14 +806,40 @@ class ElasticBookStorage(object):
                 "num_reviews": num_reviews,
                 "publish_date": publish_date
             }
-            self.es.index(index=self.book_index, doc_type=self.book_doc, body=body)
+            refresh = 'true' if refresh is True else refresh or None
+            if self.write_behind is not None:
+                future = self.write_behind.submit(body, refresh)
+                if self.documents is not None:
+                    future.add_done_callback(functools.partial(self._cache_created, body))
+                return future.result() if wait else future
+
+            params = {'refresh': refresh} if refresh else {}
+            if self.documents is None:
+                return self.es.index(index=self.book_index, doc_type=self.book_doc, id=body[BOOK_ID_FIELD], body=body,
+                                     params=params)
+            response = self.es.index(index=self.book_index, doc_type=self.book_doc, id=body[BOOK_ID_FIELD], body=body,
+                                     params=params)
+            self.documents.put(response['_id'], body, response['_version'])
+            return response
         except Exception as e:
-            print(e, flush=True)
+            record_error(e)
+
+    def _cache_created(self, body, future):
+        """
+        The following function is used to cache a book created through the write-behind buffer once acknowledged
 
-    def retrieve_book_by_id(self, book_id):
+        :param body: book source
+        :param future: Future of the bulk item response
         """
-        The following function is used to retrieve a book document from the elastic search using is ID
+        if future.exception() is None:
+            self.documents.put(future.result()['_id'], body, future.result()['_version'])
+
+    def retrieve_book_by_id(self, book_id, projection=None):
+        """
+        The following function is used to retrieve a book document from the elastic search using is ID.
+        Without projection the book is read through the document cache.
         :param book_id: book id
+        :param projection: projection, see _search
         :return: result document
 
         :Example:
@@ -130,33 +847,67 @@ class ElasticBookStorage(object):
             >>> book = elk.retrieve_book_by_id(book_id=2)
         """
         try:
-            results = self.es.get_source(index=self.book_index, doc_type=self.book_doc, id=str(book_id))
-            return results
+            if projection or self.documents is None:
+                return self.es.get_source(
+                    index=self.book_index,
+                    doc_type=self.book_doc,
+                    id=str(book_id),
+                    params=self._source_params(projection)
+                )
+            doc = self._mget_docs([book_id])[0]
+            if not doc['found']:
+                # the error get_source raises for a missing book
+                raise NotFoundError(404, 'not_found', doc)
+            return doc['_source']
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
-    def remove_book_doc(self, book_id):
+    def remove_book_doc(self, book_id, refresh=None, with_source=False):
         """
         The following function is used to remove a book entry from elastic search
         using its ID
         :param book_id: book ID
-        :return:
+        :param refresh: None, "wait_for" to return once the removal is visible to searches, or True to refresh now
+        :param with_source: delete through the update API (BOOK_DELETE_SCRIPT) so the response carries the
+            removed source in get._source, in the same request
+        :return: delete response
 
         :Example:
             >>> elk = ElasticBookStorage()
             >>> elk.remove_book_doc(book_id=2)
+            >>> elk.remove_book_doc(book_id=3, with_source=True)['get']['_source']
         """
         try:
-            self.es.delete(index=self.book_index, doc_type=self.book_doc, id=str(book_id))
+            refresh = 'true' if refresh is True else refresh or None
+            params = {'refresh': refresh} if refresh else {}
+            if with_source:
+                delete = functools.partial(self.es.update, index=self.book_index, doc_type=self.book_doc,
+                                           id=str(book_id), body={'script': BOOK_DELETE_SCRIPT},
+                                           params=dict(params, _source='true'))
+            else:
+                delete = functools.partial(self.es.delete, index=self.book_index, doc_type=self.book_doc,
+                                           id=str(book_id), params=params)
+            if self.documents is None:
+                return delete()
+            try:
+                response = delete()
+            except Exception:
+                self.documents.remove(book_id)
+                raise
+            self.documents.remove(book_id, response['_version'])
+            return response
         except Exception as e:
-            print(e, flush=True)
+            record_error(e)
 
-    def multi_match_query(self, query):
+    def multi_match_query(self, query, stream=False, page=None, projection=None):
         """
         The following function is used to perform a basic match query using elastic search
         functionalities
 
         :param query: provided query parameter
+        :param stream: stream all hits using the scroll API
+        :param page: fetch a single page of hits, see _search
+        :param projection: fetch only the projected fields, see _search
         :return: results
 
         :Examples:
@@ -164,12 +915,19 @@ class ElasticBookStorage(object):
             >>> results = elk.basic_match_query(query="guide")
         """
         try:
-            results = self.es.search(index=self.book_index, q=query, size=HITS_SIZE)["hits"]["hits"]
+            body = {
+                "query": {
+                    "query_string": {
+                        "query": query
+                    }
+                }
+            }
+            results = self._search(body, stream=stream, page=page, projection=projection)
             return results
         except Exception as e:
-            print(e, flush=True)
+            record_error(e)
 
-    def search_book_by_param(self, *args, _source=[]):
+    def search_book_by_param(self, *args, _source=[], stream=False, page=None, projection=None):
         """
         The following function is used to retrieve results from
         elastic search searching for books that contains in their title
@@ -177,6 +935,9 @@ class ElasticBookStorage(object):
         the provided query
         :param _source: source argument
         :param query: provided query to search
+        :param stream: stream all hits using the scroll API
+        :param page: fetch a single page of hits, see _search
+        :param projection: fetch only the projected fields, see _search
         :return: results
 
         :Examples:
@@ -196,12 +957,12 @@ class ElasticBookStorage(object):
                 },
                 "_source": _source
             }
-            results = self.es.search(index=self.book_index, body=body, size=HITS_SIZE)["hits"]["hits"]
+            results = self._search(body, stream=stream, page=page, projection=projection)
             return results
         except Exception as ee:
-            print(ee, flush=True)
+            record_error(ee)
 
-    def fuzzy_queries(self, query, _source=[], **kwargs):
+    def fuzzy_queries(self, query, _source=[], stream=False, page=None, projection=None, **kwargs):
         """
         The following function receives a query and search to match books using the provided query
         to match books title and summary using Fuzzy matching.
@@ -212,6 +973,9 @@ class ElasticBookStorage(object):
         as another string.
 
         :param query: provided query
+        :param stream: stream all hits using the scroll API
+        :param page: fetch a single page of hits, see _search
+        :param projection: fetch only the projected fields, see _search
         :return: results
 
         :Examples:
@@ -229,21 +993,23 @@ class ElasticBookStorage(object):
                         "fuzziness": "AUTO"
                     }
                 },
-                "_source": _source,
-                "size": 1
+                "_source": _source
             }
 
-            results = self.es.search(index=self.book_index, body=body, size=HITS_SIZE)["hits"]["hits"]
+            results = self._search(body, stream=stream, page=page, projection=projection)
             return results
         except Exception as ee:
-            print(ee, flush=True)
+            record_error(ee)
 
-    def wild_card_query(self, _source=[], **kwargs):
+    def wild_card_query(self, _source=[], stream=False, page=None, projection=None, **kwargs):
         """
         This function is used to perform ElasticSearch wild card queries
 
         :param args: given arguments
         :param query: given query
+        :param stream: stream all hits using the scroll API
+        :param page: fetch a single page of hits, see _search
+        :param projection: fetch only the projected fields, see _search
         :return:
 
         Example:
@@ -259,31 +1025,29 @@ class ElasticBookStorage(object):
                         "{}".format(field): query
                     }
                 },
-                "highlight": {
-                    "fields": {
-                        "".format(field): {}
-                    }
-                },
                 "_source": _source
             }
-            results = self.es.search(index=self.book_index, body=body, size=HITS_SIZE)["hits"]["hits"]
+            results = self._search(body, stream=stream, page=page, projection=projection)
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
-    def regex_query(self, **kwargs):
+    def regex_query(self, stream=False, page=None, projection=None, **kwargs):
         """
         Regexp queries allow you to specify more complex patterns than wildcard queries
 
         :param query: provided query
         :param args: provided arguments
+        :param stream: stream all hits using the scroll API
+        :param page: fetch a single page of hits, see _search
+        :param projection: fetch only the projected fields, see _search
         :return:
 
         Example:
             >>> regex_query("authors", query="t[a-z]*y")
         """
         try:
-            field = kwargs['field'],
+            field = kwargs['field']
             query = kwargs['query']
 
             body = {
@@ -291,19 +1055,14 @@ class ElasticBookStorage(object):
                     "regexp": {
                         "{}".format(field): query
                     }
-                },
-                "highlight": {
-                    "fields": {
-                        "{}".format(field): {}
-                    }
-                },
+                }
             }
-            results = self.es.search(index=self.book_index, body=body, size=HITS_SIZE)["hits"]["hits"]
+            results = self._search(body, stream=stream, page=page, projection=projection)
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
-    def match_phrase_query(self, query, **kwargs):
+    def match_phrase_query(self, query, stream=False, page=None, projection=None, **kwargs):
         """
         The match phrase query requires that all the terms in the query string be present in the document,
         be in the order specified in the query string and be close to each other.
@@ -311,6 +1070,9 @@ class ElasticBookStorage(object):
         indicates how far apart terms are allowed to be while still considering the document a match.
 
         :param query: provided query
+        :param stream: stream all hits using the scroll API
+        :param page: fetch a single page of hits, see _search
+        :param projection: fetch only the projected fields, see _search
         :param kwargs: provided kwargs
         :return:
 
@@ -330,145 +1092,198 @@ class ElasticBookStorage(object):
                         "slop": slop
                     }
                 },
-                "_source": []
+                "_source": kwargs.get("_source", [])
             }
-            results = self.es.search(index=self.book_index, body=body, size=HITS_SIZE)["hits"]["hits"]
+            results = self._search(body, stream=stream, page=page, projection=projection)
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
-    def match_phrase_prefix(self, query, slop, max_expansions=10, _source=[]):
+    def match_phrase_prefix(self, query, slop, max_expansions=10, fields=None, _source=[], stream=False, page=None,
+                            projection=None):
         """
         Match phrase prefix queries provide search-as-you-type or a poor man’s version of autocomplete at query
         time without needing to prepare your data in any way.Like the match_phrase query,
         it accepts a slop parameter to make the word order and relative positions somewhat less rigid.
         It also accepts the max_expansions parameter to limit the number of terms matched in order to reduce resource intensity.
+        Fields with an autocomplete sub-field (title, authors) have their prefixes indexed, they are searched
+        with a plain phrase query on that sub-field instead, without expanding prefixes at query time.
 
         :param query: provided query
         :param slop: provided slop
         :param max_expansions: provided max expansions
+        :param fields: fields to search, summary by default
+        :param stream: stream all hits using the scroll API
+        :param page: fetch a single page of hits, see _search
+        :param projection: fetch only the projected fields, see _search
         :return:
 
         Example:
             >>> match_phrase_prefix(query="search en", slop=3)
+            >>> match_phrase_prefix(query="elasticsearch in ac", slop=0, fields=["title", "authors"])
         """
         try:
-            body = {
-                "query": {
-                    "match_phrase_prefix": {
-                        "summary": {
-                            "query": query,
-                            "slop": slop,
-                            "max_expansions": max_expansions
-                        }
+            fields = fields or ["summary"]
+            autocomplete = ["{}.autocomplete".format(field) for field in fields if field in AUTOCOMPLETE_FIELDS]
+            expanded = [field for field in fields if field not in AUTOCOMPLETE_FIELDS]
+
+            queries = []
+            if autocomplete:
+                queries.append({
+                    "multi_match": {
+                        "query": query,
+                        "fields": autocomplete,
+                        "type": "phrase",
+                        "slop": slop
                     }
-                },
+                })
+            if expanded:
+                queries.append({
+                    "multi_match": {
+                        "query": query,
+                        "fields": expanded,
+                        "type": "phrase_prefix",
+                        "slop": slop,
+                        "max_expansions": max_expansions
+                    }
+                })
+
+            body = {
+                "query": queries[0] if len(queries) == 1 else {"dis_max": {"queries": queries}},
                 "_source": _source
             }
-            results = self.es.search(index=self.book_index, body=body, size=HITS_SIZE)["hits"]["hits"]
+            results = self._search(body, stream=stream, page=page, projection=projection)
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
-    def term_query(self, _source=[], **kwargs):
+    def term_query(self, _source=[], stream=False, page=None, projection=None, **kwargs):
         """
         The above examples have been examples of full-text search.
 
+        :param stream: stream all hits using the scroll API
+        :param page: fetch a single page of hits, see _search
+        :param projection: fetch only the projected fields, see _search
         :param kwargs: provided kwargs
         :return:
 
         Example:
             >>> term_query(field="publisher", term="manning")
+            >>> term_query(field="authors", term="trey grainger")
         """
         try:
             field = kwargs["field"]
             term = kwargs["term"]
 
-            if isinstance(term, list):
-                term_or_terms = "terms"
-            else:
-                term_or_terms = "term"
-
             body = {
-                "query": {
-                    "{}".format(term_or_terms): {
-                        "{}".format(field): term
-                    }
-                },
+                "query": self._exact_query(field, term),
                 "_source": _source
             }
-            results = self.es.search(index=self.book_index, body=body, size=HITS_SIZE)["hits"]["hits"]
+            results = self._search(body, stream=stream, page=page, projection=projection)
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
-    def delete_by_query(self, query, fields):
+    @staticmethod
+    def _exact_query(field, value):
         """
-        This function is used to delete by query
+        This function is used to build an exact match of a value, or list of values. Fields with a
+        keyword sub-field match the whole (case insensitive) value there, so multi-word authors and
+        publishers match, and still match single words on the analyzed field.
+
+        :param field: field name
+        :param value: value or list of values
+        :return: query clause
+
+        Example:
+            >>> ElasticBookStorage._exact_query("num_reviews", 18)
+            {'term': {'num_reviews': 18}}
+        """
+        kind = "terms" if isinstance(value, list) else "term"
+        if field not in KEYWORD_FIELDS:
+            return {kind: {field: value}}
+        return {
+            "bool": {
+                "should": [
+                    {kind: {"{}.keyword".format(field): value}},
+                    {kind: {field: value}}
+                ],
+                "minimum_should_match": 1
+            }
+        }
+
+    def delete_by_query(self, query, fields, **kwargs):
+        """
+        This function is used to delete by query.
+        Large deletes should not wait for completion: they return a task id right away
+        and their progress is available through get_task.
 
         :param query: provided query
         :param fields: provided fields
-        :return:
+        :param kwargs: wait_for_completion, slices, requests_per_second and refresh, see _by_query_params
+        :return: count of deleted documents, or the task id
 
         Example:
             >>> delete_by_query(query="python", fields=['title'])
+            >>> delete_by_query(query="python", fields=['title'], wait_for_completion=False, requests_per_second=500)
         """
         try:
-            client = Elasticsearch(
-                hosts=ELASTIC_HOSTNAME
-            )
-            s = Search(using=client, index=self.book_index)
+            s = Search(index=self.book_index)
 
             retrieved_items = s.query(
                 Q("multi_match", query=query, fields=fields)
             )
-            retrieved_items.delete()
-
-            results = {'count': retrieved_items.count()}
+            results = self._delete_by_query(retrieved_items.to_dict(), self._by_query_params(**kwargs))
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
     def update_by_query(self, **kwargs):
         """
-        This function is used to update ElasticSearch entries by record
+        This function is used to update ElasticSearch entries by record.
+        Several fields can be updated in one pass with typed operations: set a value,
+        inc(rement) a number, append a value to an array or remove it from an array.
+        Large updates should not wait for completion: they return a task id right away
+        and their progress is available through get_task.
 
-        :param kwargs: provided kwargs
-        :return:
+        :param kwargs: provided kwargs, plus wait_for_completion, slices, requests_per_second and refresh
+        :return: update by query response, or the task id
 
         Example:
             >>> update_by_query(fields="publisher", query="oreilly", field_to_update="publisher", new_value="OnMedia")
+            >>> update_by_query(fields=["title"], query="elasticsearch", updates=[
+            ...     {"op": "inc", "field": "num_reviews", "value": 1},
+            ...     {"op": "append", "field": "authors", "value": "zachary tong"}])
         """
         try:
-            client = Elasticsearch(
-                hosts=ELASTIC_HOSTNAME
-            )
-            ubq = UpdateByQuery(
-                using=client,
-                index=self.book_index
-            )
+            ubq = UpdateByQuery(index=self.book_index)
 
-            search_fields = kwargs["fields"]
-            query = kwargs["query"]
-            field_to_update = kwargs["field_to_update"]
-            new_value = kwargs["new_value"]
+            search_fields = kwargs.pop("fields")
+            query = kwargs.pop("query")
+            if "updates" in kwargs:
+                updates = kwargs.pop("updates")
+            else:
+                updates = [{"op": "set", "field": kwargs.pop("field_to_update"), "value": kwargs.pop("new_value")}]
 
             update_query = ubq.query(
                 "multi_match",
                 query=query,
                 fields=search_fields
             ).script(
-                source="ctx._source.{}='{}'".format(field_to_update, new_value)
+                **self._update_script(updates)
             )
-            results = update_query.execute()._d_
+            results = self._update_by_query(update_query.to_dict(), self._by_query_params(**kwargs))
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
-    def query_combination(self, **kwargs):
+    def query_combination(self, stream=False, page=None, projection=None, **kwargs):
         """
         This function performs Combined bool queries
 
+        :param stream: stream all hits using the scroll API
+        :param page: fetch a single page of hits, see _search
+        :param projection: fetch only the projected fields, see _search
         :param kwargs: provided kwargs
         :return:
 
@@ -480,11 +1295,7 @@ class ElasticBookStorage(object):
 
         """
         try:
-            client = Elasticsearch(
-                hosts=ELASTIC_HOSTNAME
-            )
-
-            s = Search(using=client, index=self.book_index)
+            s = Search(index=self.book_index)
 
             q = Q('bool',
                   must=[
@@ -498,16 +1309,19 @@ class ElasticBookStorage(object):
                             for m in kwargs["must_not"]] if "must_not" in kwargs.keys() else [],
                   minimum_should_match=1
                   )
-            response = s.query(q).execute()["hits"]["hits"]
-            return response.__dict__['_l_']
+            response = self._search(s.query(q).to_dict(), stream=stream, page=page, projection=projection)
+            return response
 
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
-    def range_query(self, **kwargs):
+    def range_query(self, stream=False, page=None, projection=None, **kwargs):
         """
         The following function is used to fetch elastic search records based on range queries
 
+        :param stream: stream all hits using the scroll API
+        :param page: fetch a single page of hits, see _search
+        :param projection: fetch only the projected fields, see _search
         :param kwargs: provided kwargs
         :return: elastic search response
 
@@ -525,10 +1339,10 @@ class ElasticBookStorage(object):
                     }
                 },
             }
-            results = self.es.search(index=self.book_index, body=body, size=HITS_SIZE)["hits"]["hits"]
+            results = self._search(body, stream=stream, page=page, projection=projection)
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
     def metric_aggregations(self, **kwargs):
         """
@@ -555,10 +1369,10 @@ class ElasticBookStorage(object):
                 }
             }
 
-            results = self.es.search(index=self.book_index, body=body, size=0)["aggregations"]
+            results = self._aggregate(body)
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
     def filter_aggregations(self, **kwargs):
         """
@@ -578,7 +1392,7 @@ class ElasticBookStorage(object):
             body = {
                 "aggs": {
                     "aggregated_data": {
-                        "filter": {"term": {"{}".format(term): query}},
+                        "filter": self._exact_query(term, query),
                         "aggs": {
                             "{}_{}".format(metric, field): {"{}".format(metric): {"field": field}}
                         }
@@ -586,10 +1400,10 @@ class ElasticBookStorage(object):
                 }
             }
 
-            results = self.es.search(index=self.book_index, body=body, size=0)["aggregations"]
+            results = self._aggregate(body)
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
     def reviews_range_aggregation(self, **kwargs):
         """
@@ -615,15 +1429,156 @@ class ElasticBookStorage(object):
                     }
                 }
             }
-            results = self.es.search(index=self.book_index, body=body, size=0)["aggregations"]
+            results = self._aggregate(body)
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
+
+    @staticmethod
+    def _aggregation_field(field):
+        """
+        The following function is used to name the field an aggregation reads, text fields are
+        aggregated on their keyword sub-field
+
+        :param field: book field
+        :return: aggregatable field
+        """
+        return "{}.keyword".format(field) if field in KEYWORD_FIELDS else field
+
+    def _metric_aggs(self, metrics):
+        """
+        The following function is used to build metric aggregations named <metric>_<field>
+
+        :param metrics: list of {"field", "metric"}, percentiles take optional "percents"
+        :return: aggregations body
+        """
+        aggs = {}
+        for spec in metrics or []:
+            metric, field = spec['metric'], spec['field']
+            if metric not in AGGREGATION_METRICS:
+                raise ValueError("unsupported metric [{}], expected one of {}".format(metric, AGGREGATION_METRICS))
+            options = {"field": self._aggregation_field(field)}
+            if metric == 'percentiles' and 'percents' in spec:
+                options["percents"] = spec['percents']
+            aggs["{}_{}".format(metric, field)] = {metric: options}
+        return aggs
+
+    def _bucket_agg(self, spec, composite=False):
+        """
+        The following function is used to build a bucket aggregation named <type>_<field>
+
+        :param spec: {"type", "field"} plus "size" for terms, "interval" for date_histogram and histogram,
+            "ranges" for range
+        :param composite: build a composite source, which is paged by the composite size
+        :return: tuple of (name, aggregation type, options)
+        """
+        kind, field = spec['type'], spec['field']
+        allowed = COMPOSITE_SOURCES if composite else BUCKET_AGGREGATIONS
+        if kind not in allowed:
+            raise ValueError("unsupported bucket aggregation [{}], expected one of {}".format(kind, allowed))
+        options = {"field": self._aggregation_field(field)}
+        if kind == 'terms' and not composite:
+            options["size"] = spec.get('size', TERMS_AGGREGATION_SIZE)
+        elif kind == 'date_histogram':
+            options["interval"] = spec.get('interval', DATE_HISTOGRAM_INTERVAL)
+        elif kind == 'histogram':
+            options["interval"] = spec['interval']
+        elif kind == 'range':
+            options["ranges"] = spec['ranges']
+        return "{}_{}".format(kind, field), kind, options
+
+    def _filters_query(self, filters):
+        """
+        The following function is used to restrict an aggregation to the books matching exact filters
+
+        :param filters: list of [field, value] pairs
+        :return: query clause
+        """
+        return {"bool": {"filter": [self._exact_query(field, value) for field, value in filters]}}
+
+    def aggregate(self, metrics=None, buckets=None, filters=None):
+        """
+        The following function is used to compute many metrics and nested bucket aggregations in one request.
+        Buckets are nested in the given order and the metrics are computed over the whole selection
+        and inside every innermost bucket.
+
+        :param metrics: list of {"field", "metric"}, see AGGREGATION_METRICS
+        :param buckets: list of bucket aggregations, see _bucket_agg
+        :param filters: list of [field, value] exact filters applied before aggregating
+        :return: aggregated results
+
+        Examples:
+            >>> elk = ElasticBookStorage()
+            >>> res = elk.aggregate(
+            ...     metrics=[{"field": "num_reviews", "metric": "stats"}, {"field": "authors", "metric": "cardinality"}],
+            ...     buckets=[{"type": "terms", "field": "publisher"}, {"type": "date_histogram", "field": "publish_date"}]
+            ... )
+        """
+        try:
+            aggs = self._metric_aggs(metrics)
+            nested = dict(aggs)
+            for spec in reversed(buckets or []):
+                name, kind, options = self._bucket_agg(spec)
+                bucket = {kind: options}
+                if nested:
+                    bucket["aggs"] = nested
+                nested = {name: bucket}
+            if buckets:
+                aggs.update(nested)
+            if not aggs:
+                raise ValueError("aggregate needs metrics or buckets")
+
+            body = {"aggs": aggs}
+            if filters:
+                body["query"] = self._filters_query(filters)
+            return self._aggregate(body)
+        except Exception as ex:
+            record_error(ex)
 
-    def multi_get_books(self, **kwargs):
+    def composite_aggregation(self, sources, size=COMPOSITE_PAGE_SIZE, after=None, metrics=None, filters=None):
+        """
+        The following function is used to walk the buckets of every combination of the sources one page at a time,
+        so high-cardinality fields like authors can be aggregated without building every bucket at once.
+        Pass the after_key of a page as after to get the next one, the last page has no after_key.
+
+        :param sources: list of {"type", "field"} terms, date_histogram or histogram sources
+        :param size: buckets per page, capped by MAX_PAGE_SIZE
+        :param after: after_key of the previous page
+        :param metrics: list of {"field", "metric"} computed in every bucket
+        :param filters: list of [field, value] exact filters applied before aggregating
+        :return: aggregated results, {"composite": {"buckets": [...], "after_key": {...}}}
+
+        Examples:
+            >>> elk = ElasticBookStorage()
+            >>> page = elk.composite_aggregation([{"type": "terms", "field": "authors"}], size=50,
+            ...                                  metrics=[{"field": "num_reviews", "metric": "avg"}])
+            >>> page = elk.composite_aggregation([{"type": "terms", "field": "authors"}], size=50,
+            ...                                  after=page["composite"]["after_key"])
+        """
+        try:
+            composite = {"size": min(int(size), MAX_PAGE_SIZE), "sources": []}
+            for spec in sources:
+                name, kind, options = self._bucket_agg(spec, composite=True)
+                composite["sources"].append({name: {kind: options}})
+            if after:
+                composite["after"] = after
+
+            aggregation = {"composite": composite}
+            metric_aggs = self._metric_aggs(metrics)
+            if metric_aggs:
+                aggregation["aggs"] = metric_aggs
+            body = {"aggs": {"composite": aggregation}}
+            if filters:
+                body["query"] = self._filters_query(filters)
+            return self._aggregate(body)
+        except Exception as ex:
+            record_error(ex)
+
+    def multi_get_books(self, projection=None, **kwargs):
         """
         The following function is used to fetch books based on ElasticSearch mget API
 
+        :param projection: projection, see _search
         :param kwargs: provided kwargs
         :return: elastic search response
 
@@ -634,16 +1589,27 @@ class ElasticBookStorage(object):
         try:
             book_ids = kwargs['ids']
 
-            book_results = self.es.mget(
-                index=self.book_index,
-                doc_type=self.book_doc,
-                body={'ids': book_ids},
-            )
-            book_docs = book_results['docs']
-            results = {'docs': [book['_source'] for book in book_docs]}
+            results = self._mget(book_ids, projection=projection)
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
+
+    def get_task(self, task_id):
+        """
+        This function is used to retrieve the progress of a delete/update by query task
+
+        :param task_id: task id returned by delete_by_query or update_by_query
+        :return: task progress (completed, total, updated, deleted, batches, ...)
+
+        Examples:
+            >>> elk = ElasticBookStorage()
+            >>> progress = elk.get_task("oTUltX4IQMOUUVeiohTt8A:12345")
+        """
+        try:
+            results = self._get_task(task_id)
+            return results
+        except Exception as ex:
+            record_error(ex)
 
     def get_cluster_health(self):
         """This function is used to retrieve cluster health info"""
@@ -651,7 +1617,7 @@ class ElasticBookStorage(object):
             cluster_health = self.es.cluster.health()
             return cluster_health
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
 
     def get_cluster_stats(self):
         """This function is used to retrieve cluster stats info"""
@@ -659,20 +1625,67 @@ class ElasticBookStorage(object):
             cluster_stats = self.es.cluster.stats()
             return cluster_stats
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
+
+    def fetch_all_docs(self, stream=False, page=None, projection=None):
+        """
+        This function is used to returned all stored books
 
-    def fetch_all_docs(self):
-        """This function is used to returned all stored books"""
+        :param stream: stream all hits using the scroll API
+        :param page: fetch a single page of hits, see _search
+        :param projection: fetch only the projected fields, see _search
+        :return: results
+        """
         try:
             body = {
                 "query": {
                     "match_all": {}
                 }
             }
-            results = self.es.search(
-                index=self.book_index,
-                body=body,
-                size=HITS_SIZE)["hits"]["hits"]
+            results = self._search(body, stream=stream, page=page, projection=projection)
             return results
         except Exception as ex:
-            print(ex, flush=True)
+            record_error(ex)
+
+
+class SearchRecorder(ElasticBookStorage):
+    """
+    ElasticBookStorage that records the search requests of the query methods as SearchPlan
+    objects instead of executing them, so several of them can be sent in one _msearch.
+
+    :Example:
+        >>> recorder = SearchRecorder(ElasticBookStorage())
+        >>> plan = recorder.fetch_all_docs()
+    """
+
+    timed_calls = False
+
+    def __init__(self, storage):
+        self.book_index = storage.book_index
+        self.book_doc = storage.book_doc
+        self.ELK_HOSTNAME = storage.ELK_HOSTNAME
+        self.ELK_PORT = storage.ELK_PORT
+        self.es = storage.es
+        self.documents = None
+        self.write_behind = None
+
+    def _search(self, body, stream=False, page=None, projection=None):
+        if projection:
+            body = dict(body, **projection)
+        return SearchPlan('hits', self._page_body(body, page) if page is not None else body)
+
+    def _aggregate(self, body):
+        return SearchPlan('aggregations', body)
+
+
+def make_storage():
+    """
+    This function is used to create the storage configured by STORAGE_BACKEND
+
+    :return: ElasticBookStorage, or EmbeddedBookStorage for the embedded backend
+    """
+    if STORAGE_BACKEND == 'embedded':
+        from embedded_storage_client import EmbeddedBookStorage
+
+        return EmbeddedBookStorage()
+    return ElasticBookStorage()
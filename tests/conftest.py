@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.append(os.path.join(ROOT_DIR, 'benchmarks'))
+
+# books are always read from the index, the document cache would hide what the backend answers
+os.environ['DOC_CACHE_MAX_BYTES'] = '0'
+
+from elasticsearch import Elasticsearch  # noqa: E402
+
+from embedded_storage_client import EmbeddedClient  # noqa: E402
+from es_standin import start_standin  # noqa: E402
+from initializer import DATA  # noqa: E402
+from storage_client import ElasticBookStorage  # noqa: E402
+
+# elasticsearch 6.6 response bodies, the create index, create book and cluster health ones are the
+# samples of elasticsearch_api_calls
+RESPONSES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'responses')
+
+
+def recorded(name):
+    """
+    This function is used to load an elasticsearch response body from tests/responses
+
+    :param name: file name, without .json
+    :return: response body
+    """
+    with open(os.path.join(RESPONSES_DIR, name + '.json')) as f:
+        return json.load(f)
+
+
+def stored(book_id):
+    """
+    This function is used to build the source the storage fixture keeps for an initializer book,
+    the book plus its book_id copy of the document id
+
+    :param book_id: position of the book in DATA, its document id
+    :return: book source
+    """
+    return dict(DATA[book_id], book_id=str(book_id))
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if value is None:
+        return 'null'
+    return type(value).__name__
+
+
+def assert_shape(actual, expected, subset=False, path='response'):
+    """
+    This function is used to check that a response has the shape of an elasticsearch one: the same keys
+    at every level and values of the same JSON type. Lists are compared item by item when they have the
+    same length, against the first expected item otherwise.
+
+    :param actual: response to check
+    :param expected: elasticsearch response
+    :param subset: only check that actual has no key elasticsearch does not send
+    :param path: location in the response, for the failure message
+    """
+    assert _kind(actual) == _kind(expected), "{}: {} instead of {}".format(path, _kind(actual), _kind(expected))
+    if isinstance(expected, dict):
+        missing = [] if subset else sorted(set(expected) - set(actual))
+        unexpected = sorted(set(actual) - set(expected))
+        assert not missing and not unexpected, "{}: missing {}, unexpected {}".format(path, missing, unexpected)
+        for key, value in actual.items():
+            assert_shape(value, expected[key], subset, "{}.{}".format(path, key))
+    elif isinstance(expected, list) and expected:
+        for i, item in enumerate(actual):
+            assert_shape(item, expected[i] if len(actual) == len(expected) else expected[0], subset,
+                         "{}[{}]".format(path, i))
+
+
+@pytest.fixture(params=['embedded', 'standin'])
+def storage(request, tmp_path):
+    """
+    ElasticBookStorage over a book index seeded with the initializer books, answered either in-process
+    by an EmbeddedClient or by the elasticsearch-py client through the HTTP stand-in
+    """
+    if request.param == 'embedded':
+        es = EmbeddedClient(str(tmp_path))
+        request.addfinalizer(es.close)
+    else:
+        server = start_standin(data_dir=str(tmp_path))
+        request.addfinalizer(server.es.close)
+        request.addfinalizer(server.server_close)
+        request.addfinalizer(server.shutdown)
+        es = Elasticsearch([{'host': '127.0.0.1', 'port': server.server_address[1]}], max_retries=0)
+        request.addfinalizer(es.close)
+
+    storage = ElasticBookStorage()
+    storage.es = es
+    # the update script is stored once per process, every test starts a new cluster
+    ElasticBookStorage.update_script_stored = False
+    storage.create_book_index()
+    assert storage.bulk_insert(DATA, refresh=True, first_id=0)['indexed'] == len(DATA)
+    return storage
+
+
+@pytest.fixture
+def builder(storage):
+    """QueryBuilder answering from the storage fixture"""
+    from query_builder import QueryBuilder
+
+    builder = QueryBuilder()
+    builder.client = storage
+    return builder
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+from elasticsearch import AsyncElasticsearch
+
+from async_storage_client import AsyncElasticBookStorage
+from es_standin import start_standin
+from initializer import DATA
+from settings import BOOK_MAPPING_VERSION
+
+
+@pytest.fixture
+def run(tmp_path):
+    """Runs a coroutine function with an AsyncElasticBookStorage over the HTTP stand-in"""
+    server = start_standin(data_dir=str(tmp_path))
+
+    def run(test):
+        async def main():
+            storage = AsyncElasticBookStorage()
+            storage.es = AsyncElasticsearch([{'host': '127.0.0.1', 'port': server.server_address[1]}],
+                                            max_retries=0)
+            try:
+                return await test(storage)
+            finally:
+                await storage.close()
+        return asyncio.run(main())
+
+    yield run
+    server.shutdown()
+    server.server_close()
+    server.es.close()
+
+
+def test_index_administration(run):
+    async def test(storage):
+        assert await storage.live_indices() == []
+        assert await storage.mapping_version() is None
+        assert (await storage.create_book_index())['acknowledged'] is True
+        assert await storage.create_book_index() is None
+        report = await storage.bulk_insert(DATA, refresh=True, first_id=0)
+        return await storage.live_indices(), await storage.mapping_version(), report, \
+            await storage.fetch_all_docs(page={'size': 100})
+
+    indices, version, report, hits = run(test)
+
+    assert len(indices) == 1 and indices[0].startswith('book_index_v')
+    assert version == BOOK_MAPPING_VERSION
+    assert report['indexed'] == len(DATA)
+    assert len(hits) == len(DATA)
+
+
+def test_sync_only_methods(run):
+    async def test(storage):
+        with pytest.raises(TypeError, match='reindex is not supported'):
+            storage.reindex()
+        with pytest.raises(TypeError, match='bulk_load_mode is not supported'):
+            storage.bulk_load_mode()
+        with pytest.raises(TypeError, match='bulk_load'):
+            await storage.bulk_insert(DATA, bulk_load=True)
+
+    run(test)
@@ -0,0 +1,129 @@
+import pytest
+
+import cache
+from cache import DocumentCache
+from conftest import stored
+from initializer import DATA
+from metrics import RecordedErrors
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    return now
+
+
+def test_serves_live_entries(clock):
+    documents = DocumentCache(max_bytes=1 << 20, ttl=5)
+    documents.put(1, {'title': 'Solr in Action'}, 1)
+
+    assert documents.get_many([1, 2]) == {'1': {'title': 'Solr in Action'}}
+    clock[0] += 6
+    assert documents.get_many([1]) == {}
+    assert documents.stats()['hits'] == 1 and documents.stats()['misses'] == 2
+
+
+def test_keeps_the_newest_version(clock):
+    documents = DocumentCache(max_bytes=1 << 20, ttl=5)
+    documents.put(1, {'title': 'second edition'}, 2)
+    documents.put(1, {'title': 'first edition'}, 1)
+
+    assert documents.get_many([1]) == {'1': {'title': 'second edition'}}
+
+
+def test_tombstone_blocks_older_reads(clock):
+    documents = DocumentCache(max_bytes=1 << 20, ttl=5)
+    documents.put(1, {'title': 'Solr in Action'}, 1)
+    documents.remove(1, 2)
+    # a read that started before the delete
+    documents.put_docs([{'_id': '1', '_version': 1, '_source': {'title': 'Solr in Action'}, 'found': True}])
+
+    assert documents.get_many([1]) == {}
+
+
+def test_evicts_least_recently_used(clock):
+    source = {'title': 'x' * 100}
+    documents = DocumentCache(max_bytes=3 * cache.approximate_size(source), ttl=5)
+    for book_id in range(3):
+        documents.put(book_id, source, 1)
+    documents.get_many([0])
+    documents.put(3, source, 1)
+
+    assert sorted(documents.get_many(range(4))) == ['0', '2', '3']
+    assert documents.stats()['bytes'] <= documents.max_bytes
+
+
+@pytest.fixture
+def documents(storage, monkeypatch):
+    """Document cache of the storage fixture, recording the ids of every _mget and get_source request"""
+    storage.documents = DocumentCache(max_bytes=1 << 20, ttl=60)
+    storage.requests = []
+    mget, get_source = storage.es.mget, storage.es.get_source
+
+    def record_mget(*args, **kwargs):
+        body = kwargs['body']
+        storage.requests.append([str(book_id) for book_id in body.get('ids', [])] or
+                                [doc['_id'] for doc in body['docs']])
+        return mget(*args, **kwargs)
+
+    def record_get_source(*args, **kwargs):
+        storage.requests.append([kwargs['id']])
+        return get_source(*args, **kwargs)
+
+    monkeypatch.setattr(storage.es, 'mget', record_mget)
+    monkeypatch.setattr(storage.es, 'get_source', record_get_source)
+    return storage.documents
+
+
+def test_multi_get_sends_only_missing_ids(storage, documents):
+    assert storage.multi_get_books(ids=[1, 2]) == {'docs': [stored(1), stored(2)]}
+    assert storage.multi_get_books(ids=[2, 3, 999]) == {'docs': [stored(2), stored(3), {'_id': '999'}]}
+    assert storage.multi_get_books(ids=[1, 2, 3]) == {'docs': [stored(1), stored(2), stored(3)]}
+
+    assert storage.requests == [['1', '2'], ['3', '999']]
+
+
+def test_retrieve_book_by_id(storage, documents):
+    assert storage.retrieve_book_by_id(4) == stored(4)
+    assert storage.retrieve_book_by_id(4) == stored(4)
+    with RecordedErrors() as errors:
+        assert storage.retrieve_book_by_id(999) is None
+
+    assert storage.requests == [['4'], ['999']]
+    assert [getattr(error, 'status_code', None) for error in errors] == [404]
+
+
+def test_search_hits_fill_the_cache(storage, documents):
+    solr = [hit['_id'] for hit in storage.search_book_by_param('title', 'solr')]
+    storage.search_book_by_param('title', 'action', projection={'_source': {'includes': ['title'], 'excludes': []}})
+
+    assert storage.retrieve_book_by_id(solr[0]) == stored(int(solr[0]))
+    assert storage.requests == []
+    # projected hits are never cached
+    assert documents.get_many(['2']) == {}
+
+
+def test_projected_reads_bypass_the_cache(storage, documents):
+    storage.multi_get_books(ids=[1])
+
+    title = {'_source': {'includes': ['title'], 'excludes': []}}
+
+    assert storage.retrieve_book_by_id(1, projection=title) == {'title': DATA[1]['title']}
+    assert storage.multi_get_books(ids=[1], projection=title) == {'docs': [{'title': DATA[1]['title']}]}
+    assert storage.requests == [['1'], ['1'], ['1']]
+
+
+def test_writes_update_the_cache(storage, documents):
+    storage.multi_get_books(ids=[5, 6])
+    created = storage.create_book_doc('Cached book', ['someone'], 'a summary', 'manning', 3, '2020-01-01')
+    storage.remove_book_doc(5)
+
+    assert storage.retrieve_book_by_id(created['_id'])['title'] == 'Cached book'
+    with RecordedErrors():
+        assert storage.retrieve_book_by_id(5) is None
+    assert storage.requests == [['5', '6'], ['5']]
+
+    storage.update_by_query(fields=['publisher'], query=DATA[6]['publisher'], refresh=True,
+                            updates=[{'op': 'set', 'field': 'num_reviews', 'value': 0}])
+    assert storage.retrieve_book_by_id(6)['num_reviews'] == 0
@@ -0,0 +1,414 @@
+import re
+import statistics
+from collections import Counter
+
+import pytest
+from elasticsearch import NotFoundError
+
+from conftest import recorded, assert_shape, stored
+from initializer import DATA
+from settings import BOOK_MAPPING_VERSION
+
+TITLE_QUERY = {"query": {"match": {"title": "elasticsearch"}}}
+
+
+def words(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def book_ids(hits):
+    return sorted(int(hit['_id']) for hit in hits)
+
+
+def only(response):
+    """This function is used to return the section of the single index of a response keyed by index name"""
+    assert len(response) == 1
+    return next(iter(response.values()))
+
+
+def test_create_index(storage):
+    response = storage.es.indices.create(index='book_index_v2_test', body=storage.book_index_body())
+
+    assert_shape(response, recorded('create_index'))
+    assert response['index'] == 'book_index_v2_test'
+
+
+def test_create_book(storage):
+    response = storage.create_book_doc(title="Using ElasticSearch", authors=["George kibana"],
+                                       summary="This is a guide how to use elasticsearch", publisher="wiley",
+                                       num_reviews=20, publish_date="2016-07-05", refresh=True)
+
+    assert_shape(response, recorded('index_document'))
+    assert response['result'] == 'created'
+    assert storage.retrieve_book_by_id(response['_id'])['title'] == "Using ElasticSearch"
+    assert storage.retrieve_book_by_id(response['_id'])['book_id'] == response['_id']
+
+
+def test_search(storage):
+    response = storage.es.search(index=storage.book_index, body=TITLE_QUERY)
+
+    assert_shape(response, recorded('search'))
+    expected = [i for i, book in enumerate(DATA) if 'elasticsearch' in words(book['title'])]
+    assert book_ids(response['hits']['hits']) == expected
+    assert response['hits']['total'] == len(expected)
+
+
+def test_search_pages(storage):
+    first = storage.es.search(index=storage.book_index, body=storage._page_body(TITLE_QUERY, {'size': 1}))
+    after = first['hits']['hits'][0]['sort']
+    second = storage.es.search(index=storage.book_index,
+                               body=storage._page_body(TITLE_QUERY, {'size': 1, 'search_after': after}))
+
+    assert_shape(first, recorded('search_page'))
+    assert_shape(second, recorded('search_page'))
+    hits = first['hits']['hits'] + second['hits']['hits']
+    assert hits[0]['_score'] >= hits[1]['_score']
+    assert book_ids(hits) == book_ids(storage.es.search(index=storage.book_index, body=TITLE_QUERY)['hits']['hits'])
+
+
+def test_search_pages_break_ties_on_book_id(storage):
+    body, hits, after = {"query": {"match_all": {}}}, [], None
+    while True:
+        page = storage.es.search(index=storage.book_index,
+                                 body=storage._page_body(body, {'size': 7, 'search_after': after}))['hits']['hits']
+        if not page:
+            break
+        hits.extend(page)
+        after = page[-1]['sort']
+
+    assert [hit['_id'] for hit in hits] == sorted(str(i) for i in range(len(DATA)))
+    assert all(hit['sort'][1] == hit['_id'] for hit in hits)
+
+
+def test_count(storage):
+    response = storage.es.count(index=storage.book_index)
+
+    assert_shape(response, recorded('count'))
+    assert response['count'] == len(DATA)
+
+
+def test_scroll(storage):
+    page = storage.es.search(index=storage.book_index, body={"query": {"match_all": {}}}, scroll='1m', size=5)
+    scroll_id = page['_scroll_id']
+    next_page = storage.es.scroll(body={'scroll_id': scroll_id, 'scroll': '1m'})
+    cleared = storage.es.clear_scroll(body={'scroll_id': [scroll_id]})
+
+    assert_shape(page, recorded('scroll'))
+    assert_shape(next_page, recorded('scroll'))
+    assert_shape(cleared, recorded('clear_scroll'))
+    assert len(page['hits']['hits']) == len(next_page['hits']['hits']) == 5
+    assert cleared['num_freed'] == 1
+
+
+def test_stream_every_book(storage):
+    hits = list(storage.fetch_all_docs(stream=True))
+
+    assert book_ids(hits) == list(range(len(DATA)))
+
+
+def test_msearch(storage):
+    response = storage.es.msearch(body=[{'index': storage.book_index}, TITLE_QUERY,
+                                        {'index': storage.book_index}, {"query": {"match_all": {}}, "size": 0}])
+
+    assert_shape(response, recorded('msearch'))
+    assert [item['hits']['total'] for item in response['responses']][1] == len(DATA)
+
+
+def test_mget(storage):
+    response = storage.es.mget(index=storage.book_index, doc_type=storage.book_doc, body={'ids': ['3', '99999']})
+    heads = storage.es.mget(index=storage.book_index, doc_type=storage.book_doc, body={'ids': ['3', '99999']},
+                            params={'_source': 'false'})
+
+    assert_shape(response, recorded('mget'))
+    assert_shape(heads, recorded('mget_heads'))
+    assert storage.multi_get_books(ids=[3, 99999]) == {'docs': [stored(3), {'_id': '99999'}]}
+
+
+def test_get_source(storage):
+    assert storage.retrieve_book_by_id(3) == stored(3)
+    assert storage.retrieve_book_by_id(3, projection={'_source': {'includes': ['title']}}) == {
+        'title': DATA[3]['title']}
+    assert storage.retrieve_book_by_id(99999) is None
+
+
+def test_bulk(storage):
+    response = storage.es.bulk(body=[
+        {'index': {'_index': storage.book_index, '_type': storage.book_doc, '_id': '100'}}, DATA[0],
+        {'delete': {'_index': storage.book_index, '_type': storage.book_doc, '_id': '1'}}
+    ])
+
+    assert_shape(response, recorded('bulk'))
+    assert [item[op]['status'] for item, op in zip(response['items'], ('index', 'delete'))] == [201, 200]
+
+
+def test_remove_book(storage):
+    response = storage.remove_book_doc(2)
+
+    assert_shape(response, recorded('delete_document'))
+    assert storage.retrieve_book_by_id(2) is None
+
+
+def test_remove_book_with_source(storage):
+    response = storage.remove_book_doc(3, with_source=True)
+
+    assert_shape(response, recorded('update_delete_script'))
+    assert response['get']['_source'] == stored(3)
+    assert storage.retrieve_book_by_id(3) is None
+
+
+def test_delete_by_query(storage):
+    query = {"query": {"multi_match": {"query": "springer", "fields": ["publisher"]}}}
+    response = storage.es.delete_by_query(index=storage.book_index, body=query, refresh=True)
+
+    assert_shape(response, recorded('delete_by_query'))
+    assert response['deleted'] == sum(book['publisher'] == 'Springer' for book in DATA)
+    assert storage.es.count(index=storage.book_index)['count'] == len(DATA) - response['deleted']
+
+
+def test_update_by_query(storage):
+    updates = [{'op': 'inc', 'field': 'num_reviews', 'value': 1}, {'op': 'append', 'field': 'authors',
+                                                                   'value': 'load tester'}]
+    body = {"query": {"multi_match": {"query": "manning", "fields": ["publisher"]}}}
+    body.update(script=storage._update_script(updates))
+    storage._put_update_script()
+    response = storage.es.update_by_query(index=storage.book_index, body=body, conflicts='proceed', refresh=True)
+
+    assert_shape(response, recorded('update_by_query'))
+    manning = [i for i, book in enumerate(DATA) if book['publisher'] == 'manning']
+    assert response['updated'] == len(manning)
+    book = storage.retrieve_book_by_id(manning[0])
+    assert book['num_reviews'] == DATA[manning[0]]['num_reviews'] + 1
+    assert book['authors'] == DATA[manning[0]]['authors'] + ['load tester']
+
+
+def test_by_query_task(storage):
+    submitted = storage.update_by_query(fields=['publisher'], query='manning', wait_for_completion=False,
+                                        updates=[{'op': 'set', 'field': 'publisher', 'value': 'manning publications'}])
+    task = storage.es.tasks.get(task_id=submitted['task_id'])
+
+    assert_shape({'task': submitted['task_id']}, recorded('task_submitted'))
+    assert_shape(task, recorded('task'))
+    progress = storage.get_task(submitted['task_id'])
+    assert progress['completed'] is True
+    assert progress['updated'] == sum(book['publisher'] == 'manning' for book in DATA)
+
+
+def test_reindex(storage):
+    response = storage.es.reindex(body={"source": {"index": storage.book_index}, "dest": {"index": "book_copy"}},
+                                  refresh=True)
+
+    assert_shape(response, recorded('reindex'))
+    assert response['created'] == len(DATA)
+    assert storage.es.count(index='book_copy')['count'] == len(DATA)
+
+
+def test_aggregations(storage):
+    body = {
+        "aggs": {
+            "publishers": {
+                "terms": {"field": "publisher.keyword", "size": 50},
+                "aggs": {"reviews": {"sum": {"field": "num_reviews"}}}
+            },
+            "years": {"date_histogram": {"field": "publish_date", "interval": "year", "min_doc_count": 1}},
+            "reviews": {"stats": {"field": "num_reviews"}},
+            "review_ranges": {"range": {"field": "num_reviews", "ranges": [{"to": 20}, {"from": 20, "to": 50},
+                                                                             {"from": 50}]}},
+            "manning": {
+                "filter": storage._exact_query("publisher", "manning"),
+                "aggs": {"avg_num_reviews": {"avg": {"field": "num_reviews"}}}
+            },
+            "authors": {"composite": {"sources": [{"authors": {"terms": {"field": "authors.keyword"}}}], "size": 1}}
+        }
+    }
+    response = storage.es.search(index=storage.book_index, body=body, size=0)
+    aggregations = response['aggregations']
+
+    assert_shape(response, recorded('aggregations'))
+    publishers = Counter(book['publisher'].lower() for book in DATA)
+    assert [(bucket['key'], bucket['doc_count']) for bucket in aggregations['publishers']['buckets']] == \
+        sorted(publishers.items(), key=lambda item: (-item[1], item[0]))
+    springer = next(bucket for bucket in aggregations['publishers']['buckets'] if bucket['key'] == 'springer')
+    assert springer['reviews']['value'] == sum(book['num_reviews'] for book in DATA if book['publisher'] == 'Springer')
+    assert {bucket['key_as_string'][:4]: bucket['doc_count'] for bucket in aggregations['years']['buckets']} == \
+        Counter(book['publish_date'][:4] for book in DATA)
+    reviews = [book['num_reviews'] for book in DATA]
+    assert aggregations['reviews'] == {'count': len(reviews), 'min': min(reviews), 'max': max(reviews),
+                                       'avg': statistics.mean(reviews), 'sum': sum(reviews)}
+    assert [bucket['doc_count'] for bucket in aggregations['review_ranges']['buckets']] == [
+        sum(r < 20 for r in reviews), sum(20 <= r < 50 for r in reviews), sum(r >= 50 for r in reviews)]
+    manning = [book['num_reviews'] for book in DATA if book['publisher'] == 'manning']
+    assert aggregations['manning']['doc_count'] == len(manning)
+    assert aggregations['manning']['avg_num_reviews']['value'] == pytest.approx(statistics.mean(manning))
+    first_author = min(author.lower() for book in DATA for author in book['authors'])
+    assert aggregations['authors']['after_key'] == {'authors': first_author}
+
+
+def ids_where(predicate):
+    return [i for i, book in enumerate(DATA) if predicate(book)]
+
+
+@pytest.mark.parametrize('method, kwargs, expected', [
+    ('search_book_by_param', {'args': ['title', 'solr']}, ids_where(lambda book: 'solr' in words(book['title']))),
+    # comprihensiv is two edits away from comprehensive
+    ('fuzzy_queries', {'query': 'comprihensiv', 'fields': ['summary']},
+     ids_where(lambda book: 'comprehensive' in words(book['summary']))),
+    ('wild_card_query', {'field': 'authors', 'query': 'tre*'},
+     ids_where(lambda book: any(w.startswith('tre') for author in book['authors'] for w in words(author)))),
+    ('regex_query', {'field': 'authors', 'query': 'gr[a-z]+er'},
+     ids_where(lambda book: any(re.fullmatch('gr[a-z]+er', w) for author in book['authors'] for w in words(author)))),
+    ('match_phrase_query', {'query': 'search applications', 'fields': ['summary'], 'slop': 0},
+     ids_where(lambda book: 'search applications' in ' '.join(words(book['summary'])))),
+    ('term_query', {'field': 'publisher', 'term': 'oreilly'}, ids_where(lambda book: book['publisher'] == 'oreilly')),
+    ('range_query', {'field': 'num_reviews', 'range': {'gte': 60, 'lte': 80}},
+     ids_where(lambda book: 60 <= book['num_reviews'] <= 80)),
+])
+def test_queries(storage, method, kwargs, expected):
+    kwargs = dict(kwargs)
+    hits = getattr(storage, method)(*kwargs.pop('args', []), **kwargs)
+
+    assert book_ids(hits) == expected
+
+
+def phrase_at(text, first, second, gap=1):
+    found = words(text)
+    return any(first(word) and any(second(other) for other in found[i + 1:i + 1 + gap])
+               for i, word in enumerate(found))
+
+
+@pytest.mark.parametrize('query, expected', [
+    ({"match_none": {}}, []),
+    ({"ids": {"values": ["1", "3", "999"]}}, [1, 3]),
+    ({"exists": {"field": "summary"}}, ids_where(lambda book: book['summary'])),
+    ({"prefix": {"authors": "tre"}},
+     ids_where(lambda book: any(w.startswith('tre') for author in book['authors'] for w in words(author)))),
+    ({"fuzzy": {"summary": {"value": "comprihensive"}}},
+     ids_where(lambda book: 'comprehensive' in words(book['summary']))),
+    ({"match_phrase": {"summary": "search applications"}},
+     ids_where(lambda book: phrase_at(book['summary'], 'search'.__eq__, 'applications'.__eq__))),
+    ({"match_phrase": {"summary": {"query": "build applications", "slop": 1}}},
+     ids_where(lambda book: phrase_at(book['summary'], 'build'.__eq__, 'applications'.__eq__, gap=2))),
+    ({"match_phrase_prefix": {"summary": "search appl"}},
+     ids_where(lambda book: phrase_at(book['summary'], 'search'.__eq__, lambda w: w.startswith('appl')))),
+    ({"simple_query_string": {"query": "solr", "fields": ["title"]}},
+     ids_where(lambda book: 'solr' in words(book['title']))),
+    ({"constant_score": {"filter": {"term": {"publisher.keyword": "wiley"}}}},
+     ids_where(lambda book: book['publisher'] == 'wiley')),
+])
+def test_query_types(storage, query, expected):
+    response = storage.es.search(index=storage.book_index, body={"query": query}, size=len(DATA))
+
+    assert book_ids(response['hits']['hits']) == expected
+
+
+def test_query_scores(storage):
+    def scores(query):
+        response = storage.es.search(index=storage.book_index, body={"query": query}, size=len(DATA))
+        return {hit['_id']: hit['_score'] for hit in response['hits']['hits']}
+
+    constant = scores({"constant_score": {"filter": {"term": {"publisher.keyword": "wiley"}}, "boost": 2.5}})
+    title, summary = scores({"match": {"title": "data"}}), scores({"match": {"summary": "data"}})
+    most_fields = scores({"multi_match": {"query": "data", "fields": ["title", "summary"], "type": "most_fields"}})
+
+    assert set(constant.values()) == {2.5}
+    assert most_fields == pytest.approx({doc_id: title.get(doc_id, 0) + summary.get(doc_id, 0)
+                                         for doc_id in set(title) | set(summary)})
+
+
+def test_query_aggregations(storage):
+    body = {
+        "aggs": {
+            "publishers": {"filters": {"filters": {"manning": {"term": {"publisher.keyword": "manning"}},
+                                                   "wiley": {"term": {"publisher.keyword": "wiley"}}}}},
+            "published": {"date_range": {"field": "publish_date", "ranges": [{"to": "2015-01-01"},
+                                                                             {"from": "2015-01-01"}]}},
+            "no_summary": {"missing": {"field": "summary"}},
+            "review_ranges": {"range": {"field": "num_reviews", "keyed": True, "ranges": [{"to": 20}, {"from": 20}]}},
+            "publisher_names": {"terms": {"field": "publisher.keyword", "order": {"_key": "asc"}, "min_doc_count": 2,
+                                          "size": 2}},
+            "reviews": {"histogram": {"field": "num_reviews", "interval": 100, "offset": 10, "min_doc_count": 1}}
+        }
+    }
+    response = storage.es.search(index=storage.book_index, body=body, size=0)
+    aggregations = response['aggregations']
+
+    assert_shape(response, recorded('query_aggregations'))
+    publishers = Counter(book['publisher'].lower() for book in DATA)
+    assert {key: bucket['doc_count'] for key, bucket in aggregations['publishers']['buckets'].items()} == \
+        {'manning': publishers['manning'], 'wiley': publishers['wiley']}
+    assert [bucket['doc_count'] for bucket in aggregations['published']['buckets']] == [
+        sum(book['publish_date'] < '2015-01-01' for book in DATA),
+        sum(book['publish_date'] >= '2015-01-01' for book in DATA)]
+    assert aggregations['published']['buckets'][0]['key'] == '*-2015-01-01T00:00:00.000Z'
+    assert aggregations['no_summary']['doc_count'] == 0
+    reviews = [book['num_reviews'] for book in DATA]
+    assert {key: bucket['doc_count'] for key, bucket in aggregations['review_ranges']['buckets'].items()} == \
+        {'*-20.0': sum(r < 20 for r in reviews), '20.0-*': sum(r >= 20 for r in reviews)}
+    assert [bucket['key'] for bucket in aggregations['publisher_names']['buckets']] == \
+        sorted(key for key, count in publishers.items() if count >= 2)[:2]
+    histogram = Counter((r - 10) // 100 * 100 + 10 for r in reviews)
+    assert [(bucket['key'], bucket['doc_count']) for bucket in aggregations['reviews']['buckets']] == \
+        sorted(histogram.items())
+
+
+def test_mapping(storage):
+    response = storage.es.indices.get_mapping(index=storage.book_index)
+
+    assert sorted(response) == storage.live_indices()
+    assert_shape(only(response), only(recorded('get_mapping')))
+    assert storage.mapping_version() == BOOK_MAPPING_VERSION
+
+
+def test_aliases(storage):
+    response = storage.es.indices.get_alias(name=storage.book_index)
+
+    assert_shape(only(response), only(recorded('get_alias')))
+    assert storage.es.indices.exists_alias(name=storage.book_index)
+    assert storage.live_indices() == sorted(response)
+
+
+def test_storage_reindex(storage, monkeypatch):
+    before = storage.live_indices()
+    # index names have a one second resolution, the fixture index was created in the same second
+    monkeypatch.setattr(storage, 'new_index_name', lambda: storage.book_index + '_reindexed')
+    # a book written before book_id was mapped
+    storage.es.index(index=storage.book_index, doc_type=storage.book_doc, id='legacy', body={'title': 'Lucene'},
+                     params={'refresh': 'true'})
+    assert storage.reindex(delete_source=True)['copied'] == len(DATA) + 1
+
+    assert storage.live_indices() != before
+    assert not storage.es.indices.exists(index=before[0])
+    assert storage.es.count(index=storage.book_index)['count'] == len(DATA) + 1
+    assert storage.retrieve_book_by_id('legacy') == {'title': 'Lucene', 'book_id': 'legacy'}
+
+
+def test_settings(storage):
+    response = storage.es.indices.get_settings(index=storage.book_index)
+    with storage.bulk_load_mode():
+        bulk_load = storage.es.indices.get_settings(index=storage.book_index)
+    restored = storage.es.indices.get_settings(index=storage.book_index)
+
+    assert_shape(only(response), only(recorded('get_settings')))
+    assert only(response)['settings']['index']['provided_name'] == storage.live_indices()[0]
+    assert only(bulk_load)['settings']['index']['refresh_interval'] == '-1'
+    assert 'refresh_interval' not in only(restored)['settings']['index']
+    assert_shape(storage.es.indices.put_settings(index=storage.book_index, body={'index': {'refresh_interval': '1s'}}),
+                 recorded('acknowledged'))
+
+
+def test_refresh_and_forcemerge(storage):
+    assert_shape(storage.es.indices.refresh(index=storage.book_index), recorded('refresh'))
+    assert_shape(storage.es.indices.forcemerge(index=storage.book_index, max_num_segments=1), recorded('refresh'))
+
+
+def test_cluster(storage):
+    assert_shape(storage.get_cluster_health(), recorded('cluster_health'))
+    stats = storage.get_cluster_stats()
+    assert_shape(stats, recorded('cluster_stats'), subset=True)
+    assert stats['indices']['docs']['count'] == len(DATA)
+
+
+def test_index_not_found(storage):
+    with pytest.raises(NotFoundError) as error:
+        storage.es.search(index='missing_index', body=TITLE_QUERY)
+
+    assert_shape(error.value.info, recorded('index_not_found'))
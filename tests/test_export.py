@@ -0,0 +1,88 @@
+import csv
+import gzip
+import json
+import os
+
+import pytest
+
+import export
+from export import ExportManager
+from initializer import DATA
+
+
+@pytest.fixture
+def exports(builder, tmp_path, request):
+    exports = ExportManager(builder, export_dir=str(tmp_path / 'exports'), workers=1, retention=60)
+    request.addfinalizer(exports.executor.shutdown)
+    return exports
+
+
+def finished(exports, job):
+    """This function is used to wait for the jobs submitted so far and return the status of job"""
+    exports.executor.submit(lambda: None).result(timeout=30)
+    return exports.status(job['job_id'])
+
+
+def test_ndjson_export(exports):
+    job = exports.submit('fetch_all', {})
+    assert job['state'] == 'pending' and job['finished'] is None
+
+    status = finished(exports, job)
+    assert status['state'] == 'done' and status['error'] is None
+    assert status['rows'] == len(DATA)
+    assert status['finished'] >= status['submitted']
+    with open(exports.file_path(job['job_id'])) as f:
+        titles = sorted(json.loads(line)['title'] for line in f)
+    assert titles == sorted(book['title'] for book in DATA)
+    assert not os.path.exists(exports.file_path(job['job_id']) + '.part')
+
+
+def test_compressed_csv_export(exports):
+    job = exports.submit('search_book_by_parameter', {'field': 'title', 'query': 'solr'}, file_type='csv',
+                         compression='gzip')
+
+    status = finished(exports, job)
+    assert status['file_name'].endswith('.csv.gz')
+    with gzip.open(exports.file_path(job['job_id']), 'rt', newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == status['rows'] > 0
+    assert all('solr' in row['title'].lower() for row in rows)
+
+
+def test_failed_export(exports):
+    job = exports.submit('not_an_action', {})
+
+    status = finished(exports, job)
+    assert status['state'] == 'failed'
+    assert status['error'].startswith('ValueError')
+    assert exports.file_path(job['job_id']) is None
+
+
+def test_unknown_jobs(exports):
+    assert exports.status('0' * 32) is None
+    assert exports.status('../settings') is None
+    assert exports.file_path('0' * 32) is None
+
+
+def test_rejects_unsupported_formats(exports):
+    with pytest.raises(ValueError):
+        exports.submit('fetch_all', {}, file_type='xlsx')
+    with pytest.raises(ValueError):
+        exports.submit('fetch_all', {}, compression='bzip2')
+
+
+def test_finished_jobs_expire(exports, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(export.time, 'time', lambda: now[0])
+    old = exports.submit('fetch_all', {})
+    path = exports.file_path(finished(exports, old)['job_id'])
+
+    now[0] += exports.retention - 1
+    kept = exports.submit('fetch_all', {})
+    assert exports.status(old['job_id']) is not None
+
+    now[0] += 2
+    assert exports.cleanup() == 1
+    assert exports.status(old['job_id']) is None
+    assert not os.path.exists(path)
+    assert finished(exports, kept)['state'] == 'done'
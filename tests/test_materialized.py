@@ -0,0 +1,115 @@
+import pytest
+
+import materialized as materialized_module
+from initializer import DATA
+from materialized import MaterializedAggregates
+
+BOOK = {'title': 'Kibana Dashboards', 'authors': ['load tester'], 'summary': 'visualize logs', 'publisher': 'Manning',
+        'num_reviews': 7, 'publish_date': '2019-04-01'}
+
+
+@pytest.fixture
+def aggregates(builder, monkeypatch):
+    """Materialized aggregates of the builder fixture, recording every aggregation request"""
+    builder.materialized = MaterializedAggregates(builder.client)
+    requests, aggregate = [], builder.client._aggregate
+    monkeypatch.setattr(builder.client, '_aggregate', lambda body: requests.append(body) or aggregate(body))
+    builder.materialized.requests = requests
+    return builder.materialized
+
+
+def rebuilt(storage):
+    """This function is used to compute the aggregates from scratch"""
+    return MaterializedAggregates(storage).get()
+
+
+def middle_book():
+    """This function is used to pick a book whose num_reviews is neither the min nor the max"""
+    reviews = [book['num_reviews'] for book in DATA]
+    return next(i for i, book in enumerate(DATA) if min(reviews) < book['num_reviews'] < max(reviews))
+
+
+def test_rebuild_counts_the_index(aggregates):
+    view = aggregates.get()
+
+    assert view['books'] == len(DATA)
+    assert sum(counts['books'] for counts in view['reviews_per_publisher'].values()) == \
+        sum(1 for book in DATA if book.get('publisher'))
+    assert view['num_reviews']['sum'] == sum(book['num_reviews'] for book in DATA)
+    assert aggregates.get() is view
+    assert len(aggregates.requests) == 1
+
+
+def test_writes_are_applied_incrementally(builder, aggregates):
+    aggregates.get()
+    builder.command('append_book', dict(BOOK))
+    builder.command('remove_book_by_id', {'book_id': middle_book()})
+    builder.bulk_insert([dict(BOOK, publisher='wiley', publish_date='2020-01-01')])
+
+    assert len(aggregates.requests) == 1
+    assert aggregates.get() == rebuilt(builder.client)
+
+
+def test_removing_an_extreme_rebuilds(builder, aggregates):
+    aggregates.get()
+    most_reviewed = max(range(len(DATA)), key=lambda i: DATA[i]['num_reviews'])
+    builder.command('remove_book_by_id', {'book_id': most_reviewed})
+    view = aggregates.get()
+
+    assert len(aggregates.requests) == 2
+    assert view == rebuilt(builder.client)
+
+
+def test_query_writes_rebuild(builder, aggregates):
+    aggregates.get()
+    builder.command('delete_by_query', {'fields': ['publisher'], 'query': 'manning', 'refresh': True})
+    view = aggregates.get()
+
+    assert len(aggregates.requests) == 2
+    assert 'manning' not in view['reviews_per_publisher']
+    assert view == rebuilt(builder.client)
+
+
+def test_bulk_insert_with_ids_rebuilds(builder, aggregates):
+    aggregates.get()
+    # the first book is replaced, it cannot be counted twice
+    builder.bulk_insert([dict(DATA[0], num_reviews=DATA[0]['num_reviews'] + 1)], first_id=0)
+    view = aggregates.get()
+
+    assert len(aggregates.requests) == 2
+    assert view['books'] == len(DATA)
+    assert view == rebuilt(builder.client)
+
+
+def test_failed_batch_rebuilds(aggregates):
+    aggregates.get()
+    aggregates.ingested([BOOK], failed=1)
+
+    assert aggregates.get()['books'] == len(DATA)
+    assert len(aggregates.requests) == 2
+
+
+def test_expires_after_ttl(aggregates, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(materialized_module.time, 'time', lambda: now[0])
+    aggregates.get()
+    now[0] += aggregates.ttl - 1
+    aggregates.get()
+    now[0] += 2
+    aggregates.get()
+
+    assert len(aggregates.requests) == 2
+
+
+def test_writes_during_a_rebuild_expire_it(builder, aggregates, monkeypatch):
+    aggregate = builder.client._aggregate
+
+    def racing(body):
+        # a book created after the refresh, it may or may not be in the snapshot
+        aggregates.add([BOOK])
+        return aggregate(body)
+    monkeypatch.setattr(builder.client, '_aggregate', racing)
+    aggregates.get()
+
+    assert aggregates.expires == 0
+    assert aggregates.get()['books'] == len(DATA)
@@ -0,0 +1,21 @@
+import logging
+
+from initializer import DATA
+from metrics import RecordedErrors, record_error
+
+
+def test_record_error_logs_and_records(caplog):
+    with caplog.at_level(logging.ERROR, logger='book_storage.errors'):
+        with RecordedErrors() as errors:
+            record_error(ValueError('bad payload'))
+
+    assert [type(ex) for ex in errors] == [ValueError]
+    assert [record.getMessage() for record in caplog.records] == ['ValueError in none: bad payload']
+
+
+def test_ingest_report_is_logged(storage, caplog, capsys):
+    with caplog.at_level(logging.INFO, logger='book_storage.bulk_ingest'):
+        storage.bulk_insert(DATA[:3])
+
+    assert [record.getMessage().split(' in ')[0] for record in caplog.records] == ['indexed 3 docs (0 failed)']
+    assert capsys.readouterr().out == ''
@@ -0,0 +1,35 @@
+import pytest
+
+from conftest import stored
+from initializer import DATA
+
+
+def test_batch_projected_ids(builder, monkeypatch):
+    requests, mget = [], builder.client.es.mget
+    monkeypatch.setattr(builder.client.es, 'mget',
+                        lambda *args, **kwargs: requests.append(kwargs) or mget(*args, **kwargs))
+    items = builder.batch([
+        {'action': 'multi_get', 'ids': [1, 2, 999], 'projection': {'includes': ['title']}},
+        {'action': 'retrieve_book_by_id', 'book_id': 3, 'projection': {'excludes': ['summary']}},
+        {'action': 'retrieve_book_by_id', 'book_id': 4, 'projection': {'ids_only': True}},
+        {'action': 'multi_get', 'ids': [5]},
+    ])
+
+    assert len(requests) == 1
+    assert items[0] == {'action': 'multi_get', 'results': {'docs': [
+        {'title': DATA[1]['title']}, {'title': DATA[2]['title']}, {'_id': '999'}]}}
+    assert items[1] == {'action': 'retrieve_book_by_id',
+                        'results': {key: value for key, value in stored(3).items() if key != 'summary'}}
+    assert items[2] == {'action': 'retrieve_book_by_id', 'results': {'_id': '4'}}
+    assert items[3] == {'action': 'multi_get', 'results': {'docs': [stored(5)]}}
+
+
+@pytest.mark.parametrize('projection', [{'includes': ['title']}, {'ids_only': True}])
+def test_batch_matches_command(builder, projection):
+    payloads = [{'action': 'multi_get', 'ids': [1, 2], 'projection': projection},
+                {'action': 'search_book_by_parameter', 'field': 'title', 'query': 'solr', 'projection': projection}]
+
+    items = builder.batch(payloads)
+
+    assert [item['results'] for item in items] == [builder.command(payload['action'], payload)
+                                                   for payload in payloads]
@@ -0,0 +1,112 @@
+import pytest
+
+import cache
+from cache import QueryCache, cache_key
+
+SEARCH = {'field': 'title', 'query': 'solr'}
+
+BOOK = {'title': 'Solr Dashboards', 'authors': ['load tester'], 'summary': 'visualize logs', 'publisher': 'wiley',
+        'num_reviews': 3, 'publish_date': '2019-04-01'}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    return now
+
+
+def test_serves_live_entries(clock):
+    queries = QueryCache(max_entries=8, ttl=60)
+    queries.set('a', [1], queries.generation())
+
+    assert queries.get('a') == [1]
+    clock[0] += 61
+    assert queries.get('a') is None
+    assert queries.stats()['hits'] == 1 and queries.stats()['misses'] == 1
+
+
+def test_evicts_least_recently_used(clock):
+    queries = QueryCache(max_entries=2, ttl=60)
+    queries.set('a', 1, queries.generation())
+    queries.set('b', 2, queries.generation())
+    queries.get('a')
+    queries.set('c', 3, queries.generation())
+
+    assert [queries.get(key) for key in ('a', 'b', 'c')] == [1, None, 3]
+
+
+def test_results_computed_before_a_clear_are_not_stored(clock):
+    queries = QueryCache(max_entries=8, ttl=60)
+    generation = queries.generation()
+    queries.clear()
+    queries.set('a', 1, generation)
+
+    assert queries.get('a') is None
+
+
+def test_cache_key_ignores_payload_key_order():
+    assert cache_key('search', {'field': 'title', 'query': 'solr'}) == \
+        cache_key('search', {'query': 'solr', 'field': 'title'})
+
+
+@pytest.fixture
+def searches(builder, monkeypatch):
+    """Query cache of the builder fixture, recording the body of every search sent to the storage"""
+    builder.cache = QueryCache(max_entries=8, ttl=60)
+    bodies, search = [], builder.client.es.search
+    monkeypatch.setattr(builder.client.es, 'search',
+                        lambda *args, **kwargs: bodies.append(kwargs.get('body')) or search(*args, **kwargs))
+    return bodies
+
+
+def titles(results):
+    return sorted(hit['_source']['title'] for hit in results)
+
+
+def test_serves_repeated_searches(builder, searches):
+    first = builder.command('search_book_by_parameter', dict(SEARCH))
+
+    assert builder.command('search_book_by_parameter', dict(SEARCH)) == first
+    assert len(searches) == 1
+    assert builder.cache.stats()['hits'] == 1
+
+
+def test_append_book_invalidates(builder, searches, monkeypatch):
+    refreshes, create = [], builder.client.create_book_doc
+    monkeypatch.setattr(builder.client, 'create_book_doc',
+                        lambda **kwargs: refreshes.append(kwargs['refresh']) or create(**kwargs))
+    before = builder.command('search_book_by_parameter', dict(SEARCH))
+    builder.command('append_book', dict(BOOK))
+    after = builder.command('search_book_by_parameter', dict(SEARCH))
+
+    # the write waits until it is searchable, so the next search cannot cache the results from before it
+    assert refreshes == ['wait_for']
+    assert len(searches) == 2
+    assert titles(after) == sorted(titles(before) + [BOOK['title']])
+
+
+def test_remove_book_invalidates(builder, searches):
+    before = builder.command('search_book_by_parameter', dict(SEARCH))
+    builder.command('remove_book_by_id', {'book_id': before[0]['_id']})
+    after = builder.command('search_book_by_parameter', dict(SEARCH))
+
+    assert len(searches) == 2
+    assert len(after) == len(before) - 1
+
+
+def test_bulk_insert_invalidates(builder, searches):
+    before = builder.command('search_book_by_parameter', dict(SEARCH))
+    builder.bulk_insert([BOOK])
+    after = builder.command('search_book_by_parameter', dict(SEARCH))
+
+    assert len(searches) == 2
+    assert titles(after) == sorted(titles(before) + [BOOK['title']])
+
+
+def test_profiled_searches_bypass_the_cache(builder, searches):
+    builder.command('search_book_by_parameter', dict(SEARCH))
+    builder.command('search_book_by_parameter', dict(SEARCH, profile=True))
+
+    assert len(searches) == 2
+    assert builder.cache.stats()['entries'] == 1
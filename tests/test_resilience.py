@@ -0,0 +1,161 @@
+import pytest
+from elasticsearch import ConnectionError, ConnectionTimeout, NotFoundError, TransportError
+from urllib3.exceptions import ConnectTimeoutError, ReadTimeoutError
+
+import bulk_ingest
+import resilience
+from resilience import CallerRetries, CircuitBreaker, CircuitOpenError, error_status, retry_reason
+
+SEARCH = ('POST', '/book_index/_search', {})
+GET = ('GET', '/book_index/_doc/1', {})
+SCROLL = ('POST', '/_search/scroll', {})
+INDEX = ('POST', '/book_index/_doc', {})
+BULK = ('POST', '/_bulk', {})
+
+
+def unsent():
+    return ConnectionError('N/A', 'connection refused', ConnectTimeoutError())
+
+
+def lost():
+    return ConnectionError('N/A', 'connection reset', ReadTimeoutError(None, '/', 'reset'))
+
+
+@pytest.mark.parametrize('error, request_, reason', [
+    (ConnectionTimeout('TIMEOUT', 'read timed out', None), SEARCH, 'timeout'),
+    (ConnectionTimeout('TIMEOUT', 'read timed out', None), INDEX, None),
+    (ConnectionTimeout('TIMEOUT', 'read timed out', None), SCROLL, None),
+    (lost(), GET, 'connection'),
+    (lost(), INDEX, None),
+    (unsent(), INDEX, 'connection'),
+    (TransportError(429, 'es_rejected_execution_exception', {}), INDEX, '429'),
+    (TransportError(429, 'es_rejected_execution_exception', {}), BULK, '429'),
+    (TransportError(503, 'unavailable', {}), SEARCH, '503'),
+    (TransportError(502, 'bad gateway', {}), GET, '502'),
+    # a proxy may answer 502/503 after the write was applied, sending it again could duplicate an auto-id book
+    (TransportError(503, 'unavailable', {}), INDEX, None),
+    (TransportError(502, 'bad gateway', {}), BULK, None),
+    (TransportError(500, 'internal', {}), SEARCH, None),
+    (NotFoundError(404, 'index_not_found_exception', {}), GET, None),
+    (CircuitOpenError('N/A', 'circuit breaker open', {'retry_after': 1.0}), SEARCH, None),
+])
+def test_retry_reason(error, request_, reason):
+    assert retry_reason(error, *request_) == reason
+
+
+def test_caller_retries():
+    rejected = TransportError(429, 'es_rejected_execution_exception', {})
+
+    with CallerRetries():
+        assert retry_reason(rejected, *BULK) is None
+        # the transport still retries what the caller does not
+        assert retry_reason(unsent(), *BULK) == 'connection'
+    with CallerRetries(enabled=False):
+        assert retry_reason(rejected, *BULK) == '429'
+    assert retry_reason(rejected, *BULK) == '429'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(max_failures=3, reset_timeout=30)
+    failure = TransportError(503, 'unavailable', {})
+
+    for _ in range(2):
+        breaker.allow()
+        breaker.record(failure)
+    breaker.allow()
+    breaker.record()
+    for _ in range(3):
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.allow()
+        breaker.record(failure)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    assert breaker.stats() == {'state': 'open', 'failures': 3, 'retry_after': 30.0, 'rejected': 1}
+
+
+def test_breaker_ignores_client_errors(clock):
+    breaker = CircuitBreaker(max_failures=1, reset_timeout=30)
+
+    breaker.allow()
+    breaker.record(NotFoundError(404, 'not_found', {}))
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_probes_after_reset_timeout(clock):
+    breaker = CircuitBreaker(max_failures=1, reset_timeout=30)
+    breaker.allow()
+    breaker.record(unsent())
+
+    clock[0] += 30
+    breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # a single probe at a time
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record(unsent())
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock[0] += 30
+    breaker.allow()
+    breaker.record()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.allow()
+
+
+def test_breaker_release_gives_back_the_probe(clock):
+    breaker = CircuitBreaker(max_failures=1, reset_timeout=30)
+    breaker.allow()
+    breaker.record(unsent())
+    clock[0] += 30
+
+    breaker.allow()
+    breaker.release()
+    breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+@pytest.mark.parametrize('error, status', [
+    (NotFoundError(404, 'not_found', {}), 404),
+    (TransportError(409, 'version_conflict_engine_exception', {}), 409),
+    (TransportError(503, 'unavailable', {}), 502),
+    (unsent(), 502),
+    (ValueError('invalid payload'), 500),
+])
+def test_error_status(error, status):
+    assert error_status(error) == (status, {})
+
+
+def test_error_status_of_open_circuit(clock, monkeypatch):
+    breaker = CircuitBreaker(max_failures=1, reset_timeout=30)
+    breaker.allow()
+    breaker.record(unsent())
+    monkeypatch.setattr(resilience, 'breaker', breaker)
+
+    assert error_status(CircuitOpenError('N/A', 'circuit breaker open', {'retry_after': 30.0})) == \
+        (503, {'Retry-After': '31'})
+
+
+@pytest.mark.parametrize('max_retries, caller_retries', [(5, True), (0, False)])
+def test_bulk_ingest_retries_rejected_chunks_once(monkeypatch, max_retries, caller_retries):
+    seen = []
+
+    def streaming_bulk(client, actions, **options):
+        seen.append(resilience.caller_retries.get())
+        return iter([(True, {})])
+
+    monkeypatch.setattr(bulk_ingest.helpers, 'streaming_bulk', streaming_bulk)
+    engine = bulk_ingest.BulkIngestEngine(None, 'book_index', '_doc', max_retries=max_retries)
+
+    assert engine._send([{'_source': {}}]) == (1, [])
+    assert seen == [caller_retries]
+    assert resilience.caller_retries.get() is False
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+
+from metrics import RecordedErrors, record_error
+from single_flight import AsyncSingleFlight, SingleFlight
+
+
+def run_together(flight, count, func):
+    """This function is used to call flight.do from count threads while the first call is still running"""
+    started, release = threading.Event(), threading.Event()
+    outcomes = [None] * count
+
+    def leader():
+        started.set()
+        release.wait(5)
+        return func()
+
+    def call(i):
+        with RecordedErrors() as errors:
+            try:
+                outcomes[i] = ('result', flight.do('key', leader if i == 0 else func), errors)
+            except Exception as ex:
+                outcomes[i] = ('raised', ex, errors)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while flight.stats()['coalesced'] < count - 1:
+        threading.Event().wait(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return outcomes
+
+
+def test_coalesces_concurrent_calls():
+    flight, calls = SingleFlight(), []
+
+    outcomes = run_together(flight, 4, lambda: calls.append(1) or {'hits': 1})
+
+    assert len(calls) == 1
+    assert [outcome[:2] for outcome in outcomes] == [('result', {'hits': 1})] * 4
+    assert flight.stats() == {'in_flight': 0, 'executed': 1, 'coalesced': 3}
+
+
+def test_shares_raised_errors():
+    flight = SingleFlight()
+
+    def fail():
+        raise ConnectionError('cluster down')
+
+    outcomes = run_together(flight, 3, fail)
+
+    assert [(kind, type(ex)) for kind, ex, _ in outcomes] == [('raised', ConnectionError)] * 3
+
+
+def test_shares_swallowed_errors():
+    flight, error = SingleFlight(), ConnectionError('cluster down')
+
+    outcomes = run_together(flight, 3, lambda: record_error(error))
+
+    # the storage swallows the error and returns None, every caller must see it to answer with an error status
+    assert outcomes == [('result', None, [error])] * 3
+
+
+def test_forgets_finished_calls():
+    flight = SingleFlight()
+
+    assert flight.do('key', lambda: 1) == 1
+    assert flight.do('key', lambda: 2) == 2
+    assert flight.stats() == {'in_flight': 0, 'executed': 2, 'coalesced': 0}
+
+
+def test_async_shares_results_and_swallowed_errors():
+    flight, error, calls = AsyncSingleFlight(), ConnectionError('cluster down'), []
+
+    async def search():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        record_error(error)
+
+    async def call():
+        with RecordedErrors() as errors:
+            return await flight.do('key', search), errors
+
+    async def main():
+        return await asyncio.gather(*[call() for _ in range(3)])
+
+    assert asyncio.run(main()) == [(None, [error])] * 3
+    assert len(calls) == 1
+
+
+def test_async_shares_raised_errors():
+    flight = AsyncSingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ConnectionError('cluster down')
+
+    async def main():
+        return await asyncio.gather(*[flight.do('key', fail) for _ in range(3)], return_exceptions=True)
+
+    assert [type(ex) for ex in asyncio.run(main())] == [ConnectionError] * 3
+    assert flight.stats() == {'in_flight': 0, 'executed': 1, 'coalesced': 2}
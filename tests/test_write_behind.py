@@ -0,0 +1,94 @@
+import time
+
+import pytest
+
+from bulk_ingest import WriteBehindBuffer
+
+
+def book(title):
+    return {'title': title, 'authors': ['load tester'], 'num_reviews': 1}
+
+
+@pytest.fixture
+def bulks(storage, monkeypatch):
+    """Bodies of the _bulk requests the storage fixture client receives"""
+    bodies, bulk = [], storage.es.bulk
+    monkeypatch.setattr(storage.es, 'bulk', lambda body, **kwargs: bodies.append(body) or bulk(body, **kwargs))
+    return bodies
+
+
+@pytest.fixture
+def make_buffer(storage, request):
+    def make(**kwargs):
+        buffer = WriteBehindBuffer(storage.es, storage.book_index, storage.book_doc, **kwargs)
+        request.addfinalizer(buffer.close)
+        return buffer
+    return make
+
+
+def test_flushes_once_max_docs_are_queued(make_buffer, bulks):
+    buffer = make_buffer(max_docs=3, max_delay=60)
+    futures = [buffer.submit(book(str(i))) for i in range(3)]
+
+    assert [future.result(timeout=5)['result'] for future in futures] == ['created'] * 3
+    assert len(bulks) == 1 and len(bulks[0]) == 6
+    assert buffer.stats() == {'pending': 0, 'batches': 1, 'documents': 3}
+
+
+def test_flushes_after_max_delay(make_buffer, bulks):
+    buffer = make_buffer(max_docs=100, max_delay=0.2)
+    start = time.monotonic()
+    future = buffer.submit(book('late'))
+
+    assert not future.done()
+    assert future.result(timeout=5)['result'] == 'created'
+    assert time.monotonic() - start >= 0.2
+    assert len(bulks) == 1
+
+
+def test_refresh_sends_right_away(make_buffer, storage, bulks):
+    buffer = make_buffer(max_docs=100, max_delay=60)
+    queued = buffer.submit(book('queued'))
+    searchable = buffer.submit(book('searchable'), refresh='wait_for')
+
+    searchable.result(timeout=5)
+    assert queued.done()
+    assert storage.es.count(index=storage.book_index, body={'query': {'match': {'title': 'searchable'}}})['count'] == 1
+
+
+def test_flush_and_close_send_the_queue(make_buffer, bulks):
+    buffer = make_buffer(max_docs=100, max_delay=60)
+    flushed = buffer.submit(book('flushed'))
+    buffer.flush()
+    assert flushed.done()
+
+    closed = [buffer.submit(book('closed')), buffer.submit(book('closed too'))]
+    buffer.close()
+
+    assert all(future.done() and future.exception() is None for future in closed)
+    assert [len(body) for body in bulks] == [2, 4]
+    with pytest.raises(RuntimeError):
+        buffer.submit(book('after close'))
+
+
+def test_ids_are_read_from_id_field(make_buffer, storage, bulks):
+    buffer = make_buffer(max_docs=1, max_delay=60, id_field='book_id')
+    response = buffer.submit(dict(book('with id'), book_id='wb-1')).result(timeout=5)
+
+    assert response['_id'] == 'wb-1'
+    assert bulks[0][0]['index']['_id'] == 'wb-1'
+
+
+def test_failed_bulk_fails_every_write(make_buffer, storage, monkeypatch):
+    def unavailable(body, **kwargs):
+        raise ConnectionError('cluster unavailable')
+    monkeypatch.setattr(storage.es, 'bulk', unavailable)
+    buffer = make_buffer(max_docs=2, max_delay=60)
+    futures = [buffer.submit(book('lost')), buffer.submit(book('lost too'))]
+
+    assert all(isinstance(future.exception(timeout=5), ConnectionError) for future in futures)
+
+
+def test_rejects_unknown_refresh(make_buffer):
+    with pytest.raises(ValueError):
+        make_buffer().submit(book('x'), refresh='false')
@@ -1,53 +1,22 @@
-import csv
+import base64
 import json
 
-from settings import COLUMNS
 
-
-def prepare_for_save(attr_dict_data):
+def encode_cursor(sort_values):
     """
-    This function is used to take output data and change authors format
+    This function is used to turn the sort values of a hit into an opaque search_after cursor
 
-    :param attr_dict_data: attribute data
-    :return: changes in authors field
+    :param sort_values: sort values of the last hit of a page
+    :return: cursor token
     """
-    for d in attr_dict_data:
-        d["authors"] = "|".join(d["authors"])
-    return attr_dict_data
-
-
-def toJSON(dictionary):
-    """This function is used to convert list of dicts to json object"""
-    return json.dumps(
-        dictionary,
-        default=lambda o: o.__dict__,
-        sort_keys=True, indent=4)
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode()).decode()
 
 
-def save_json_to_file(json_data, filename):
+def decode_cursor(cursor):
     """
-    This function is used to save a JSON string to a file
+    This function is used to turn an opaque search_after cursor back into sort values
 
-    :param json_data: json data object
-    :param filename: filename
-    :return: None
+    :param cursor: cursor token
+    :return: sort values
     """
-    with open(filename, 'w') as f:
-        json.dump(json_data, f)
-
-
-def save_attr_dict_to_csv(attrdict, filename):
-    """
-    This function is used to store elastic search response to CSV
-    :param attrdict: elasticsearch response
-    :param filename: file name to save
-    :return: None
-    """
-    with open(filename, 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=COLUMNS)
-
-        for attr_data in attrdict:
-            to_dict = attr_data.__dict__['_d_']
-
-            writer.writeheader()
-            writer.writerow(to_dict)
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))